@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Measures encoder throughput (in panels per second) on synthetic panel renders.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import pysodium
+
+from PIL import Image, ImageDraw
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "src")
+
+sys.path.append(SRC_DIR)
+
+import encoder
+import payload
+
+
+def render_panel(seed, size=(640, 400)):
+    """
+    Renders a panel resembling a typical status update: lines of text with the occasional highlighted heading.
+    """
+    r = random.Random(seed)
+    image = Image.new("RGB", size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    y = 4
+    while y < size[1] - 12:
+        colour = (255, 255, 0) if r.random() < 0.2 else (0, 0, 0)
+        text = " ".join("".join(r.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(r.randint(2, 9)))
+                        for _ in range(r.randint(3, 12)))
+        draw.text((4, y), text, fill=colour)
+        y += 14
+    return image
+
+
+def reference_encode(image):
+    # Straightforward per-pixel implementation, for comparison.
+    data = image.tobytes()
+    pixels = [data[i:i + 3] for i in range(0, len(data), 3)]
+    indexes = {b"\x00\x00\x00": 0, b"\xff\xff\x00": 1, b"\xff\xff\xff": 2}
+    packed = bytearray()
+    for i in range(0, len(pixels), 4):
+        byte = 0
+        for j in range(4):
+            byte |= indexes.get(pixels[i + j], 0) << (j * 2)
+        packed.append(byte)
+    return payload.encode_rle(packed)
+
+
+def measure(name, count, fn):
+    start = time.perf_counter()
+    fn()
+    duration = time.perf_counter() - start
+    print("%-24s %8.1f panels/s" % (name, count / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=200, help="number of panels to encode")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of encoder processes")
+    options = parser.parse_args()
+
+    public_key, _ = pysodium.crypto_box_keypair()
+    panels = [render_panel(seed) for seed in range(options.count)]
+    reference_count = max(options.count // 20, 1)
+
+    measure("reference", reference_count, lambda: [reference_encode(panel) for panel in panels[:reference_count]])
+    measure("vectorised", options.count, lambda: [encoder.encode_image(panel) for panel in panels])
+    measure("vectorised + seal", options.count, lambda: [encoder.encode_update([panel], public_key)
+                                                         for panel in panels])
+    with encoder.Encoder(max_workers=options.workers) as pool:
+        list(pool.encode_updates([([panels[0]], public_key, 0)]))  # Start the workers.
+        measure("pool (%d workers)" % options.workers,
+                options.count,
+                lambda: list(pool.encode_updates(([panel], public_key, 0) for panel in panels)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""
+Compares the size and decode time of the available image encodings on a corpus of panel renders.
+"""
+
+import argparse
+import glob
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "src")
+
+sys.path.append(SRC_DIR)
+
+import encoder
+import payload
+
+from benchmark_encoder import render_panel
+
+
+ENCODINGS = {
+    "rle": payload.RLE,
+    "zlib": payload.ZLIB,
+    "png": payload.PNG,
+}
+
+PLANE_LENGTH = 640 * 400 // 4
+
+
+def decode(data, encoding):
+    if encoding == payload.PNG:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+    return payload.decode_plane(data, encoding, PLANE_LENGTH)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", nargs="?", help="directory of 640x400 panel renders (defaults to synthetic renders)")
+    parser.add_argument("--count", type=int, default=50, help="number of synthetic renders to use")
+    options = parser.parse_args()
+
+    if options.directory:
+        panels = [Image.open(path).convert("RGB") for path in sorted(glob.glob(os.path.join(options.directory, "*.png")))]
+    else:
+        panels = [render_panel(seed) for seed in range(options.count)]
+    if not panels:
+        exit("No panels found.")
+
+    print("%-6s %10s %10s %12s" % ("", "mean bytes", "max bytes", "decode ms"))
+    for name, encoding in ENCODINGS.items():
+        encoded = [encoder.encode_image(panel, encoding) for panel in panels]
+        start = time.perf_counter()
+        for data in encoded:
+            decode(data, encoding)
+        duration = (time.perf_counter() - start) * 1000 / len(encoded)
+        sizes = [len(data) for data in encoded]
+        print("%-6s %10.0f %10d %12.3f" % (name, sum(sizes) / len(sizes), max(sizes), duration))
+
+
+if __name__ == "__main__":
+    main()
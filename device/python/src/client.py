@@ -0,0 +1,343 @@
+import concurrent.futures
+import datetime
+import email.utils
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+
+from dataclasses import dataclass
+
+import requests
+import requests.adapters
+
+from stats import Stats
+
+
+DEFAULT_SERVICE_URL = "https://api.statuspanel.io/"
+
+# Enough to cover the largest possible header (255 bytes) and index (255 four-byte offsets).
+INDEX_RANGE = "bytes=0-1274"
+
+# Connect and read timeouts (in seconds), so a stalled connection can't stop the device polling.
+REQUEST_TIMEOUT = (10, 60)
+
+
+class MissingUpdate(Exception):
+    pass
+
+
+class UpdateChanged(Exception):
+    pass
+
+
+class ServiceUnavailable(Exception):
+    """
+    Raised for transient failures (e.g., '429 Too Many Requests' or '503 Service Unavailable'); the request should be
+    retried later, after at least `retry_after` seconds if given, without discarding the current update.
+    """
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__("Service returned status code %s" % status_code)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+@dataclass
+class UpdateData:
+    data: bytes  # None if the update hasn't been modified.
+    last_modified: str
+    etag: str
+    max_age: int
+    complete: bool = True  # False if data only contains the header and index.
+
+    @property
+    def modified(self):
+        return self.data is not None
+
+
+class Service(object):
+
+    def __init__(self, identifier, base_url=DEFAULT_SERVICE_URL, stats=None, timeout=REQUEST_TIMEOUT):
+        self.identifier = identifier
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.stats = stats if stats is not None else Stats()
+
+    def get(self, url, **kwargs):
+        self.stats.increment("requests")
+        try:
+            with self.stats.time("request"):
+                response = self.session.get(url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.stats.increment("request_errors")
+            raise
+        self.stats.increment("bytes_downloaded", len(response.content))
+        return response
+
+    @property
+    def update_url(self):
+        return self.base_url.rstrip("/") + "/api/v3/status/" + self.identifier.id
+
+    def image_url(self, index):
+        return self.update_url + "/image/%d" % index
+
+    def get_status_data(self, etag=None, last_modified=None, index_only=False):
+        """
+        Fetches the raw update from the service using a single conditional request; the returned `UpdateData` has no
+        data if the update hasn't changed since the given validators.
+
+        If `index_only` is set, we ask for just enough of the update to read the header and image index, leaving the
+        images to be fetched individually using `get_image`.
+        """
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        if index_only:
+            headers['Range'] = INDEX_RANGE
+        logging.info("Fetching update '%s'...", self.update_url)
+        response = self.get(self.update_url, headers=headers)
+        if response.status_code == 304:
+            self.stats.increment("not_modified")
+            return UpdateData(data=None,
+                              last_modified=response.headers.get('last-modified', last_modified),
+                              etag=response.headers.get('etag', etag),
+                              max_age=get_max_age(response.headers))
+        if response.status_code not in (200, 206):
+            logging.warning("Failed to fetch update with status code '%s'.",
+                            response.status_code)
+            raise get_error(response)
+        complete = True
+        if response.status_code == 206:
+            _, _, length = response.headers.get('content-range', '').rpartition('/')
+            complete = length == str(len(response.content))
+        return UpdateData(data=response.content,
+                          last_modified=response.headers.get('last-modified'),
+                          etag=response.headers.get('etag'),
+                          max_age=get_max_age(response.headers),
+                          complete=complete)
+
+    def get_image(self, index, etag):
+        """
+        Fetches a single (still encrypted) image from the update, raising `UpdateChanged` if the update no longer has
+        the ETag `etag`, or `MissingUpdate` if the service can't serve the image on its own. ETags are compared rather
+        than Last-Modified, which can't distinguish updates made within the same second.
+        """
+        logging.info("Fetching image '%s'...", self.image_url(index))
+        response = self.get(self.image_url(index))
+        if response.status_code != 200:
+            logging.warning("Failed to fetch image with status code '%s'.",
+                            response.status_code)
+            raise get_error(response)
+        if response.headers.get('x-status-etag') != etag:
+            raise UpdateChanged()
+        return response.content
+
+
+class Uploader(object):
+    """
+    Uploads updates to the service, reusing a pool of connections across uploads (and threads).
+    """
+
+    def __init__(self, base_url=DEFAULT_SERVICE_URL, pool_size=10):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def upload(self, identifier, data):
+        url = self.base_url.rstrip("/") + "/api/v3/status/" + identifier
+        response = self.session.post(url, files={'file': data})
+        response.raise_for_status()
+
+    def upload_all(self, updates):
+        """
+        Uploads `(identifier, data)` pairs concurrently, returning once all uploads have completed.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            for future in [executor.submit(self.upload, identifier, data) for identifier, data in updates]:
+                future.result()
+
+
+class UpdateCache(object):
+    """
+    Persists the most recent update and its validators so that conditional requests continue to work across restarts.
+
+    Decoded frames (and the setup screen) are also stored as raw pixel data, alongside a small JSON description, so they
+    can be memory-mapped and shown immediately on boot without decrypting or decoding anything.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def data_path(self):
+        return os.path.join(self.path, "update")
+
+    @property
+    def validators_path(self):
+        return os.path.join(self.path, "update.json")
+
+    def image_path(self, index, etag):
+        # Images are keyed by the update they belong to, so an image fetched for a previous update that's saved after a
+        # new update can never be mistaken for part of it.
+        return os.path.join(self.path, "image-%s-%d" % (hashlib.sha256(str(etag).encode("utf-8")).hexdigest()[:16],
+                                                        index))
+
+    def frame_path(self, index):
+        return os.path.join(self.path, "frame-%d" % index)
+
+    @property
+    def setup_screen_path(self):
+        return os.path.join(self.path, "setup-screen")
+
+    def load(self):
+        try:
+            with open(self.validators_path) as fh:
+                validators = json.load(fh)
+            with open(self.data_path, "rb") as fh:
+                data = fh.read()
+        except (OSError, ValueError):
+            return None
+        return UpdateData(data=data,
+                          last_modified=validators.get("last_modified"),
+                          etag=validators.get("etag"),
+                          max_age=None,
+                          complete=validators.get("complete", True))
+
+    def save(self, update):
+        # Images from any previous update are removed, and the data written before the validators, so a partially
+        # written cache can never pair new validators with stale data.
+        self.clear()
+        os.makedirs(self.path, exist_ok=True)
+        write_atomic(self.data_path, update.data)
+        write_atomic(self.validators_path, json.dumps({
+            "last_modified": update.last_modified,
+            "etag": update.etag,
+            "complete": update.complete,
+        }).encode("utf-8"))
+
+    def load_image(self, index, etag):
+        """
+        Returns the (still encrypted) image at `index`, or None if there's no image for the update with the given ETag.
+        """
+        try:
+            with open(self.image_path(index, etag), "rb") as fh:
+                return fh.read()
+        except OSError:
+            return None
+
+    def save_image(self, index, etag, data):
+        write_atomic(self.image_path(index, etag), data)
+
+    def load_frame(self, index, etag):
+        """
+        Returns the raw pixels and description of the decoded frame at `index`, or None if there's no frame for the
+        update with the given ETag.
+        """
+        return load_raw(self.frame_path(index), lambda description: description.get("etag") == etag)
+
+    def save_frame(self, index, data, description):
+        """
+        Saves a decoded frame; `description` must include the ETag of the update it was decoded from.
+        """
+        save_raw(self.frame_path(index), data, description)
+
+    def load_setup_screen(self, pairing_url):
+        return load_raw(self.setup_screen_path, lambda description: description.get("pairing_url") == pairing_url)
+
+    def save_setup_screen(self, data, description):
+        os.makedirs(self.path, exist_ok=True)
+        save_raw(self.setup_screen_path, data, description)
+
+    def clear(self):
+        paths = [self.validators_path, self.data_path]
+        if os.path.isdir(self.path):
+            paths.extend(os.path.join(self.path, name)
+                         for name in os.listdir(self.path)
+                         if name.startswith("image-") or name.startswith("frame-"))
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def load_raw(path, is_valid):
+    try:
+        with open(path + ".json") as fh:
+            description = json.load(fh)
+        if not is_valid(description):
+            return None
+        with open(path, "rb") as fh:
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ), description
+    except (OSError, ValueError):
+        return None
+
+
+def save_raw(path, data, description):
+    # As with updates, the data is written before its description so the two can't be mismatched.
+    write_atomic(path, data)
+    write_atomic(path + ".json", json.dumps(description).encode("utf-8"))
+
+
+def write_atomic(path, data):
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(temporary_path, path)
+    except:
+        os.remove(temporary_path)
+        raise
+
+
+def get_retry_after(headers):
+    """
+    Returns the delay, in seconds, given by the 'Retry-After' response header, or None if it's missing or invalid.
+    """
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_after = email.utils.parsedate_to_datetime(value)
+        return max(int((retry_after - datetime.datetime.now(datetime.timezone.utc)).total_seconds()), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_error(response):
+    # Only a 404 means the update is gone; anything else is assumed to be transient.
+    if response.status_code == 404:
+        return MissingUpdate()
+    return ServiceUnavailable(response.status_code, retry_after=get_retry_after(response.headers))
+
+
+def get_max_age(headers):
+    """
+    Returns the lifetime, in seconds, given by the 'Cache-Control: max-age' or 'Expires' response headers, or None if
+    neither is present.
+    """
+    for directive in headers.get('cache-control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age':
+            try:
+                return max(int(value), 0)
+            except ValueError:
+                return None
+    try:
+        expires = email.utils.parsedate_to_datetime(headers['expires'])
+        return max(int((expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds()), 0)
+    except (KeyError, TypeError, ValueError):
+        return None
@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import base64
+import concurrent.futures
+import datetime
 import enum
+import hashlib
 import json
 import io
 import logging
+import math
+import multiprocessing
 import os
+import random
 import signal
-import struct
 import subprocess
 import sys
 import threading
@@ -16,7 +22,7 @@ import time
 import urllib.parse
 import uuid
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import inky
 import pysodium
@@ -24,15 +30,41 @@ import qrcode
 import requests
 import RPi.GPIO as GPIO
 
-from PIL import Image, ImageOps
+from PIL import Image, ImageChops, ImageOps
 from inky.auto import auto
 
+import client
+import payload
+
+from stats import Stats, Stopwatch
+
 
 verbose = '--verbose' in sys.argv[1:] or '-v' in sys.argv[1:]
 logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, format="[%(levelname)s] %(message)s")
 
 
 SETTINGS_PATH = os.path.expanduser("~/.statuspanel")
+CACHE_PATH = os.path.expanduser("~/.statuspanel-cache")
+
+# Polling intervals (in seconds). The service suggests how often to poll using 'Cache-Control: max-age', which we clamp to
+# keep devices responsive and protect the service from misconfiguration.
+DEFAULT_UPDATE_INTERVAL = 30
+MINIMUM_UPDATE_INTERVAL = 10
+MAXIMUM_UPDATE_INTERVAL = 60 * 60
+SETUP_UPDATE_INTERVAL = 10
+ERROR_UPDATE_INTERVAL = 10
+MAXIMUM_ERROR_INTERVAL = 10 * 60
+
+# If the update changes while we're fetching its images, we retry after a short pause, backing off if it keeps happening
+# and waiting for the next regular poll after too many consecutive retries.
+UPDATE_CHANGED_DELAY = 1
+MAXIMUM_UPDATE_CHANGED_RETRIES = 5
+
+# Grace period after the daily update time before polling, giving the app time to upload.
+WAKEUP_GRACE_PERIOD = 60
+
+# Interval (in seconds) between stats log lines.
+STATS_INTERVAL = 15 * 60
 
 PALETTE = {
     0: (0, 0, 0),
@@ -47,12 +79,25 @@ class Size:
     height: int
 
 
+@dataclass
+class Frame:
+    image: Image.Image = field(compare=False)
+    digest: bytes  # Digest of the decoded pixels; frames with the same digest are considered identical.
+
+
 @dataclass
 class DisplayState:
-    images: list
+    images: list  # Frames.
     index: int
 
 
+@dataclass
+class Update:
+    data: client.UpdateData
+    header: payload.Header
+    images: list  # Decoded frames; None for images that haven't been fetched yet.
+
+
 class DeviceIdentifier(object):
 
     def __init__(self, id, public_key, secret_key):
@@ -67,6 +112,15 @@ class DeviceIdentifier(object):
                    public_key=public_key,
                    secret_key=secret_key)
 
+    @property
+    def phase(self):
+        """
+        Stable value in the range [0, 1) derived from the identifier, used to spread polls from many devices evenly
+        across each polling interval.
+        """
+        digest = hashlib.sha256(self.id.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
     @property
     def pairing_url(self):
         public_key = base64.b64encode(self.public_key)
@@ -81,18 +135,6 @@ class DeviceIdentifier(object):
 DEVICE_SIZE = Size(640, 400)
 
 
-class MissingUpdate(Exception):
-    pass
-
-
-class InvalidHeader(Exception):
-    pass
-
-
-class UnsupportedUpdate(Exception):
-    pass
-
-
 class State(enum.Enum):
     UNKNOWN = 0
     PAIRING = 1
@@ -105,147 +147,65 @@ class Button(enum.Enum):
     D = 24
 
 
-class Service(object):
+class Backoff(object):
+    """
+    Exponential backoff with full jitter: each successive delay is drawn uniformly from [minimum, bound], where the
+    bound doubles with every consecutive failure (up to `cap`).
+    """
 
-    def __init__(self, identifier):
-        self.identifier = identifier
-
-    @property
-    def update_url(self):
-        return "https://api.statuspanel.io/api/v3/status/" + self.identifier.id
-
-    def get_status_last_modified(self):
-        logging.info("Fetching update header '%s'...", self.update_url)
-        response = requests.head(self.update_url)
-        if response.status_code != 200:
-            logging.warning("Failed to fetch update with status code '%s'.",
-                            response.status_code)
-            raise MissingUpdate()
-        return response.headers['last-modified']
-
-
-    def get_status(self):
-        logging.info("Fetching update '%s'...", self.update_url)
-        response = requests.get(self.update_url)
-        if response.status_code != 200:
-            logging.warning("Failed to fetch update with status code '%s'.",
-                            response.status_code)
-            raise MissingUpdate()
-
-        last_modified = response.headers['last-modified']
-        data = io.BytesIO(response.content)
-
-        # Check for a valid update.
-        if unpack(data, '>H')[0] != 0xFF00:
-            raise InvalidHeader()
-
-        # Ensure the header 'version' is high enough for the assumptions in our
-        # implementation.
-        headerLength = unpack(data, '>B')[0]
-        logging.debug("Header Length: %d", headerLength)
-        if headerLength < 8:
-            raise UnsupportedUpdate()
-
-        wakeupTime = unpack(data, '>H')[0]
-        logging.debug("Wakeup Time: %d", wakeupTime)
-
-        imageCount = unpack(data, '>B')[0]
-        logging.debug("Image Count: %d", imageCount)
-
-        encoding = unpack(data, '<H')[0]
-        logging.debug("Encoding: %d", encoding)
-
-        # Seek to the end of the header.
-        data.seek(headerLength)
-
-        # Read the index (given after the header), calculating lengths as we go.
-        offsets = []
-        start = None
-        for _ in range(0, imageCount):
-            offset = unpack(data, '<I')[0]
-            if start is not None:
-                offsets.append((start, offset - start))
-            start = offset
-        if start is not None:
-            offsets.append((start, -1))
-        logging.debug("Offsets: %s", offsets)
-
-        # Read the images.
-        images = []
-        for (offset, size) in offsets:
-            assert(data.tell() == offset)
-            image = data.read(size)
-            contents = pysodium.crypto_box_seal_open(image,
-                                                     self.identifier.public_key,
-                                                     self.identifier.secret_key)
-
-            if encoding == 0:
-                logging.debug("Decoding RLE...")
-
-                # Unpack the RLE data.
-                rle_data = io.BytesIO(contents)
-                pixel_data = bytearray()
-                try:
-                    while len(pixel_data) * 4 < DEVICE_SIZE.width * DEVICE_SIZE.height:
-                        pixel = unpack(rle_data, 'B')[0]
-                        if pixel == 255:
-                            count = unpack(rle_data, 'B')[0]
-                            value = unpack(rle_data, 'B')[0]
-                            for _ in range(0, count):
-                                pixel_data.append(value)
-                        else:
-                            pixel_data.append(pixel)
-                except Exception as e:
-                    # TODO: Make this more specific.
-                    pass
-
-                # Convert the 2BPP representation to 8BPP RGB.
-                rgb_data = []
-                for byte in pixel_data:
-                    rgb_data.append(PALETTE[(byte >> 0) & 3])
-                    rgb_data.append(PALETTE[(byte >> 2) & 3])
-                    rgb_data.append(PALETTE[(byte >> 4) & 3])
-                    rgb_data.append(PALETTE[(byte >> 6) & 3])
-
-                pil_image = Image.new("RGB",
-                                      (DEVICE_SIZE.width, DEVICE_SIZE.height),
-                                      (255, 255, 255))
-                pil_image.putdata(rgb_data)
-                images.append(pil_image)
-
-            elif encoding == 1:
-                logging.debug("Decoding PNG...")
-                pil_image = Image.open(io.BytesIO(contents))
-                images.append(pil_image)
+    def __init__(self, base, cap, minimum=1):
+        self.base = base
+        self.cap = cap
+        self.minimum = minimum
+        self.failures = 0
 
-            else:
-                print("Unsupported Encoding")
+    def reset(self):
+        self.failures = 0
 
-        return images, last_modified
+    def next_delay(self):
+        bound = min(self.cap, self.base * 2 ** min(self.failures, 32))
+        self.failures += 1
+        return random.uniform(self.minimum, max(bound, self.minimum))
 
 
 class Device(object):
 
-    def __init__(self, identifier):
+    def __init__(self, identifier, service_url=client.DEFAULT_SERVICE_URL, cache_path=None):
         self.identifier = identifier
-        self.service = Service(identifier)
+        self.stats = Stats()
+        self.service = client.Service(identifier, base_url=service_url, stats=self.stats)
+        self.cache = client.UpdateCache(cache_path) if cache_path is not None else None
 
         self.state = State.UNKNOWN
 
         self._lock = threading.Lock()
         self._state = None  # Synchronized on _lock
         self._requested_state = None  # Synchronized on _lock
+        self._update = None  # Synchronized on _lock
+        self._header = None  # Synchronized on _lock
         self._last_modified = None
+        self._etag = None
+        self._wakeup_time = None
+        self._max_age = None
+        self._frame = None  # Only accessed from the render thread.
+        self._frame_digest = None  # Only accessed from the render thread.
+
+        # Start from the validators of the last update we saw so that even our first request can be conditional.
+        if self.cache is not None:
+            cached_update = self.cache.load()
+            if cached_update is not None:
+                self._last_modified = cached_update.last_modified
+                self._etag = cached_update.etag
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, **kwargs):
         with open(path) as fh:
             settings = json.load(fh)
             id = settings["id"]
             public_key = base64.b64decode(settings["public_key"])
             secret_key = base64.b64decode(settings["secret_key"])
             identifier = DeviceIdentifier(id, public_key, secret_key)
-            return cls(identifier=identifier)
+            return cls(identifier=identifier, **kwargs)
 
     def save(self, path):
         with open(path, "w") as fh:
@@ -268,37 +228,225 @@ class Device(object):
         if self.state == State.PAIRING:
             return
         self.state = State.PAIRING
-        image = Image.new("RGB", display.resolution, (255, 255, 255))
-        code = qrcode.make(self.identifier.pairing_url, box_size=4)
-        origin_x = int((image.size[0] - code.size[0]) / 2)
-        origin_y = int((image.size[1] - code.size[1]) / 2)
-        image.paste(code, (origin_x, origin_y))
-        display.set_image(image)
-        display.show()
+        with self._lock:
+            self._state = None  # Ensure the next update is drawn, even if it hasn't changed.
+        image = self.load_setup_screen(display.resolution)
+        if image is None:
+            image = Image.new("RGB", display.resolution, (255, 255, 255))
+            code = qrcode.make(self.identifier.pairing_url, box_size=4)
+            origin_x = int((image.size[0] - code.size[0]) / 2)
+            origin_y = int((image.size[1] - code.size[1]) / 2)
+            image.paste(code, (origin_x, origin_y))
+            if self.cache is not None:
+                self.cache.save_setup_screen(image.tobytes(), {
+                    "pairing_url": self.identifier.pairing_url,
+                    "size": image.size,
+                })
+        self.show_frame(display, image)
+
+    def load_setup_screen(self, size):
+        cached = self.cache.load_setup_screen(self.identifier.pairing_url) if self.cache is not None else None
+        if cached is None:
+            return None
+        buffer, description = cached
+        with buffer:
+            if tuple(description["size"]) != tuple(size) or len(buffer) != size[0] * size[1] * 3:
+                return None
+            return Image.frombytes("RGB", size, buffer)
 
     def show_error(self, display, message):
+        with self._lock:
+            self._state = None  # Ensure the next update is drawn, even if it hasn't changed.
         image = Image.new("RGB", display.resolution, (255, 255, 255))
         image.paste((255, 0, 255), (0, 0, image.size[0], image.size[1]))
-        display.set_image(image)
-        display.show()
+        self.show_frame(display, image)
+
+    def reset_validators(self):
+        self._last_modified = None
+        self._etag = None
+        self._max_age = None
+        if self.cache is not None:
+            self.cache.clear()
+
+    def fetch_update(self):
+        """
+        Fetches the header and index of the update from the service, returning `client.UpdateData` to apply, or None
+        if the update hasn't changed since it was last applied. Images are fetched separately using `fetch_image`.
+        """
+        try:
+            update = self.service.get_status_data(etag=self._etag,
+                                                  last_modified=self._last_modified,
+                                                  index_only=True)
+        except client.MissingUpdate:
+            # The update no longer exists, so anything we're holding on to is stale.
+            self.reset_validators()
+            raise
+        self._max_age = update.max_age
+
+        if update.modified:
+            if self.cache is not None:
+                self.cache.save(update)
+            return update
+
+        with self._lock:
+            has_state = self._requested_state is not None
+        if has_state:
+            print("No update; skipping...")
+            return None
+
+        # The update is unchanged since before we restarted, so use our cached copy if we can.
+        cached_update = self.cache.load() if self.cache is not None else None
+        if cached_update is not None and cached_update.etag == update.etag:
+            cached_update.max_age = update.max_age
+            return cached_update
+        self._last_modified = None
+        self._etag = None
+        return self.fetch_update()
+
+    def fetch_image(self, update, header, index):
+        """
+        Returns the (still encrypted) image at `index`, fetching it from the service if the update is incomplete. Raises
+        `client.UpdateChanged` if the update has changed since `update` was fetched, or `client.MissingUpdate` if it has
+        gone away.
+        """
+        if update.complete:
+            # The image is copied here as it needs to be sent to the decoding process.
+            return bytes(header.image(update.data, index))
+        data = self.cache.load_image(index, update.etag) if self.cache is not None else None
+        if data is not None:
+            return data
+        try:
+            data = self.service.get_image(index, update.etag)
+        except client.UpdateChanged:
+            # Start again from the top with an unconditional request.
+            self.reset_validators()
+            raise
+        except client.MissingUpdate:
+            # The service can't serve the image on its own (e.g., the update predates its image index), so fall back to
+            # fetching the whole update.
+            return self.fetch_image_from_update(update, index)
+        if self.cache is not None:
+            self.cache.save_image(index, update.etag, data)
+        return data
+
+    def fetch_image_from_update(self, update, index):
+        try:
+            complete_update = self.service.get_status_data()
+        except client.MissingUpdate:
+            self.reset_validators()
+            raise
+        if complete_update.etag != update.etag:
+            self.reset_validators()
+            raise client.UpdateChanged()
+        header = payload.parse_header(complete_update.data)
+        images = [bytes(header.image(complete_update.data, i)) for i in range(len(header.offsets))]
+        if self.cache is not None:
+            for i, data in enumerate(images):
+                self.cache.save_image(i, update.etag, data)
+        return images[index]
+
+    def requested_index(self, count):
+        with self._lock:
+            return 0 if self._requested_state is None else self._requested_state.index % count
 
-    def fetch_update(self, display):
+    def restore(self):
+        """
+        Restores the most recent update, and any frames decoded from it, from the cache so there's something to show
+        before the first poll completes. Returns True if the requested frame was restored.
+        """
+        cached_update = self.cache.load() if self.cache is not None else None
+        if cached_update is None:
+            return False
         try:
-            if self._last_modified is not None:
-                last_modified = self.service.get_status_last_modified()
-                if last_modified == self._last_modified:
-                    print("No update; skipping...")
-                    return
-            images, self._last_modified = self.service.get_status()
-        except:
-            self._last_modified = None  # Ensure subsequent updates clear the screen.
-            raise  # Re-raise the exception.
+            header = payload.parse_header(cached_update.data)
+        except (payload.InvalidHeader, payload.UnsupportedUpdate) as e:
+            logging.warning("Ignoring cached update with error '%r'", e)
+            return False
+        if not header.offsets:
+            return False
+        images = [self.load_frame(cached_update, index) for index in range(len(header.offsets))]
+        self.apply_update(Update(data=cached_update, header=header, images=images))
+        return self.missing_image() is None
+
+    def load_frame(self, update, index):
+        cached = self.cache.load_frame(index, update.etag)
+        if cached is None:
+            return None
+        buffer, description = cached
+        with buffer:
+            width, height = description["size"]
+            if len(buffer) != width * height * 3:
+                return None
+            return Frame(image=Image.frombytes("RGB", (width, height), buffer),
+                         digest=bytes.fromhex(description["digest"]))
+
+    def save_frame(self, update, index, frame):
+        if self.cache is None:
+            return
+        self.cache.save_frame(index, frame.image.tobytes(), {
+            "etag": update.etag,
+            "size": frame.image.size,
+            "digest": frame.digest.hex(),
+        })
+
+    def apply_update(self, update):
+        self.state = State.UNKNOWN
+        self._last_modified = update.data.last_modified
+        self._etag = update.data.etag
+        self._wakeup_time = update.header.wakeup_time
+        self._max_age = update.data.max_age
+
+        with self._lock:
+            self._update = update.data
+            self._header = update.header
+            index = 0 if self._requested_state is None else self._requested_state.index % len(update.images)
+            self._requested_state = DisplayState(update.images, index)
+
+    def missing_image(self):
+        """
+        Returns the update, header, and index of the requested image if it still needs to be fetched, or None.
+        """
+        with self._lock:
+            state = self._requested_state
+            if state is None or state.images[state.index] is not None:
+                return None
+            return self._update, self._header, state.index
 
+    def set_image(self, update, index, image):
         with self._lock:
-            index = 0 if self._requested_state is None else self._requested_state.index % len(images)
-            self._requested_state = DisplayState(images, index)
+            if update is not self._update:
+                return  # A newer update has been applied in the meantime.
+            images = list(self._requested_state.images)
+            images[index] = image
+            self._requested_state = DisplayState(images, self._requested_state.index)
 
-        self.display_image_if_necessary(display)
+    def phased_delay(self, interval, now=None):
+        """
+        Returns a delay between half and one and a half times `interval` that lands on this device's phase within the
+        interval, so that devices which happen to poll at the same moment drift apart rather than staying in lockstep.
+        """
+        now = now if now is not None else time.time()
+        offset = self.identifier.phase * interval
+        deadline = math.ceil((now + interval / 2 - offset) / interval) * interval + offset
+        return deadline - now
+
+    def next_update_delay(self, now=None):
+        """
+        Returns the number of seconds to wait before polling for the next update, using the service's suggested polling
+        interval, but making sure to wake in time for the daily update time given in the update header.
+        """
+        interval = DEFAULT_UPDATE_INTERVAL
+        if self._max_age is not None:
+            interval = min(max(self._max_age, MINIMUM_UPDATE_INTERVAL), MAXIMUM_UPDATE_INTERVAL)
+        now = now if now is not None else datetime.datetime.now()
+        delay = self.phased_delay(interval, now=now.timestamp())
+        if self._wakeup_time is not None:
+            midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            wakeup = midnight + datetime.timedelta(minutes=self._wakeup_time, seconds=WAKEUP_GRACE_PERIOD)
+            if wakeup <= now:
+                wakeup += datetime.timedelta(days=1)
+            delay = min(delay, (wakeup - now).total_seconds())
+        return max(math.ceil(delay), 1)
 
     def display_image_if_necessary(self, display):
         """
@@ -310,6 +458,9 @@ class Device(object):
             if self._state == self._requested_state:
                 logging.info("No update requested; ignoring...")
                 return
+            if self._requested_state.images[self._requested_state.index] is None:
+                logging.info("Requested image not yet fetched; ignoring...")
+                return
             self._state = self._requested_state
             state = self._requested_state
         assert state is not None
@@ -317,28 +468,297 @@ class Device(object):
         panel_image = Image.new("RGB",
                                 display.resolution,
                                 (255, 255, 255))
-        panel_image.paste(state.images[state.index], (0, 0))
-        display.set_image(panel_image)
-        display.show()
+        panel_image.paste(state.images[state.index].image, (0, 0))
+        self.show_frame(display, panel_image)
 
+    def show_frame(self, display, image):
+        """
+        Shows an image on the display unless it's pixel-identical to the one already shown. Displays that support
+        partial updates (by implementing `show_region`) only refresh the bounding box of the pixels that have changed.
+        """
+        digest = hashlib.sha256(image.tobytes()).digest()
+        if digest == self._frame_digest:
+            self.stats.increment("refreshes_avoided")
+            logging.info("Frame unchanged; skipping refresh...")
+            return
+        region = None
+        if self._frame is not None and self._frame.size == image.size and self._frame.mode == image.mode:
+            region = ImageChops.difference(self._frame, image).getbbox()
+        with self.stats.time("refresh"):
+            display.set_image(image)
+            if region is not None and hasattr(display, "show_region"):
+                logging.info("Refreshing region %s...", region)
+                display.show_region(region)
+            else:
+                display.show()
+        self.stats.increment("refreshes")
+        self._frame = image
+        self._frame_digest = digest
+
+
+class Runtime(object):
+    """
+    Asyncio-based device runtime.
+
+    Polling runs independently of rendering: network requests happen on the default executor, CPU-bound decoding in a
+    separate process, and all display access on a single dedicated thread. Redraw requests made while the display is
+    refreshing coalesce into a single redraw of the latest requested state.
+    """
+
+    def __init__(self, device, display, stats_socket=None):
+        self.device = device
+        self.display = display
+        self.stats_socket = stats_socket
+        self._render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._decode_executor = concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                                       mp_context=multiprocessing.get_context("spawn"))
+        self._loop = None
+        self._redraw = None
+        self._poll = None
+
+    def request_redraw(self):
+        """
+        Schedules a redraw; safe to call from any thread.
+        """
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._redraw.set)
+        except RuntimeError:
+            pass  # The runtime has stopped.
+
+    async def render(self, fn, *args):
+        return await self._loop.run_in_executor(self._render_executor, fn, *args)
+
+    async def load_image(self, update, header, index):
+        data = await self._loop.run_in_executor(None, self.device.fetch_image, update, header, index)
+        frame, timings = await self._loop.run_in_executor(self._decode_executor,
+                                                          decode_frame,
+                                                          data,
+                                                          header.encoding,
+                                                          self.device.identifier.public_key,
+                                                          self.device.identifier.secret_key)
+        self.device.stats.record_all(timings)
+        self.device.stats.record("decode", sum(timings.values()))
+        await self._loop.run_in_executor(None, self.device.save_frame, update, index, frame)
+        return frame
+
+    async def restore(self):
+        """
+        Shows the last update (or setup screen) from the cache, without waiting for the network.
+        """
+        if await self._loop.run_in_executor(None, self.device.restore):
+            logging.info("Showing cached update...")
+            self._redraw.set()
+        elif self.device.cache is not None and self.device.cache.load() is None:
+            # We were unpaired (or have never been paired) when we last ran.
+            await self.render(self.device.show_setup_screen, self.display)
+
+    async def update(self):
+        with self.device.stats.time("fetch_update"):
+            update = await self._loop.run_in_executor(None, self.device.fetch_update)
+        if update is None:
+            return
+        self.device.stats.increment("updates")
+        header = payload.parse_header(update.data)
+        # Only the image we're about to show is fetched and decoded; the others are loaded when they're selected.
+        images = [None] * len(header.offsets)
+        index = self.device.requested_index(len(images))
+        images[index] = await self.load_image(update, header, index)
+        self.device.apply_update(Update(data=update, header=header, images=images))
+        self._redraw.set()
+
+    async def poll(self):
+        backoff = Backoff(base=ERROR_UPDATE_INTERVAL, cap=MAXIMUM_ERROR_INTERVAL)
+        changes = 0
+        while True:
+            try:
+                logging.info("Fetching update...")
+                await self.update()
+                backoff.reset()
+                changes = 0
+                delay = self.device.next_update_delay()
+            except client.MissingUpdate:
+                self.device.stats.increment("missing_updates")
+                backoff.reset()
+                changes = 0
+                await self.render(self.device.show_setup_screen, self.display)
+                delay = self.device.phased_delay(SETUP_UPDATE_INTERVAL)
+            except client.UpdateChanged:
+                self.device.stats.increment("changed_updates")
+                changes += 1
+                if changes > MAXIMUM_UPDATE_CHANGED_RETRIES:
+                    logging.warning("Update kept changing while fetching images; waiting for the next update...")
+                    changes = 0
+                    delay = self.device.next_update_delay()
+                elif changes == 1:
+                    logging.info("Update changed while fetching images; retrying...")
+                    delay = UPDATE_CHANGED_DELAY
+                else:
+                    logging.info("Update changed again while fetching images; backing off...")
+                    delay = max(backoff.next_delay(), UPDATE_CHANGED_DELAY)
+            except client.ServiceUnavailable as e:
+                # Rate limited or overloaded; keep showing the current update (and its cache) and try again later.
+                self.device.stats.increment("service_unavailable")
+                logging.warning("Service unavailable ('%s'); retrying later...", e)
+                delay = backoff.next_delay()
+                if e.retry_after is not None:
+                    delay = max(delay, min(e.retry_after, MAXIMUM_UPDATE_INTERVAL))
+            except (payload.InvalidHeader, payload.UnsupportedUpdate, payload.InvalidImage) as e:
+                self.device.stats.increment("invalid_updates")
+                logging.error("Failed to decode update with error '%r'", e)
+                await self.render(self.device.show_error, self.display, "Invalid Update")
+                delay = backoff.next_delay()
+            except requests.exceptions.RequestException as e:
+                # Includes timeouts and connections dropped mid-response, as well as failures to connect.
+                self.device.stats.increment("connection_errors")
+                logging.error("Failed to fetch update with error '%s'", e)
+                await self.render(self.device.show_error, self.display, "Connection Error")
+                delay = backoff.next_delay()
+            logging.info("Sleeping %ds...", delay)
+            try:
+                await asyncio.wait_for(self._poll.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._poll.clear()
 
-# https://stackoverflow.com/questions/17537071/idiomatic-way-to-struct-unpack-from-bytesio
-def unpack(stream, fmt):
-    size = struct.calcsize(fmt)
-    buf = stream.read(size)
-    return struct.unpack(fmt, buf)
+    async def redraw(self):
+        while True:
+            await self._redraw.wait()
+            self._redraw.clear()
+            missing = self.device.missing_image()
+            if missing is not None:
+                try:
+                    image = await self.load_image(*missing)
+                except (client.UpdateChanged,
+                        client.MissingUpdate,
+                        payload.InvalidHeader,
+                        payload.UnsupportedUpdate,
+                        payload.InvalidImage,
+                        requests.exceptions.RequestException) as e:
+                    logging.warning("Failed to fetch image with error '%s'; polling for update...", e)
+                    self._poll.set()
+                    continue
+                except client.ServiceUnavailable as e:
+                    # Waking the poll loop would defeat its backoff; the image is fetched again on the next redraw.
+                    logging.warning("Failed to fetch image with error '%s'; waiting for the next update...", e)
+                    continue
+                self.device.set_image(missing[0], missing[2], image)
+            await self.render(self.device.display_image_if_necessary, self.display)
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            logging.info("Stats: %s", json.dumps(self.device.stats.snapshot(), sort_keys=True))
+
+    async def serve_stats(self, reader, writer):
+        # Each connection receives a single JSON snapshot, e.g., `socat - UNIX-CONNECT:<path>`.
+        writer.write(json.dumps(self.device.stats.snapshot(), sort_keys=True).encode("utf-8") + b"\n")
+        await writer.drain()
+        writer.close()
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._redraw = asyncio.Event()
+        self._poll = asyncio.Event()
+        stop = asyncio.Event()
+        self._loop.add_signal_handler(signal.SIGUSR1, self._redraw.set)
+        self._loop.add_signal_handler(signal.SIGINT, stop.set)
+        await self.restore()
+        server = None
+        if self.stats_socket is not None:
+            if os.path.exists(self.stats_socket):
+                os.remove(self.stats_socket)
+            server = await asyncio.start_unix_server(self.serve_stats, path=self.stats_socket)
+        tasks = [asyncio.create_task(self.report()),
+                 asyncio.create_task(self.poll()),
+                 asyncio.create_task(self.redraw()),
+                 asyncio.create_task(stop.wait())]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                task.result()  # Propagate any failures.
+        finally:
+            if server is not None:
+                server.close()
+            self._decode_executor.shutdown(cancel_futures=True)
+            self._render_executor.shutdown(wait=False)
+
+
+def decode_frame(image, encoding, public_key, secret_key):
+    """
+    Decrypts and decodes a single image from an update, returning a `Frame` and the time (in milliseconds) spent in
+    each stage. This is CPU-bound and self-contained so that it can be run in a separate process.
+    """
+    stopwatch = Stopwatch()
+    try:
+        image = decode_image(image, encoding, public_key, secret_key, stopwatch)
+    except (ValueError, OSError, SyntaxError) as e:
+        # pysodium raises `ValueError` if decryption fails, and PIL any of these for corrupt images.
+        raise payload.InvalidImage("Failed to decode image: %r" % e)
+    if image.mode != "RGB":
+        image = image.convert("RGB")  # Ensures frames can be cached as raw RGB data.
+        stopwatch.lap("convert_rgb")
+    frame = Frame(image=image, digest=hashlib.sha256(image.tobytes()).digest())
+    stopwatch.lap("digest")
+    return frame, stopwatch.timings
+
+
+def decode_image(image, encoding, public_key, secret_key, stopwatch):
+    contents = pysodium.crypto_box_seal_open(image,
+                                             public_key,
+                                             secret_key)
+    stopwatch.lap("decrypt")
+
+    if encoding in (payload.RLE, payload.ZLIB):
+        logging.debug("Decoding 2BPP plane...")
+        pixel_data = payload.decode_plane(contents, encoding, DEVICE_SIZE.width * DEVICE_SIZE.height // 4)
+        stopwatch.lap("decode_rle" if encoding == payload.RLE else "decode_zlib")
+
+        # Convert the 2BPP representation to 8BPP RGB.
+        rgb_data = []
+        for byte in pixel_data:
+            rgb_data.append(PALETTE[(byte >> 0) & 3])
+            rgb_data.append(PALETTE[(byte >> 2) & 3])
+            rgb_data.append(PALETTE[(byte >> 4) & 3])
+            rgb_data.append(PALETTE[(byte >> 6) & 3])
+
+        pil_image = Image.new("RGB",
+                              (DEVICE_SIZE.width, DEVICE_SIZE.height),
+                              (255, 255, 255))
+        pil_image.putdata(rgb_data)
+        stopwatch.lap("convert_palette")
+        return pil_image
+
+    elif encoding == payload.PNG:
+        logging.debug("Decoding PNG...")
+        pil_image = Image.open(io.BytesIO(contents))
+        pil_image.load()
+        stopwatch.lap("decode_png")
+        return pil_image
+
+    else:
+        raise payload.UnsupportedUpdate("Unsupported encoding %d" % encoding)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action="store_true")
+    parser.add_argument('--service-url',
+                        default=os.environ.get("STATUSPANEL_SERVICE_URL", client.DEFAULT_SERVICE_URL),
+                        help="base URL of the StatusPanel service")
+    parser.add_argument('--stats-socket',
+                        default=os.environ.get("STATUSPANEL_STATS_SOCKET"),
+                        help="path of a Unix socket on which to serve timing and counter stats as JSON")
     options = parser.parse_args()
 
     try:
-        device = Device.load(SETTINGS_PATH)
+        device = Device.load(SETTINGS_PATH, service_url=options.service_url, cache_path=CACHE_PATH)
     except Exception as e:
         logging.error(e)
-        device = Device(identifier=DeviceIdentifier.generate())
+        device = Device(identifier=DeviceIdentifier.generate(), service_url=options.service_url, cache_path=CACHE_PATH)
         device.save(SETTINGS_PATH)
 
     logging.info("Pairing URL: %s", device.identifier.pairing_url)
@@ -350,12 +770,13 @@ def main():
                GPIO.IN,
                pull_up_down=GPIO.PUD_UP)
 
+    runtime = Runtime(device, display, stats_socket=options.stats_socket)
+
     def toggle(pin):
-        # Select a different image and then schedule the redraw
-        # by sending SIGUSR1.
+        # Select a different image and then schedule the redraw.
         print("toggle")
         device.toggle()
-        os.kill(os.getpid(), signal.SIGUSR1)
+        runtime.request_redraw()
 
     def shutdown(pin):
         logging.info("Shutting down...")
@@ -370,49 +791,7 @@ def main():
                           shutdown,
                           bouncetime=250)
 
-    tasks = []
-
-    def update():
-        try:
-            logging.info("Fetching update...")
-            device.fetch_update(display)
-            logging.info("Sleeping 30s...")
-            signal.alarm(30)
-        except MissingUpdate:
-            device.show_setup_screen(display)
-            logging.info("Sleeping 10s...")
-            signal.alarm(10)
-        except requests.exceptions.ConnectionError as e:
-            logging.error("Failed to fetch update with error '%s'", e)
-            device.show_error(display, "Connection Error")
-            logging.info("Sleeping 10s...")
-            signal.alarm(10)
-
-    def redraw():
-        device.display_image_if_necessary(display)
-
-    def alarm(sig, frame):
-        tasks.append(update)
-
-    def user(sig, frame):
-        tasks.append(redraw)
-
-    def interrupt(sig, frame):
-        exit()
-
-    signal.signal(signal.SIGALRM, alarm)
-    signal.signal(signal.SIGUSR1, user)
-    signal.signal(signal.SIGINT, interrupt)
-
-    tasks.append(update)
-
-    while True:
-        while True:
-            try:
-                tasks.pop(0)()
-            except IndexError:
-                break
-        signal.pause()
+    asyncio.run(runtime.run())
 
 
 if __name__ == "__main__":
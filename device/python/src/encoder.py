@@ -0,0 +1,156 @@
+"""
+Reference encoder for StatusPanel updates.
+
+Converts PIL images (or NumPy arrays) into the 2BPP panel representation, encodes them (RLE, zlib, or PNG), and seals
+them with the device's public key, producing updates that can be decoded by `device.py`.
+"""
+
+import concurrent.futures
+import io
+import zlib
+
+import numpy
+import pysodium
+
+from PIL import Image
+
+import payload
+
+
+# Panel colours in index order: black, yellow, white.
+PALETTE = [
+    (0, 0, 0),
+    (255, 255, 0),
+    (255, 255, 255),
+]
+
+MAXIMUM_RUN = 255
+
+# PIL palettes always contain 256 entries, so the remainder are padded with copies of black and mapped back to it.
+PALETTE_IMAGE = Image.new("P", (1, 1))
+PALETTE_IMAGE.putpalette([component for colour in PALETTE + [PALETTE[0]] * (256 - len(PALETTE)) for component in colour])
+PALETTE_INDEXES = numpy.array(list(range(len(PALETTE))) + [0] * (256 - len(PALETTE)), dtype=numpy.uint8)
+
+
+def to_indexes(image):
+    """
+    Maps each pixel of an image to the index of the nearest panel colour, returning a 2D uint8 array. Accepts PIL
+    images, RGB arrays (height x width x 3), or arrays that already contain panel colour indexes (height x width).
+    """
+    if not isinstance(image, Image.Image):
+        pixels = numpy.asarray(image)
+        if pixels.ndim == 2:
+            if pixels.max(initial=0) >= len(PALETTE):
+                raise ValueError("Index arrays must only contain values less than %d" % len(PALETTE))
+            return pixels.astype(numpy.uint8)
+        if pixels.ndim != 3 or pixels.shape[2] != 3:
+            raise ValueError("Unsupported image shape %s" % (pixels.shape,))
+        image = Image.fromarray(pixels.astype(numpy.uint8), "RGB")
+    quantized = image.convert("RGB").quantize(palette=PALETTE_IMAGE, dither=Image.Dither.NONE)
+    return PALETTE_INDEXES[numpy.asarray(quantized)]
+
+
+def pack_2bpp(indexes):
+    """
+    Packs panel colour indexes four to a byte; for pixels A, B, C, D the layout is DDCCBBAA.
+    """
+    flat = numpy.asarray(indexes, dtype=numpy.uint8).reshape(-1)
+    if len(flat) % 4:
+        raise ValueError("Pixel count must be a multiple of four")
+    quads = flat.reshape(-1, 4)
+    return (quads[:, 0] | (quads[:, 1] << 2) | (quads[:, 2] << 4) | (quads[:, 3] << 6)).astype(numpy.uint8)
+
+
+def encode_rle(data):
+    """
+    Vectorised equivalent of `payload.encode_rle`, producing byte-for-byte identical output.
+    """
+    data = numpy.frombuffer(bytes(data), dtype=numpy.uint8) if not isinstance(data, numpy.ndarray) else data
+    if len(data) == 0:
+        return b""
+
+    # Find the runs of identical bytes.
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(data)) + 1))
+    lengths = numpy.diff(numpy.concatenate((starts, [len(data)])))
+    values = data[starts]
+
+    # Split runs longer than the maximum run into chunks.
+    counts = (lengths + MAXIMUM_RUN - 1) // MAXIMUM_RUN
+    first = numpy.cumsum(counts) - counts
+    position = numpy.arange(counts.sum()) - numpy.repeat(first, counts)
+    chunk_lengths = numpy.minimum(MAXIMUM_RUN, numpy.repeat(lengths, counts) - MAXIMUM_RUN * position)
+    chunk_values = numpy.repeat(values, counts)
+
+    # Chunks longer than three bytes (or containing the escape value) are written as escape, length, value; the rest
+    # are written as literals.
+    escaped = (chunk_lengths > 3) | (chunk_values == 255)
+    sizes = numpy.where(escaped, 3, chunk_lengths)
+    offsets = numpy.cumsum(sizes) - sizes
+    result = numpy.empty(sizes.sum(), dtype=numpy.uint8)
+
+    escaped_offsets = offsets[escaped]
+    result[escaped_offsets] = 255
+    result[escaped_offsets + 1] = chunk_lengths[escaped]
+    result[escaped_offsets + 2] = chunk_values[escaped]
+
+    literal_lengths = chunk_lengths[~escaped]
+    literal_first = numpy.cumsum(literal_lengths) - literal_lengths
+    literal_position = numpy.arange(literal_lengths.sum()) - numpy.repeat(literal_first, literal_lengths)
+    result[numpy.repeat(offsets[~escaped], literal_lengths) + literal_position] = numpy.repeat(chunk_values[~escaped],
+                                                                                              literal_lengths)
+    return result.tobytes()
+
+
+def encode_image(image, encoding=payload.RLE):
+    """
+    Encodes a single (unencrypted) panel image.
+    """
+    if encoding == payload.RLE:
+        return encode_rle(pack_2bpp(to_indexes(image)))
+    elif encoding == payload.ZLIB:
+        return zlib.compress(pack_2bpp(to_indexes(image)).tobytes(), 9)
+    elif encoding == payload.PNG:
+        if not isinstance(image, Image.Image):
+            image = Image.fromarray(numpy.asarray(image, dtype=numpy.uint8))
+        data = io.BytesIO()
+        image.convert("RGB").save(data, format="PNG")
+        return data.getvalue()
+    raise payload.UnsupportedUpdate("Unsupported encoding %d" % encoding)
+
+
+def encode_update(images, public_key, wakeup_time=0, encoding=payload.RLE):
+    """
+    Encodes and encrypts the images for a device, returning the complete update ready to upload.
+    """
+    sealed = [pysodium.crypto_box_seal(encode_image(image, encoding), public_key) for image in images]
+    return payload.encode(sealed, wakeup_time=wakeup_time, encoding=encoding)
+
+
+def _encode_update(arguments):
+    images, public_key, wakeup_time, encoding = arguments
+    return encode_update(images, public_key, wakeup_time=wakeup_time, encoding=encoding)
+
+
+class Encoder(object):
+    """
+    Encodes many updates in parallel using a pool of processes.
+    """
+
+    def __init__(self, max_workers=None):
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def encode_updates(self, updates, encoding=payload.RLE, chunksize=4):
+        """
+        Encodes `(images, public_key, wakeup_time)` tuples, yielding the updates in order.
+        """
+        arguments = ((images, public_key, wakeup_time, encoding) for images, public_key, wakeup_time in updates)
+        return self.executor.map(_encode_update, arguments, chunksize=chunksize)
@@ -0,0 +1,149 @@
+import struct
+import zlib
+
+from dataclasses import dataclass
+
+
+MARKER = 0xFF00
+HEADER_LENGTH = 8
+
+# Encodings.
+RLE = 0
+PNG = 1
+ZLIB = 2  # zlib (deflate) stream of the 2BPP plane.
+
+# The header mixes big and little endian fields so it's read in two parts.
+HEADER = struct.Struct(">HBHB")  # marker, headerLength, wakeupTime, imageCount
+ENCODING = struct.Struct("<H")
+OFFSET = struct.Struct("<I")
+
+
+class InvalidHeader(Exception):
+    pass
+
+
+class UnsupportedUpdate(Exception):
+    pass
+
+
+class InvalidImage(Exception):
+    pass
+
+
+@dataclass
+class Header:
+    wakeup_time: int  # Minutes after local midnight.
+    encoding: int
+    offsets: list
+
+    def image(self, data, index):
+        """
+        Returns a memoryview of the (still encrypted) image at `index` in the complete update data, without copying it.
+        """
+        start = self.offsets[index]
+        end = self.offsets[index + 1] if index + 1 < len(self.offsets) else len(data)
+        if max(start, end) > len(data):
+            raise InvalidHeader("Image %d exceeds update length %d" % (index, len(data)))
+        return memoryview(data)[start:end]
+
+
+def parse_header(data):
+    """
+    Parses and validates the header and image index at the start of an update. `data` can be the complete update or just
+    its prefix, as long as it includes the whole index.
+    """
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise InvalidHeader("Update too short (%d bytes)" % len(view))
+    marker, header_length, wakeup_time, image_count = HEADER.unpack_from(view)
+    if marker != MARKER:
+        raise InvalidHeader("Unexpected marker 0x%04X" % marker)
+
+    # Ensure the header 'version' is high enough for the assumptions in our implementation.
+    if header_length < HEADER_LENGTH:
+        raise UnsupportedUpdate("Unsupported header length %d" % header_length)
+    encoding = ENCODING.unpack_from(view, HEADER.size)[0]
+
+    # The index follows the header; the images must start after it and be stored in order.
+    index_end = header_length + OFFSET.size * image_count
+    if len(view) < index_end:
+        raise InvalidHeader("Update too short (%d bytes) for %d images" % (len(view), image_count))
+    offsets = [offset for (offset,) in OFFSET.iter_unpack(view[header_length:index_end])]
+    previous = index_end
+    for index, offset in enumerate(offsets):
+        if offset < previous:
+            raise InvalidHeader("Image %d has invalid offset %d (expected at least %d)" % (index, offset, previous))
+        previous = offset
+
+    return Header(wakeup_time=wakeup_time, encoding=encoding, offsets=offsets)
+
+
+def encode(images, wakeup_time=0, encoding=RLE):
+    """
+    Assembles an update from the (already encrypted) images; the inverse of `parse_header` and `Header.image`.
+    """
+    header = bytearray(HEADER_LENGTH)
+    HEADER.pack_into(header, 0, MARKER, HEADER_LENGTH, wakeup_time, len(images))
+    ENCODING.pack_into(header, HEADER.size, encoding)
+    offset = HEADER_LENGTH + OFFSET.size * len(images)
+    index = bytearray()
+    for image in images:
+        index += OFFSET.pack(offset)
+        offset += len(image)
+    return bytes(header + index) + b"".join(images)
+
+
+def decode_plane(data, encoding, length):
+    """
+    Decodes the 2BPP plane of an RLE or zlib encoded image, returning at most `length` bytes.
+    """
+    if encoding == RLE:
+        return decode_rle(data, length)
+    elif encoding == ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            return decompressor.decompress(data, length)
+        except zlib.error as e:
+            raise InvalidHeader("Invalid zlib stream: %s" % e)
+    raise UnsupportedUpdate("Unsupported encoding %d" % encoding)
+
+
+def decode_rle(data, length):
+    """
+    Expands RLE data into at most `length` bytes. Runs are encoded as 255 followed by the count and the value.
+    """
+    view = memoryview(data)
+    result = bytearray()
+    i = 0
+    while len(result) < length and i < len(view):
+        value = view[i]
+        if value == 255:
+            if i + 2 >= len(view):
+                break  # Truncated run.
+            result += bytes((view[i + 2],)) * view[i + 1]
+            i += 3
+        else:
+            result.append(value)
+            i += 1
+    return result[:length]
+
+
+def encode_rle(data):
+    """
+    RLE-encodes data in the same way as the iOS app.
+    """
+    result = bytearray()
+    i = 0
+    while i < len(data):
+        current = data[i]
+        j = i + 1
+        while j < len(data) and data[j] == current and j - i < 255:
+            j += 1
+        count = j - i
+        # For a length below 3, the encoding is longer so don't bother.
+        if count > 3 or current == 255:
+            result += bytes((255, count, current))
+        else:
+            result += bytes((current,)) * count
+        i = j
+    return bytes(result)
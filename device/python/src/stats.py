@@ -0,0 +1,67 @@
+import collections
+import contextlib
+import threading
+import time
+
+
+class Stats(object):
+    """
+    Thread-safe counters and stage timers, reported as a JSON-serializable snapshot.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()  # Synchronized on _lock
+        self._timers = {}  # Synchronized on _lock
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def record(self, name, milliseconds):
+        with self._lock:
+            count, total, maximum = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = (count + 1, total + milliseconds, max(maximum, milliseconds))
+
+    def record_all(self, timings):
+        for name, milliseconds in timings.items():
+            self.record(name, milliseconds)
+
+    @contextlib.contextmanager
+    def time(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, (self.clock() - start) * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime": int(time.time() - self.started),
+                "counters": dict(self._counters),
+                "timers": {name: {"count": count,
+                                  "total_ms": round(total, 3),
+                                  "mean_ms": round(total / count, 3),
+                                  "max_ms": round(maximum, 3)}
+                           for name, (count, total, maximum) in self._timers.items()},
+            }
+
+
+class Stopwatch(object):
+    """
+    Collects the duration of successive stages in a single task; used where timings need to be returned from a
+    separate process rather than recorded directly.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.timings = {}
+        self._start = clock()
+
+    def lap(self, name):
+        now = self.clock()
+        self.timings[name] = self.timings.get(name, 0.0) + (now - self._start) * 1000
+        self._start = now
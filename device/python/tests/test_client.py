@@ -0,0 +1,283 @@
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+
+import requests
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), "src")
+
+sys.path.append(SRC_DIR)
+
+import client
+
+
+class Identifier(object):
+
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+
+
+class StubService(object):
+    """
+    Minimal stand-in for the StatusPanel service which serves a single update (and, optionally, its individual images)
+    and counts the requests it receives.
+    """
+
+    def __init__(self):
+        self.data = None
+        self.images = []
+        self.error = None  # Status code and headers to respond with, if set.
+        self.delay = 0  # Seconds to wait before responding.
+        self.last_modified = None  # Last-Modified header to send for every version, if set.
+        self.version = 0
+        self.requests = []
+        service = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                service.requests.append((self.command, self.path))
+                time.sleep(service.delay)
+                if service.error is not None:
+                    status_code, headers = service.error
+                    self.send_response(status_code)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.end_headers()
+                    return
+                if service.data is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                last_modified = service.last_modified or 'Mon, 01 Jan 2024 00:00:%02d GMT' % service.version
+                etag = '"%d"' % service.version
+                _, image, index = self.path.rpartition("/image/")
+                if image:
+                    if int(index) >= len(service.images):
+                        self.send_response(404)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header('Last-Modified', last_modified)
+                    self.send_header('X-Status-ETag', etag)
+                    self.send_header('Content-Length', str(len(service.images[int(index)])))
+                    self.end_headers()
+                    self.wfile.write(service.images[int(index)])
+                    return
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Cache-Control', 'max-age=60')
+                    self.end_headers()
+                    return
+                data = service.data
+                byte_range = self.headers.get('Range')
+                if byte_range is not None:
+                    end = min(int(byte_range.rpartition("-")[2]) + 1, len(service.data))
+                    data = service.data[:end]
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes 0-%d/%d' % (end - 1, len(service.data)))
+                else:
+                    self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('Cache-Control', 'max-age=60')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_HEAD = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def publish(self, data, images=()):
+        self.data = data
+        self.images = images
+        self.version += 1
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestService(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubService()
+        self.service = client.Service(Identifier(), base_url=self.stub.url)
+
+    def tearDown(self):
+        self.stub.close()
+
+    def test_missing_update(self):
+        with self.assertRaises(client.MissingUpdate):
+            self.service.get_status_data()
+
+    def test_single_request_per_poll(self):
+        self.stub.publish(b"one")
+        update = self.service.get_status_data()
+        self.assertEqual(update.data, b"one")
+        self.assertEqual(update.max_age, 60)
+        self.assertEqual(len(self.stub.requests), 1)
+
+        unchanged = self.service.get_status_data(etag=update.etag, last_modified=update.last_modified)
+        self.assertFalse(unchanged.modified, "Unchanged updates are not downloaded")
+        self.assertEqual(unchanged.etag, update.etag)
+        self.assertEqual(len(self.stub.requests), 2, "Unchanged polls cost a single request")
+
+        self.stub.publish(b"two")
+        changed = self.service.get_status_data(etag=update.etag, last_modified=update.last_modified)
+        self.assertEqual(changed.data, b"two")
+        self.assertEqual(len(self.stub.requests), 3, "Changed polls cost a single request")
+        self.assertEqual({method for method, _ in self.stub.requests}, {"GET"})
+
+    def test_index_only(self):
+        self.stub.publish(b"header" + b"\0" * 2000)
+        update = self.service.get_status_data(index_only=True)
+        self.assertFalse(update.complete)
+        self.assertEqual(len(update.data), 1275)
+
+        self.stub.publish(b"short")
+        update = self.service.get_status_data(index_only=True)
+        self.assertTrue(update.complete, "Short updates are fetched in full")
+        self.assertEqual(update.data, b"short")
+
+    def test_get_image(self):
+        self.stub.publish(b"header", images=[b"one", b"two"])
+        update = self.service.get_status_data(index_only=True)
+        self.assertEqual(self.service.get_image(1, update.etag), b"two")
+        with self.assertRaises(client.MissingUpdate):
+            self.service.get_image(2, update.etag)
+
+        self.stub.publish(b"header", images=[b"three"])
+        with self.assertRaises(client.UpdateChanged):
+            self.service.get_image(0, update.etag)
+
+    def test_get_image_detects_changes_within_a_second(self):
+        self.stub.last_modified = 'Mon, 01 Jan 2024 00:00:00 GMT'
+        self.stub.publish(b"header", images=[b"one"])
+        update = self.service.get_status_data(index_only=True)
+        self.stub.publish(b"header", images=[b"two"])
+        with self.assertRaises(client.UpdateChanged):
+            self.service.get_image(0, update.etag)
+
+    def test_transient_errors(self):
+        self.stub.publish(b"header", images=[b"one"])
+        for status_code in (429, 500, 503):
+            self.stub.error = (status_code, {"Retry-After": "120"})
+            with self.assertRaises(client.ServiceUnavailable) as context:
+                self.service.get_status_data()
+            self.assertEqual(context.exception.status_code, status_code)
+            self.assertEqual(context.exception.retry_after, 120)
+            with self.assertRaises(client.ServiceUnavailable):
+                self.service.get_image(0, None)
+
+    def test_timeout(self):
+        self.stub.publish(b"one")
+        self.stub.delay = 1
+        service = client.Service(Identifier(), base_url=self.stub.url, timeout=0.1)
+        with self.assertRaises(requests.exceptions.Timeout):
+            service.get_status_data()
+
+    def test_retry_after(self):
+        self.assertIsNone(client.get_retry_after({}))
+        self.assertIsNone(client.get_retry_after({"retry-after": "soon"}))
+        self.assertEqual(client.get_retry_after({"retry-after": "30"}), 30)
+        self.assertEqual(client.get_retry_after({"retry-after": "Mon, 01 Jan 2001 00:00:00 GMT"}), 0)
+
+
+class TestUpdateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_empty(self):
+        self.assertIsNone(client.UpdateCache(self.path).load())
+
+    def test_validators_survive_restart(self):
+        stub = StubService()
+        try:
+            stub.publish(b"contents")
+            service = client.Service(Identifier(), base_url=stub.url)
+            client.UpdateCache(self.path).save(service.get_status_data())
+
+            cached_update = client.UpdateCache(self.path).load()
+            self.assertEqual(cached_update.data, b"contents")
+            update = service.get_status_data(etag=cached_update.etag, last_modified=cached_update.last_modified)
+            self.assertFalse(update.modified, "Cached validators can be used after a restart")
+            self.assertEqual(len(stub.requests), 2)
+        finally:
+            stub.close()
+
+    def test_clear(self):
+        cache = client.UpdateCache(self.path)
+        cache.save(client.UpdateData(data=b"contents", last_modified=None, etag='"1"', max_age=None))
+        cache.clear()
+        self.assertIsNone(cache.load())
+
+    def test_images_cleared_with_update(self):
+        cache = client.UpdateCache(self.path)
+        cache.save(client.UpdateData(data=b"header", last_modified=None, etag='"1"', max_age=None, complete=False))
+        cache.save_image(1, '"1"', b"image")
+        self.assertEqual(cache.load_image(1, '"1"'), b"image")
+        self.assertFalse(cache.load().complete)
+
+        cache.save(client.UpdateData(data=b"header", last_modified=None, etag='"2"', max_age=None, complete=False))
+        self.assertIsNone(cache.load_image(1, '"1"'), "Images from previous updates are discarded")
+
+    def test_images_keyed_by_update(self):
+        cache = client.UpdateCache(self.path)
+        cache.save(client.UpdateData(data=b"header", last_modified=None, etag='"2"', max_age=None, complete=False))
+        # An image from the previous update, saved after the new update.
+        cache.save_image(1, '"1"', b"old")
+        self.assertIsNone(cache.load_image(1, '"2"'))
+        cache.save_image(1, '"2"', b"new")
+        self.assertEqual(cache.load_image(1, '"2"'), b"new")
+        self.assertEqual(cache.load_image(1, '"1"'), b"old")
+
+    def test_frames(self):
+        cache = client.UpdateCache(self.path)
+        cache.save(client.UpdateData(data=b"header", last_modified=None, etag='"1"', max_age=None))
+        cache.save_frame(0, b"pixels", {"etag": '"1"', "size": [2, 1]})
+        buffer, description = cache.load_frame(0, '"1"')
+        with buffer:
+            self.assertEqual(buffer[:], b"pixels")
+        self.assertEqual(description["size"], [2, 1])
+        self.assertIsNone(cache.load_frame(0, '"2"'), "Frames are only returned for the matching update")
+
+        cache.save(client.UpdateData(data=b"header", last_modified=None, etag='"2"', max_age=None))
+        self.assertIsNone(cache.load_frame(0, '"1"'), "Frames from previous updates are discarded")
+
+    def test_setup_screen(self):
+        cache = client.UpdateCache(self.path)
+        cache.save_setup_screen(b"pixels", {"pairing_url": "statuspanel:r2?id=1"})
+        self.assertIsNone(cache.load_setup_screen("statuspanel:r2?id=2"))
+        buffer, _ = cache.load_setup_screen("statuspanel:r2?id=1")
+        with buffer:
+            self.assertEqual(buffer[:], b"pixels")
+        cache.clear()
+        self.assertIsNotNone(cache.load_setup_screen("statuspanel:r2?id=1"), "The setup screen outlives updates")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import random
+import sys
+import unittest
+
+import numpy
+import pysodium
+
+from PIL import Image
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), "src")
+
+sys.path.append(SRC_DIR)
+
+import encoder
+import payload
+
+
+def random_plane(seed, length=64000):
+    r = random.Random(seed)
+    data = bytearray()
+    while len(data) < length:
+        data += bytes([r.choice([0x00, 0x55, 0xAA, 0xFF, 0x12])]) * r.choice([1, 2, 3, 4, 255, 256, 600])
+    return bytes(data[:length])
+
+
+class TestEncoder(unittest.TestCase):
+
+    def test_rle_matches_reference(self):
+        for data in [b"", b"\x01", b"\xff", b"\x01\x01\x01", b"\x01\x01\x01\x01", b"\xff" * 600, b"\x02" * 256]:
+            self.assertEqual(encoder.encode_rle(data), payload.encode_rle(data), data)
+        for seed in range(5):
+            data = random_plane(seed)
+            self.assertEqual(encoder.encode_rle(data), payload.encode_rle(data))
+
+    def test_pack_2bpp(self):
+        self.assertEqual(encoder.pack_2bpp([0, 1, 2, 1]).tobytes(), bytes([0b01100100]))
+
+    def test_to_indexes(self):
+        image = Image.new("RGB", (4, 1), (255, 255, 255))
+        image.putpixel((1, 0), (250, 250, 10))
+        image.putpixel((2, 0), (5, 5, 5))
+        self.assertEqual(encoder.to_indexes(image).tolist(), [[2, 1, 0, 2]])
+
+    def test_round_trip(self):
+        public_key, secret_key = pysodium.crypto_box_keypair()
+        indexes = numpy.random.default_rng(0).integers(0, 3, size=(400, 640), dtype=numpy.uint8)
+        data = encoder.encode_update([indexes, numpy.zeros((400, 640), dtype=numpy.uint8)],
+                                     public_key,
+                                     wakeup_time=60)
+        header = payload.parse_header(data)
+        self.assertEqual(header.wakeup_time, 60)
+        self.assertEqual(len(header.offsets), 2)
+        contents = pysodium.crypto_box_seal_open(bytes(header.image(data, 0)), public_key, secret_key)
+        self.assertEqual(payload.decode_rle(contents, 64000), encoder.pack_2bpp(indexes).tobytes())
+
+    def test_zlib_round_trip(self):
+        public_key, secret_key = pysodium.crypto_box_keypair()
+        indexes = numpy.random.default_rng(0).integers(0, 3, size=(400, 640), dtype=numpy.uint8)
+        data = encoder.encode_update([indexes], public_key, encoding=payload.ZLIB)
+        header = payload.parse_header(data)
+        self.assertEqual(header.encoding, payload.ZLIB)
+        contents = pysodium.crypto_box_seal_open(bytes(header.image(data, 0)), public_key, secret_key)
+        self.assertEqual(payload.decode_plane(contents, payload.ZLIB, 64000), encoder.pack_2bpp(indexes).tobytes())
+
+    def test_parallel(self):
+        public_key, _ = pysodium.crypto_box_keypair()
+        images = [numpy.full((400, 640), index % 3, dtype=numpy.uint8) for index in range(4)]
+        with encoder.Encoder(max_workers=2) as pool:
+            updates = list(pool.encode_updates(([image], public_key, 0) for image in images))
+        self.assertEqual(len(updates), 4)
+        self.assertEqual([len(payload.parse_header(update).offsets) for update in updates], [1, 1, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
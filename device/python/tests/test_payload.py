@@ -0,0 +1,107 @@
+import os
+import random
+import sys
+import unittest
+import zlib
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), "src")
+
+sys.path.append(SRC_DIR)
+
+import payload
+
+
+class TestPayload(unittest.TestCase):
+
+    def test_round_trip(self):
+        images = [b"first", b"", b"third image"]
+        data = payload.encode(images, wakeup_time=6 * 60 + 20, encoding=payload.PNG)
+        header = payload.parse_header(data)
+        self.assertEqual(header.wakeup_time, 6 * 60 + 20)
+        self.assertEqual(header.encoding, payload.PNG)
+        self.assertEqual([bytes(header.image(data, index)) for index in range(len(images))], images)
+
+    def test_image_is_not_copied(self):
+        data = payload.encode([b"first", b"second"])
+        image = payload.parse_header(data).image(data, 1)
+        self.assertIsInstance(image, memoryview)
+        self.assertIs(image.obj, data)
+
+    def test_parse_prefix(self):
+        data = payload.encode([b"first", b"second"])
+        header = payload.parse_header(data[:payload.HEADER_LENGTH + 8])
+        self.assertEqual(header.offsets, [16, 21])
+
+    def test_invalid_marker(self):
+        data = bytearray(payload.encode([b"image"]))
+        data[0] = 0
+        with self.assertRaises(payload.InvalidHeader):
+            payload.parse_header(data)
+
+    def test_unsupported_header_length(self):
+        data = bytearray(payload.encode([b"image"]))
+        data[2] = 5
+        with self.assertRaises(payload.UnsupportedUpdate):
+            payload.parse_header(data)
+
+    def test_truncated_index(self):
+        data = payload.encode([b"first", b"second"])
+        with self.assertRaises(payload.InvalidHeader):
+            payload.parse_header(data[:payload.HEADER_LENGTH + 4])
+
+    def test_out_of_order_offsets(self):
+        data = bytearray(payload.encode([b"first", b"second"]))
+        payload.OFFSET.pack_into(data, payload.HEADER_LENGTH + 4, 4)
+        with self.assertRaises(payload.InvalidHeader):
+            payload.parse_header(data)
+
+    def test_image_beyond_end(self):
+        data = payload.encode([b"first", b"second"])
+        header = payload.parse_header(data)
+        with self.assertRaises(payload.InvalidHeader):
+            header.image(data[:18], 0)
+
+
+class TestRLE(unittest.TestCase):
+
+    def test_round_trip(self):
+        r = random.Random(0)
+        data = bytearray()
+        while len(data) < 64000:
+            data += bytes([r.choice([0x00, 0x55, 0xAA, 0xFF, 0x12])]) * r.randint(1, 600)
+        data = bytes(data[:64000])
+        self.assertEqual(payload.decode_rle(payload.encode_rle(data), len(data)), data)
+
+    def test_escape(self):
+        self.assertEqual(payload.encode_rle(b"\xff"), b"\xff\x01\xff")
+        self.assertEqual(payload.decode_rle(b"\xff\x01\xff", 1), b"\xff")
+
+    def test_short_runs(self):
+        self.assertEqual(payload.encode_rle(b"\x01\x01\x01"), b"\x01\x01\x01")
+        self.assertEqual(payload.encode_rle(b"\x01\x01\x01\x01"), b"\xff\x04\x01")
+
+    def test_truncated(self):
+        self.assertEqual(payload.decode_rle(b"\x01\x02\xff\x04\x03", 4), b"\x01\x02\x03\x03")
+        self.assertEqual(payload.decode_rle(b"\x01\xff", 4), b"\x01")
+
+
+class TestPlane(unittest.TestCase):
+
+    def test_zlib(self):
+        data = bytes(range(256)) * 250
+        self.assertEqual(payload.decode_plane(zlib.compress(data), payload.ZLIB, len(data)), data)
+        self.assertEqual(payload.decode_plane(zlib.compress(data), payload.ZLIB, 10), data[:10])
+
+    def test_invalid_zlib(self):
+        with self.assertRaises(payload.InvalidHeader):
+            payload.decode_plane(b"not zlib", payload.ZLIB, 100)
+
+    def test_unsupported(self):
+        with self.assertRaises(payload.UnsupportedUpdate):
+            payload.decode_plane(b"", payload.PNG, 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
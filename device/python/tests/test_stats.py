@@ -0,0 +1,52 @@
+import os
+import sys
+import unittest
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), "src")
+
+sys.path.append(SRC_DIR)
+
+import stats
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestStats(unittest.TestCase):
+
+    def test_counters(self):
+        s = stats.Stats()
+        s.increment("requests")
+        s.increment("bytes_downloaded", 100)
+        s.increment("bytes_downloaded", 20)
+        self.assertEqual(s.snapshot()["counters"], {"requests": 1, "bytes_downloaded": 120})
+
+    def test_timers(self):
+        clock = Clock()
+        s = stats.Stats(clock=clock)
+        with s.time("refresh"):
+            clock.now += 2
+        s.record("refresh", 1000)
+        self.assertEqual(s.snapshot()["timers"]["refresh"],
+                         {"count": 2, "total_ms": 3000, "mean_ms": 1500, "max_ms": 2000})
+
+    def test_stopwatch(self):
+        clock = Clock()
+        stopwatch = stats.Stopwatch(clock=clock)
+        clock.now += 0.5
+        stopwatch.lap("decrypt")
+        clock.now += 0.25
+        stopwatch.lap("decode_rle")
+        self.assertEqual(stopwatch.timings, {"decrypt": 500, "decode_rle": 250})
+
+
+if __name__ == "__main__":
+    unittest.main()
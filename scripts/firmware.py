@@ -21,12 +21,19 @@
 # SOFTWARE.
 
 import argparse
+import collections
+import concurrent.futures
+import datetime
 import glob
+import hashlib
+import json
 import logging
 import os
+import re
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import zipfile
 
@@ -41,10 +48,33 @@ ROOT_DIRECTORY = os.path.dirname(SCRIPT_DIRECTORY)
 NODEMCU_DIRECTORY = os.path.join(ROOT_DIRECTORY, "nodemcu")
 ESP32_DIRECTORY = os.path.join(NODEMCU_DIRECTORY, "esp32")
 
-ESPTOOL_PATH = os.path.join(ROOT_DIRECTORY, "esptool", "esptool.py")
+ESPTOOL_PATH = os.environ.get("STATUSPANEL_ESPTOOL", os.path.join(ROOT_DIRECTORY, "esptool", "esptool.py"))
 NODEMCU_UPLOADER_PATH = os.path.join(ROOT_DIRECTORY, "nodemcu-uploader", "nodemcu-uploader.py")
 
 
+# Flash offsets and the firmware files written to them.
+FLASH_REGIONS = [
+    ("0x1000", "bootloader.bin"),
+    ("0x10000", "NodeMCU.bin"),
+    ("0x8000", "partition-table.bin"),
+    ("0x190000", "lfs.img"),
+]
+
+# esptool output worth showing for each device when flashing several at once; everything else is logged at debug level.
+FLASH_PROGRESS_PREFIXES = ("Connecting", "Chip is", "Wrote", "Hash of data verified", "Hard resetting", "-- verify")
+
+# Records the images last flashed to each device (by MAC address) when flashing differentially.
+FLASH_MANIFEST_PATH = os.path.join(os.path.expanduser("~"), ".statuspanel", "flash-manifest.json")
+
+MAC_ADDRESS_REGEX = re.compile(r"^MAC: ([0-9a-f:]+)", re.IGNORECASE)
+VERIFY_RESULT_REGEX = re.compile(r"^-- verify (OK|FAILED)")
+
+
+FlashResult = collections.namedtuple("FlashResult", ["device", "returncode", "duration", "output", "bytes_written",
+                                                     "bytes_skipped", "time_saved"],
+                                     defaults=[0, 0, 0.0])
+
+
 verbose = '--verbose' in sys.argv[1:] or '-v' in sys.argv[1:]
 logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, format="[%(levelname)s] %(message)s")
 
@@ -87,6 +117,225 @@ def run(command):
     return subprocess.run(command)
 
 
+def get_esptool_command(esptool, device):
+    return [esptool,
+            "--chip", "esp32",
+            "--port", device,
+            "--baud", "921600",
+            "--before", "default_reset",
+            "--after", "hard_reset"]
+
+
+def get_region_arguments(path, regions):
+    arguments = []
+    for offset, filename in regions:
+        arguments.extend([offset, os.path.join(path, filename)])
+    return arguments
+
+
+def get_flash_command(esptool, device, path, regions=FLASH_REGIONS):
+    return get_esptool_command(esptool, device) + [
+        "write_flash",
+        "-z",
+        "--flash_mode", "dio",
+        "--flash_freq", "40m",
+        "--flash_size", "detect"] + get_region_arguments(path, regions)
+
+
+def get_verify_command(esptool, device, path, regions=FLASH_REGIONS):
+    # The flash parameters must match those used when writing, since esptool patches them into the bootloader header.
+    return get_esptool_command(esptool, device) + [
+        "verify_flash",
+        "--flash_mode", "dio",
+        "--flash_freq", "40m",
+        "--flash_size", "detect"] + get_region_arguments(path, regions)
+
+
+def run_esptool(command, device):
+    """
+    Runs esptool, logging its output prefixed with the device, and returning the exit code (None if it couldn't be run)
+    and the output lines.
+    """
+    output = []
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except OSError as e:
+        return None, [str(e)]
+    for line in process.stdout:
+        line = line.strip()
+        if not line:
+            continue
+        output.append(line)
+        level = logging.INFO if line.startswith(FLASH_PROGRESS_PREFIXES) else logging.DEBUG
+        logging.log(level, "[%s] %s", device, line)
+    return process.wait(), output
+
+
+def get_md5(path):
+    with open(path, "rb") as fh:
+        return hashlib.md5(fh.read()).hexdigest()
+
+
+class FlashManifest(object):
+    """
+    Thread-safe record of the images last flashed to each device, stored as JSON at `path`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as fh:
+                self._devices = json.load(fh)
+        except FileNotFoundError:
+            self._devices = {}
+
+    def get(self, key):
+        with self._lock:
+            return self._devices.get(key, {})
+
+    def update(self, key, regions, full_write_duration=None):
+        with self._lock:
+            entry = self._devices.setdefault(key, {"regions": {}})
+            entry["regions"].update(regions)
+            entry["flashed"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            if full_write_duration is not None:
+                entry["fullWriteDuration"] = full_write_duration
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w") as fh:
+                json.dump(self._devices, fh, indent=2, sort_keys=True)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def get_failed_regions(output, regions=FLASH_REGIONS):
+    """
+    Returns the regions that failed verification, given the output of `get_verify_command` for `regions`, or None if
+    the output doesn't contain a result for every region (e.g., if esptool couldn't connect to the device).
+    """
+    results = [match.group(1) for match in (VERIFY_RESULT_REGEX.match(line) for line in output) if match]
+    if len(results) != len(regions):
+        return None
+    return [region for region, result in zip(regions, results) if result == "FAILED"]
+
+
+def flash_device(esptool, device, path, manifest=None):
+    """
+    Flashes a single device, logging its progress (prefixed with the device) and returning a `FlashResult` containing
+    the last few lines of output.
+
+    If `manifest` is given, the device's flash is first checked against the local images (using esptool's on-chip MD5
+    support) and only the regions that differ are written; the images are then recorded in the manifest, along with
+    how long writing every region took, which is used to estimate the time saved.
+    """
+    start = time.monotonic()
+    regions = FLASH_REGIONS
+    sizes = {filename: os.path.getsize(os.path.join(path, filename)) for _, filename in FLASH_REGIONS}
+    key = device
+    previous = {}
+
+    if manifest is not None:
+        returncode, output = run_esptool(get_verify_command(esptool, device, path), device)
+        for line in output:
+            match = MAC_ADDRESS_REGEX.match(line)
+            if match:
+                key = match.group(1).lower()
+        failed_regions = get_failed_regions(output)
+        if failed_regions is not None:
+            regions = failed_regions
+        elif returncode is None:
+            return FlashResult(device, None, time.monotonic() - start, output[-5:])
+        else:
+            logging.warning("[%s] Unable to verify the flash; writing every region.", device)
+        previous = manifest.get(key)
+        for offset, filename in FLASH_REGIONS:
+            recorded = previous.get("regions", {}).get(offset)
+            if recorded is not None and recorded["md5"] != get_md5(os.path.join(path, filename)):
+                logging.info("[%s] %s has changed since it was last flashed.", device, filename)
+        logging.info("[%s] Writing %s.", device, ", ".join(filename for _, filename in regions) or "nothing")
+
+    returncode, output, write_duration = 0, [], 0.0
+    if regions:
+        write_start = time.monotonic()
+        returncode, output = run_esptool(get_flash_command(esptool, device, path, regions), device)
+        write_duration = time.monotonic() - write_start
+
+    if returncode != 0:
+        return FlashResult(device, returncode, time.monotonic() - start, output[-5:])
+
+    bytes_written = sum(sizes[filename] for _, filename in regions)
+    bytes_skipped = sum(sizes.values()) - bytes_written
+    time_saved = 0.0
+    if manifest is not None:
+        # Estimate the time saved from the last time every region was written to this device, net of the time spent
+        # verifying.
+        full_write_duration = write_duration if regions == FLASH_REGIONS else previous.get("fullWriteDuration")
+        if full_write_duration is not None:
+            time_saved = full_write_duration - (time.monotonic() - start)
+        manifest.update(key,
+                        {offset: {"file": filename,
+                                  "md5": get_md5(os.path.join(path, filename)),
+                                  "size": sizes[filename]}
+                         for offset, filename in FLASH_REGIONS},
+                        full_write_duration=write_duration if regions == FLASH_REGIONS else None)
+    return FlashResult(device, returncode, time.monotonic() - start, output[-5:], bytes_written, bytes_skipped,
+                       time_saved)
+
+
+def expand_devices(patterns):
+    """
+    Expands glob patterns (e.g., '/dev/cu.usbserial-*') into a de-duplicated list of devices, in order.
+    """
+    devices = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            logging.warning("No devices match '%s'.", pattern)
+        for device in matches:
+            if device not in devices:
+                devices.append(device)
+    return devices
+
+
+def flash_devices(esptool, devices, path, jobs, manifest=None):
+    """
+    Flashes several devices concurrently, using at most `jobs` at a time, and logs a summary. Returns True if every
+    device was flashed successfully.
+    """
+    start = time.monotonic()
+    logging.info("Flashing %d devices (%d at a time)...", len(devices), jobs)
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(flash_device, esptool, device, path, manifest) for device in devices]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if result.returncode == 0:
+                logging.info("[%s] Done in %.1fs.", result.device, result.duration)
+            else:
+                logging.error("[%s] Failed in %.1fs.", result.device, result.duration)
+            results.append(result)
+    duration = time.monotonic() - start
+
+    logging.info("Results:")
+    for result in sorted(results, key=lambda result: devices.index(result.device)):
+        if result.returncode == 0:
+            logging.info("  %s: OK (%.1fs)", result.device, result.duration)
+        else:
+            logging.error("  %s: FAILED with exit code %s (%.1fs): %s",
+                          result.device, result.returncode, result.duration,
+                          result.output[-1] if result.output else "no output")
+    succeeded = len([result for result in results if result.returncode == 0])
+    logging.info("Flashed %d of %d devices in %.1fs (%.1fs if flashed one at a time).",
+                 succeeded, len(results), duration, sum(result.duration for result in results))
+    if manifest is not None:
+        flashed = [result for result in results if result.returncode == 0]
+        bytes_skipped = sum(result.bytes_skipped for result in flashed)
+        bytes_total = bytes_skipped + sum(result.bytes_written for result in flashed)
+        logging.info("Skipped writing %d of %d bytes (%.0f%%); estimated device time saved, net of verification: %.1fs.",
+                     bytes_skipped, bytes_total, 100 * bytes_skipped / bytes_total if bytes_total else 0,
+                     sum(result.time_saved for result in flashed))
+    return succeeded == len(results)
+
+
 def check_access(device):
     if os.access(device, os.R_OK | os.W_OK):
         return
@@ -137,38 +386,48 @@ def command_erase(options):
 
 @cli.command("flash", help="flash device firmware", arguments=[
     DeviceArgument(),
+    cli.Argument("--devices", action="append", metavar="DEVICE",
+                 help="flash several USB serial devices (or glob patterns, e.g., '/dev/cu.usbserial-*') concurrently; "
+                      "may be repeated, but not combined with --device"),
+    cli.Argument("--jobs", "-j", type=int, default=8, help="number of devices to flash at once (default 8)"),
+    cli.Argument("--differential", "-d", action="store_true",
+                 help="only write regions that differ from the local images (checked using their MD5 on the device)"),
+    cli.Argument("--manifest", default=FLASH_MANIFEST_PATH,
+                 help="where to record the images flashed to each device with --differential (default %(default)s)"),
+    cli.Argument("--esptool", default=ESPTOOL_PATH, help="path to esptool (defaults to $STATUSPANEL_ESPTOOL, or the "
+                                                          "esptool submodule)"),
     cli.Argument("path", help="firmware to use to flash the device (may be a directory or zip file)"),
 ])
 def command_flash(options):
-    device = get_device(options)
+    if options.devices and options.device:
+        logging.error("--device and --devices can't be used together.")
+        exit(1)
+    if options.devices:
+        devices = expand_devices(options.devices)
+        if not devices:
+            logging.error("No devices to flash.")
+            exit(1)
+        for device in devices:
+            check_access(device)
+    else:
+        devices = [get_device(options)]
 
     path = os.path.abspath(options.path)
     firmware = Directory(path)
     if not os.path.isdir(path):
         firmware = Zip(path)
 
+    # Zips are only extracted once, and shared by every device.
     with firmware as path:
 
-        logging.info("Flashing firmware...")
-        run([ESPTOOL_PATH,
-             "--chip", "esp32",
-             "--port", device,
-             "--baud", "921600",
-             "--before", "default_reset",
-             "--after", "hard_reset",
-             "write_flash",
-             "-z",
-             "--flash_mode", "dio",
-             "--flash_freq", "40m",
-             "--flash_size", "detect",
-             "0x1000",
-             os.path.join(path, "bootloader.bin"),
-             "0x10000",
-             os.path.join(path, "NodeMCU.bin"),
-             "0x8000",
-             os.path.join(path, "partition-table.bin"),
-             "0x190000",
-             os.path.join(path, "lfs.img")])
+        if not options.devices and not options.differential:
+            logging.info("Flashing firmware...")
+            run(get_flash_command(options.esptool, devices[0], path))
+            return
+
+        manifest = FlashManifest(options.manifest) if options.differential else None
+        if not flash_devices(options.esptool, devices, path, max(options.jobs, 1), manifest=manifest):
+            exit(1)
 
 
 @cli.command("console", help="connect to the device console using minicom", arguments=[
@@ -0,0 +1,139 @@
+import json
+import os
+import stat
+import sys
+import tempfile
+import textwrap
+import unittest
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.dirname(TESTS_DIR)
+
+sys.path.append(SCRIPTS_DIR)
+
+import firmware
+
+
+VERIFY_OUTPUT = [
+    "MAC: 24:0a:c4:00:00:01",
+    "Verifying 0x6d30 (27952) bytes @ 0x00001000 in flash against bootloader.bin...",
+    "-- verify OK (digest matched)",
+    "Verifying 0x1a0000 (1703936) bytes @ 0x00010000 in flash against NodeMCU.bin...",
+    "-- verify FAILED (digest mismatch)",
+    "Verifying 0xc00 (3072) bytes @ 0x00008000 in flash against partition-table.bin...",
+    "-- verify OK (digest matched)",
+    "Verifying 0x40000 (262144) bytes @ 0x00190000 in flash against lfs.img...",
+    "-- verify FAILED (digest mismatch)",
+]
+
+
+class StubEsptool(object):
+    """
+    Executable stand-in for esptool which prints `verify_output` (exiting with `verify_returncode`) when verifying,
+    and records the arguments of every invocation.
+    """
+
+    def __init__(self, directory, verify_output, verify_returncode=0):
+        self.path = os.path.join(directory, "esptool.py")
+        self.log_path = os.path.join(directory, "esptool.log")
+        output = "\n".join(verify_output)
+        with open(self.path, "w") as fh:
+            fh.write(textwrap.dedent(f"""\
+                #!{sys.executable}
+                import json
+                import sys
+                with open({self.log_path!r}, "a") as fh:
+                    fh.write(json.dumps(sys.argv[1:]) + "\\n")
+                if "verify_flash" in sys.argv:
+                    print({output!r})
+                    sys.exit({verify_returncode})
+                """))
+        os.chmod(self.path, os.stat(self.path).st_mode | stat.S_IXUSR)
+
+    @property
+    def commands(self):
+        try:
+            with open(self.log_path) as fh:
+                return [json.loads(line) for line in fh]
+        except FileNotFoundError:
+            return []
+
+    @property
+    def written_regions(self):
+        """
+        Offsets written by each `write_flash` invocation.
+        """
+        return [[argument for argument in command[command.index("write_flash"):] if argument.startswith("0x")]
+                for command in self.commands if "write_flash" in command]
+
+
+class TestGetFailedRegions(unittest.TestCase):
+
+    def test_failed_regions(self):
+        self.assertEqual(firmware.get_failed_regions(VERIFY_OUTPUT),
+                         [("0x10000", "NodeMCU.bin"), ("0x190000", "lfs.img")])
+
+    def test_all_regions_verified(self):
+        output = [line.replace("FAILED (digest mismatch)", "OK (digest matched)") for line in VERIFY_OUTPUT]
+        self.assertEqual(firmware.get_failed_regions(output), [])
+
+    def test_incomplete_output(self):
+        self.assertIsNone(firmware.get_failed_regions([]))
+        self.assertIsNone(firmware.get_failed_regions(VERIFY_OUTPUT[:5]),
+                          "Results are only trusted if every region was verified")
+        self.assertIsNone(firmware.get_failed_regions(["A fatal error occurred: Failed to connect to ESP32"]))
+
+    def test_ignores_other_lines(self):
+        output = ["Ignoring -- verify FAILED"] + VERIFY_OUTPUT
+        self.assertEqual(len(firmware.get_failed_regions(output)), 2)
+
+
+class TestFlashDevice(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "firmware")
+        os.mkdir(self.path)
+        for _, filename in firmware.FLASH_REGIONS:
+            with open(os.path.join(self.path, filename), "wb") as fh:
+                fh.write(filename.encode("utf-8"))
+        self.manifest = firmware.FlashManifest(os.path.join(self.directory.name, "manifest.json"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_writes_failed_regions(self):
+        esptool = StubEsptool(self.directory.name, VERIFY_OUTPUT, verify_returncode=2)
+        result = firmware.flash_device(esptool.path, "/dev/null", self.path, manifest=self.manifest)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(esptool.written_regions, [["0x10000", "0x190000"]])
+        self.assertEqual(result.bytes_written, len(b"NodeMCU.bin") + len(b"lfs.img"))
+        self.assertEqual(set(self.manifest.get("24:0a:c4:00:00:01")["regions"]),
+                         {offset for offset, _ in firmware.FLASH_REGIONS},
+                         "Devices are recorded by MAC address")
+
+    def test_skips_verified_device(self):
+        output = [line.replace("FAILED (digest mismatch)", "OK (digest matched)") for line in VERIFY_OUTPUT]
+        esptool = StubEsptool(self.directory.name, output)
+        result = firmware.flash_device(esptool.path, "/dev/null", self.path, manifest=self.manifest)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(esptool.written_regions, [], "Nothing is written if every region matches")
+        self.assertEqual(result.bytes_written, 0)
+
+    def test_writes_every_region_if_unverified(self):
+        esptool = StubEsptool(self.directory.name, ["A fatal error occurred: Failed to connect to ESP32"],
+                              verify_returncode=2)
+        result = firmware.flash_device(esptool.path, "/dev/null", self.path, manifest=self.manifest)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(esptool.written_regions, [[offset for offset, _ in firmware.FLASH_REGIONS]])
+
+    def test_missing_esptool(self):
+        result = firmware.flash_device(os.path.join(self.directory.name, "missing"), "/dev/null", self.path,
+                                       manifest=self.manifest)
+        self.assertIsNone(result.returncode)
+        self.assertEqual(self.manifest.get("/dev/null"), {}, "Nothing is recorded for devices that weren't flashed")
+
+
+if __name__ == "__main__":
+    unittest.main()
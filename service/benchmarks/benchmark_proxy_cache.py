@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""
+Simulates devices polling the service through a shared cache honouring `s-maxage` and upload-driven purges, reporting
+the fraction of polls served by the cache without reaching the service. Runs the service in-process (using an
+in-memory database) against a simulated clock, so hours of polling take seconds.
+"""
+
+import argparse
+import heapq
+import io
+import os
+import random
+import sys
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCHMARKS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import proxycache
+
+
+class StubCache(object):
+    """
+    Minimal shared cache: stores 200 responses with `s-maxage`, answers conditional requests itself when it holds a
+    fresh response, and drops entries when purged.
+    """
+
+    def __init__(self, origin, clock):
+        self.origin = origin
+        self.clock = clock
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, etag=None):
+        entry = self.entries.get(path)
+        if entry is not None and entry["expires"] > self.clock():
+            self.hits += 1
+            return 304 if etag == entry["etag"] else 200, entry["etag"]
+        self.misses += 1
+        headers = {"If-None-Match": etag} if etag else {}
+        response = self.origin.get(path, headers=headers)
+        s_maxage = response.cache_control.s_maxage
+        if response.status_code == 200 and s_maxage:
+            self.entries[path] = {"etag": response.headers["ETag"], "expires": self.clock() + int(s_maxage)}
+        return response.status_code, response.headers.get("ETag")
+
+    def purge(self, path):
+        self.entries.pop(path, None)
+
+
+class StubPurger(object):
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.stats = {}
+
+    def purge(self, identifier, image_count=0):
+        for path in proxycache.get_paths(identifier, image_count):
+            self.cache.purge(path)
+
+
+def simulate(options):
+    import app
+
+    now = [0.0]
+    origin = app.app.test_client()
+    cache = StubCache(origin, lambda: now[0])
+    app.purger = StubPurger(cache)
+
+    r = random.Random(0)
+    identifiers = ["%08x" % r.getrandbits(32) for _ in range(options.devices)]
+    events = []
+    for identifier in identifiers:
+        origin.post(f"/api/v3/status/{identifier}", data={"file": (io.BytesIO(os.urandom(options.size)), "file")})
+        heapq.heappush(events, (r.uniform(0, options.poll_interval), "poll", identifier))
+        heapq.heappush(events, (r.uniform(0, options.upload_interval), "upload", identifier))
+
+    etags = {}
+    polls = 0
+    while events:
+        now[0], kind, identifier = heapq.heappop(events)
+        if now[0] > options.duration:
+            break
+        if kind == "poll":
+            _, etags[identifier] = cache.get(f"/api/v3/status/{identifier}", etags.get(identifier))
+            polls += 1
+            heapq.heappush(events, (now[0] + options.poll_interval, "poll", identifier))
+        else:
+            origin.post(f"/api/v3/status/{identifier}", data={"file": (io.BytesIO(os.urandom(options.size)), "file")})
+            heapq.heappush(events, (now[0] + options.upload_interval, "upload", identifier))
+
+    return polls, cache.hits, cache.misses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--devices", type=int, default=200, help="number of devices")
+    parser.add_argument("--duration", type=float, default=4 * 60 * 60, help="simulated seconds")
+    parser.add_argument("--poll-interval", type=float, default=60, help="seconds between polls for each device")
+    parser.add_argument("--upload-interval", type=float, default=60 * 60, help="seconds between uploads for each device")
+    parser.add_argument("--max-age", type=int, default=3600, help="s-maxage given to the shared cache")
+    parser.add_argument("--size", type=int, default=20000, help="size of each update in bytes")
+    options = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", "memory://benchmark")
+    os.environ.setdefault("SKIP_APNS_STARTUP_CHECK", "1")
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "none")
+    os.environ["PROXY_CACHE_MAX_AGE"] = str(options.max_age)
+
+    polls, hits, misses = simulate(options)
+    print("%-28s %8d" % ("polls", polls))
+    print("%-28s %8d" % ("served by cache", hits))
+    print("%-28s %8d" % ("reached the service", misses))
+    print("%-28s %8.1f%%" % ("hit ratio", 100 * hits / polls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Measures device registrations per second against the database given by `DATABASE_URL`, with a fleet of registered
+devices, comparing the original registration path with the coalescing one.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCHMARKS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import cache
+import database
+
+
+TOKEN_PREFIX = "benchmark-"
+
+
+def legacy_register(db, token, use_sandbox):
+    # What the original handler did: SELECT followed by UPDATE or INSERT, then reading every device to log them.
+    with database.Transaction(db.connection) as cursor:
+        cursor.execute("SELECT COUNT(*) FROM devices WHERE token = %s", (token, ))
+        if cursor.fetchone()[0]:
+            cursor.execute("UPDATE devices SET use_sandbox = %s, last_modified = current_timestamp WHERE token = %s",
+                           (use_sandbox, token))
+        else:
+            cursor.execute("INSERT INTO devices (token, use_sandbox, last_modified) VALUES (%s, %s, current_timestamp)",
+                           (token, use_sandbox))
+    db.get_devices()
+
+
+def measure(name, count, fn):
+    start = time.perf_counter()
+    fn()
+    duration = time.perf_counter() - start
+    print("%-32s %10.0f registrations/s" % (name, count / duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--devices", type=int, default=100000, help="number of registered devices")
+    parser.add_argument("--count", type=int, default=2000, help="number of registrations to measure")
+    parser.add_argument("--ttl", type=float, default=60 * 60 * 24, help="registration cache TTL in seconds")
+    options = parser.parse_args()
+
+    if "DATABASE_URL" not in os.environ:
+        exit("DATABASE_URL must be set.")
+
+    db = database.PostgresDatabase(os.environ["DATABASE_URL"])
+    tokens = ["%s%064x" % (TOKEN_PREFIX, random.getrandbits(256)) for _ in range(options.devices)]
+    with database.Transaction(db.connection) as cursor:
+        cursor.execute("INSERT INTO devices (token) SELECT unnest(%s::text[])", (tokens, ))
+    sample = random.sample(tokens, min(options.count, len(tokens)))
+
+    try:
+        # The legacy path is O(fleet) per registration, so we only measure a fraction of the registrations.
+        legacy_sample = sample[:max(len(sample) // 20, 1)]
+        measure("legacy", len(legacy_sample), lambda: [legacy_register(db, token, False) for token in legacy_sample])
+        measure("upsert (recent, skipped)", len(sample),
+                lambda: [db.register_device(token, False, min_age=options.ttl) for token in sample])
+        measure("upsert (stale, written)", len(sample),
+                lambda: [db.register_device(token, False, min_age=0) for token in sample])
+
+        registered_devices = cache.TTLCache(ttl=options.ttl)
+
+        def register(token):
+            if registered_devices.get(token) is not False:
+                db.register_device(token, False, min_age=options.ttl)
+                registered_devices.set(token, False)
+
+        measure("cache (cold)", len(sample), lambda: [register(token) for token in sample])
+        measure("cache (warm)", len(sample), lambda: [register(token) for token in sample])
+    finally:
+        with database.Transaction(db.connection) as cursor:
+            cursor.execute("DELETE FROM devices WHERE token LIKE %s", (TOKEN_PREFIX + "%", ))
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+Simulates the hourly upload burst (every device's client uploading at the top of the hour) against the database given
+by `DATABASE_URL`, comparing synchronous writes with write-behind batching.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCHMARKS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import database
+import writebehind
+
+
+def make_update(size):
+    # Header with a two image index; the contents are opaque to the service.
+    header = bytes([0xFF, 0x00, 0x08, 0x00, 0x00, 0x02, 0x00, 0x00])
+    offset = len(header) + 8
+    length = (size - offset) // 2
+    index = offset.to_bytes(4, "little") + (offset + length).to_bytes(4, "little")
+    return header + index + os.urandom(size - offset)
+
+
+def burst(identifiers, uploads_per_identifier, threads, upload):
+    """
+    Uploads to each identifier from a pool of threads (mimicking gunicorn's request handlers), returning the duration.
+    """
+    work = [identifier for _ in range(uploads_per_identifier) for identifier in identifiers]
+    chunks = [work[i::threads] for i in range(threads)]
+
+    def run(chunk):
+        for identifier in chunk:
+            upload(identifier)
+
+    workers = [threading.Thread(target=run, args=(chunk,)) for chunk in chunks]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def report(name, uploads, commits, duration):
+    print("%-28s %8.0f uploads/s %8.0f commits/s %8.3f s" % (name, uploads / duration, commits / duration, duration))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--devices", type=int, default=2000, help="number of devices uploading in the burst")
+    parser.add_argument("--repeats", type=int, default=2, help="uploads per device (clients often upload twice)")
+    parser.add_argument("--threads", type=int, default=16, help="number of concurrent request handlers")
+    parser.add_argument("--size", type=int, default=20000, help="size of each update in bytes")
+    parser.add_argument("--interval", type=float, default=5, help="write-behind interval in milliseconds")
+    options = parser.parse_args()
+
+    if "DATABASE_URL" not in os.environ:
+        exit("DATABASE_URL must be set.")
+
+    database.PostgresDatabase(os.environ["DATABASE_URL"]).close()  # Run the migrations up-front.
+    identifiers = [str(uuid.uuid4()) for _ in range(options.devices)]
+    data = make_update(options.size)
+    uploads = options.devices * options.repeats
+
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def synchronous_upload(identifier):
+        if not hasattr(local, "database"):
+            local.database = database.PostgresDatabase(os.environ["DATABASE_URL"])
+            with lock:
+                connections.append(local.database)
+        local.database.set_data(identifier, data)
+
+    duration = burst(identifiers, options.repeats, options.threads, synchronous_upload)
+    report("synchronous", uploads, uploads, duration)
+
+    buffer = writebehind.WriteBehindBuffer(database.connect,
+                                           interval=options.interval / 1000,
+                                           max_pending=uploads)
+    start = time.perf_counter()
+    acknowledged = burst(identifiers, options.repeats, options.threads, lambda identifier: buffer.put(identifier, data))
+    buffer.close(timeout=None)
+    duration = time.perf_counter() - start
+    report("write-behind (acknowledged)", uploads, buffer.stats["batches"], acknowledged)
+    report("write-behind (committed)", uploads, buffer.stats["batches"], duration)
+    print("write-behind wrote %d rows in %d batches, coalescing %d uploads" % (buffer.stats["written"],
+                                                                              buffer.stats["batches"],
+                                                                              buffer.stats["coalesced"]))
+
+    with database.Transaction(connections[0].connection) as cursor:
+        cursor.execute("DELETE FROM data WHERE id = ANY(%s)", (identifiers,))
+    for connection in connections:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""
+Replays traffic captured by the service (see `CAPTURE_PATH`) against a local instance, reporting latency distributions
+and status codes by route. Results can be saved and compared with a previous run (or the capture itself) to show
+changes in errors and latency.
+"""
+
+import argparse
+import base64
+import collections
+import json
+import os
+import queue
+import threading
+import time
+import urllib.parse
+
+import requests
+
+
+def load_capture(path):
+    # Requests that didn't match a route can't be replayed.
+    with open(path) as fh:
+        records = [json.loads(line) for line in fh if line.strip()]
+    return sorted((record for record in records if record["route"] is not None), key=lambda record: record["time"])
+
+
+def get_url(base_url, record):
+    # Hashed identifiers are replaced with valid short identifiers derived from them.
+    path = record["route"]
+    if record["identifier"] is not None:
+        path = path.replace("<identifier>", record["identifier"][:8])
+    if record["index"] is not None:
+        path = path.replace("<int:index>", str(record["index"]))
+    return urllib.parse.urljoin(base_url, path)
+
+
+class Replayer(object):
+    """
+    Sends captured requests using a fixed number of clients. Requests for the same identifier always use the same
+    client, so they're sent in their original order.
+    """
+
+    def __init__(self, base_url, clients):
+        self.base_url = base_url
+        self.clients = clients
+        self.validators = {}  # Only accessed by the client for the corresponding identifier.
+
+    def send(self, session, record):
+        url = get_url(self.base_url, record)
+        headers = {}
+        etag, last_modified = self.validators.get(url, (None, None))
+        if "If-None-Match" in record["conditional"] and etag:
+            headers["If-None-Match"] = etag
+        if "If-Modified-Since" in record["conditional"] and last_modified:
+            headers["If-Modified-Since"] = last_modified
+        if record["range"]:
+            headers["Range"] = record["range"]
+        start = time.perf_counter()
+        try:
+            if record["method"] == "POST" and record["route"] == "/api/v3/device/":
+                # Device tokens aren't captured.
+                response = session.post(url, json={"token": base64.b64encode(os.urandom(32)).decode("ascii")})
+            elif record["method"] == "POST":
+                response = session.post(url, files={"file": os.urandom(record["size"])})
+            else:
+                response = session.request(record["method"], url, headers=headers, allow_redirects=False)
+            status = response.status_code
+            if status == 200 and "ETag" in response.headers:
+                self.validators[url] = (response.headers["ETag"], response.headers.get("Last-Modified"))
+        except requests.RequestException:
+            status = None
+        return status, (time.perf_counter() - start) * 1000
+
+    def run_client(self, requests_queue, results):
+        session = requests.Session()
+        while True:
+            item = requests_queue.get()
+            if item is None:
+                return
+            sequence, record = item
+            results[sequence] = (sequence,) + self.send(session, record)
+
+    def replay(self, records, speed):
+        """
+        Sends the records, preserving their relative timing scaled by `speed` (0 sends them as fast as possible), and
+        returns `(sequence, status, duration_ms)` tuples.
+        """
+        results = [None] * len(records)
+        queues = [queue.Queue() for _ in range(self.clients)]
+        threads = [threading.Thread(target=self.run_client, args=(requests_queue, results)) for requests_queue in queues]
+        for thread in threads:
+            thread.start()
+        start = time.monotonic()
+        origin = records[0]["time"] if records else 0
+        for sequence, record in enumerate(records):
+            if speed:
+                delay = (record["time"] - origin) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            client = int(record["identifier"], 16) if record["identifier"] else sequence
+            queues[client % self.clients].put((sequence, record))
+        for requests_queue in queues:
+            requests_queue.put(None)
+        for thread in threads:
+            thread.join()
+        return results
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summarize(records, results):
+    routes = collections.defaultdict(lambda: {"count": 0, "statuses": collections.Counter(), "durations": []})
+    for sequence, status, duration in results:
+        route = routes["%s %s" % (records[sequence]["method"], records[sequence]["route"])]
+        route["count"] += 1
+        route["statuses"][str(status)] += 1
+        route["durations"].append(duration)
+    return {name: {"count": route["count"],
+                   "statuses": dict(route["statuses"]),
+                   "p50_ms": round(percentile(route["durations"], 0.5), 3),
+                   "p90_ms": round(percentile(route["durations"], 0.9), 3),
+                   "p99_ms": round(percentile(route["durations"], 0.99), 3),
+                   "max_ms": round(max(route["durations"]), 3)}
+            for name, route in sorted(routes.items())}
+
+
+def print_summary(summary):
+    print("%-48s %7s %9s %9s %9s %9s  %s" % ("route", "count", "p50 ms", "p90 ms", "p99 ms", "max ms", "statuses"))
+    for name, route in summary.items():
+        statuses = ", ".join("%s: %d" % item for item in sorted(route["statuses"].items()))
+        print("%-48s %7d %9.2f %9.2f %9.2f %9.2f  %s" % (name, route["count"], route["p50_ms"], route["p90_ms"],
+                                                         route["p99_ms"], route["max_ms"], statuses))
+
+
+def print_comparison(baseline, results):
+    """
+    Reports requests whose status differs from the baseline (a previous run, or the capture), and the change in median
+    and tail latency by route.
+    """
+    changes = collections.Counter()
+    for sequence, status in results["statuses"].items():
+        previous = baseline["statuses"].get(sequence)
+        if previous != status:
+            changes[(results["routes"][sequence], previous, status)] += 1
+    if changes:
+        print("\nStatus changes:")
+        for (route, previous, status), count in sorted(changes.items(), key=str):
+            print("  %-48s %s -> %s: %d" % (route, previous, status, count))
+    else:
+        print("\nNo status changes.")
+    if "summary" in baseline:
+        print("\nLatency changes:")
+        for name, route in results["summary"].items():
+            if name in baseline["summary"]:
+                previous = baseline["summary"][name]
+                print("  %-48s p50 %+8.2f ms  p99 %+8.2f ms" % (name,
+                                                                route["p50_ms"] - previous["p50_ms"],
+                                                                route["p99_ms"] - previous["p99_ms"]))
+
+
+def capture_baseline(records):
+    return {"statuses": {str(sequence): record["status"] for sequence, record in enumerate(records)}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("capture", help="capture file (JSONL)")
+    parser.add_argument("--base-url", default="http://localhost:5000", help="service to replay against")
+    parser.add_argument("--speed", type=float, default=1, help="speed relative to the capture (0 is unpaced)")
+    parser.add_argument("--clients", type=int, default=16, help="number of concurrent clients")
+    parser.add_argument("--output", help="save the results for comparison with a later run")
+    parser.add_argument("--compare", help="results of a previous run to compare with, or 'capture'")
+    options = parser.parse_args()
+
+    records = load_capture(options.capture)
+    replayer = Replayer(options.base_url, options.clients)
+    start = time.monotonic()
+    results = replayer.replay(records, options.speed)
+    duration = time.monotonic() - start
+    summary = summarize(records, results)
+    print_summary(summary)
+    print("\nReplayed %d requests in %.1fs (%.1f requests/s)." % (len(results), duration, len(results) / duration))
+
+    run = {
+        "summary": summary,
+        "statuses": {str(sequence): status for sequence, status, _ in results},
+        "routes": {str(sequence): "%s %s" % (records[sequence]["method"], records[sequence]["route"])
+                   for sequence, _, _ in results},
+    }
+    if options.compare:
+        if options.compare == "capture":
+            baseline = capture_baseline(records)
+        else:
+            with open(options.compare) as fh:
+                baseline = json.load(fh)
+        print_comparison(baseline, run)
+    if options.output:
+        with open(options.output, "w") as fh:
+            json.dump(run, fh)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,7 @@ import datetime
 import io
 import os
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
@@ -49,6 +50,10 @@ SERVICE_DIR = os.path.dirname(TESTS_DIR)
 WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
 BUILD_DIR = os.path.join(SERVICE_DIR, "build")
 
+# Must match the service configuration.
+NEGATIVE_CACHE_TTL = float(os.environ.get("NEGATIVE_CACHE_TTL", "30"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "60"))
+
 sys.path.append(WEB_SERVICE_DIR)
 
 import apns
@@ -76,6 +81,50 @@ class RemoteClient(object):
         self.session.close()
 
 
+class LocalResponse(object):
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.data
+        self._response = response
+
+    def json(self):
+        return self._response.get_json()
+
+
+class LocalClient(object):
+    """
+    Runs the service in-process using Flask's test client, with the storage backend given by `DATABASE_URL` (defaulting
+    to an in-memory store).
+    """
+
+    def __init__(self):
+        os.environ.setdefault("DATABASE_URL", "memory://")
+        os.environ.setdefault("SKIP_APNS_STARTUP_CHECK", "1")
+        import app
+        self.client = app.app.test_client()
+
+    def get(self, url, *args, **kwargs):
+        return LocalResponse(self.client.get(url, *args, **kwargs))
+
+    def post(self, url, *args, **kwargs):
+        return LocalResponse(self.client.post(url, *args, **kwargs))
+
+    def upload(self, url, data):
+        return self.post(url, data={'file': (io.BytesIO(data), 'file')})
+
+    def close(self):
+        pass
+
+
+def make_client():
+    # Test a running service if one is given, otherwise the service in-process.
+    if os.environ.get("TEST_BASE_URL"):
+        return RemoteClient(os.environ["TEST_BASE_URL"])
+    return LocalClient()
+
+
 @contextlib.contextmanager
 def chdir(path):
     pwd = os.getcwd()
@@ -86,10 +135,20 @@ def chdir(path):
         os.chdir(pwd)
 
 
+def make_payload(images, wakeup_time=0, flags=0):
+    header = struct.pack(">HBHB", 0xFF00, 8, wakeup_time, len(images)) + struct.pack("<H", flags)
+    offset = len(header) + 4 * len(images)
+    index = b""
+    for image in images:
+        index += struct.pack("<I", offset)
+        offset += len(image)
+    return header + index + b"".join(images)
+
+
 class TestAPI(unittest.TestCase):
 
     def setUp(self):
-        self.client = RemoteClient(os.environ["TEST_BASE_URL"])
+        self.client = make_client()
 
     def tearDown(self):
         self.client.close()
@@ -227,6 +286,37 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 200, "Getting the uploaded file succeeds")
         self.assertEqual(response.content, data, "Downloaded file matches uploaded file")
 
+    # Rate limits are per-worker, so this can only be checked reliably in-process.
+    @unittest.skipIf(os.environ.get("TEST_BASE_URL") or os.environ.get("RATE_LIMIT_BACKEND", "memory") != "memory",
+                     "Requires the in-process service with the default rate limiter")
+    def test_api_v3_rate_limit_ignores_identifier_case(self):
+        identifier = str(uuid.uuid4())
+        for i in range(int(RATE_LIMIT_BURST)):
+            url = '/api/v3/status/' + (identifier.upper() if i % 2 else identifier)
+            self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.get('/api/v3/status/' + identifier.upper())
+        self.assertEqual(response.status_code, 429, "Changing the case of the identifier doesn't reset the rate limit")
+
+    def test_api_v3_upload_after_missing_becomes_visible(self):
+        url = '/api/v3/status/' + str(uuid.uuid4())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404, "Fetching missing upload fails")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404, "Fetching missing upload fails repeatedly")
+        data = os.urandom(307200)
+        response = self._upload(url, data)
+        self.assertEqual(response.status_code, 200, "Upload succeeds")
+
+        # Workers other than the one that handled the upload may cache the missing identifier for a bounded time.
+        deadline = time.monotonic() + NEGATIVE_CACHE_TTL + 5
+        while True:
+            response = self.client.get(url)
+            if response.status_code != 404 or time.monotonic() > deadline:
+                break
+            time.sleep(1)
+        self.assertEqual(response.status_code, 200, "Upload becomes visible within the negative cache TTL")
+        self.assertEqual(response.content, data, "Downloaded file matches uploaded file")
+
     def _test_put_get_last_modified(self, url):
         data = os.urandom(307200)
         response = self._upload(url, data)
@@ -245,6 +335,20 @@ class TestAPI(unittest.TestCase):
     def test_api_v3_put_get_last_modified(self):
         self._test_put_get_last_modified('/api/v3/status/abcdefgh')
 
+    def test_api_v3_get_poll_interval_hint(self):
+        url = '/api/v3/status/' + str(uuid.uuid4())
+        response = self._upload(url, os.urandom(1024))
+        self.assertEqual(response.status_code, 200, "Upload succeeds")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, "Download succeeds")
+        self.assertTrue('Expires' in response.headers, "Expires header returned")
+        directives = [directive.strip() for directive in response.headers['Cache-Control'].split(',')]
+        max_age = [int(directive.split('=')[1]) for directive in directives if directive.startswith('max-age=')]
+        self.assertEqual(len(max_age), 1, "Cache-Control max-age returned")
+        self.assertGreater(max_age[0], 0, "Suggested polling interval is positive")
+        if not os.environ.get("PROXY_CACHE_MAX_AGE"):
+            self.assertIn("private", directives, "Shared caches can't store statuses")
+
     def _test_upload_large_file_fails(self, url):
         data = os.urandom((1024 * 1024) + 1)  # A little over 1MB
         response = self._upload(url, data)
@@ -273,6 +377,72 @@ class TestAPI(unittest.TestCase):
         response = self.client.get(url, headers={'If-Modified-Since': last_modified})
         self.assertEqual(response.status_code, 304, "Does not download data that has not changed")
 
+    def test_api_v3_if_none_match_header(self):
+        url = '/api/v3/status/' + str(uuid.uuid4())
+        response = self._upload(url, os.urandom(1024))
+        self.assertEqual(response.status_code, 200, "Upload succeeds")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, "Download succeeds")
+        etag = response.headers['ETag']
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304, "Does not download data that has not changed")
+
+        response = self._upload(url, os.urandom(1024))
+        self.assertEqual(response.status_code, 200, "Upload succeeds")
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200, "Downloads data uploaded within the same second")
+        self.assertNotEqual(response.headers['ETag'], etag, "ETag changes with each upload")
+
+    def test_api_v3_get_image(self):
+        url = '/api/v3/status/' + str(uuid.uuid4())
+        images = [os.urandom(1024), os.urandom(2048), os.urandom(512)]
+        response = self._upload(url, make_payload(images))
+        self.assertEqual(response.status_code, 200, "Upload succeeds")
+        for index, image in enumerate(images):
+            response = self.client.get(f"{url}/image/{index}")
+            self.assertEqual(response.status_code, 200, "Getting an image succeeds")
+            self.assertEqual(response.content, image, "Downloaded image matches uploaded image")
+            self.assertTrue('Last-Modified' in response.headers, "Last-Modified headers returned")
+        response = self.client.get(f"{url}/image/{len(images)}")
+        self.assertEqual(response.status_code, 404, "Getting a missing image fails")
+
+    def test_api_v3_get_image_etag(self):
+        url = '/api/v3/status/' + str(uuid.uuid4())
+        response = self._upload(url, make_payload([os.urandom(1024), os.urandom(1024)]))
+        self.assertEqual(response.status_code, 200, "Upload succeeds")
+        etags = [self.client.get(f"{url}/image/{index}").headers['ETag'] for index in range(2)]
+        self.assertNotEqual(etags[0], etags[1], "Images have distinct ETags")
+        response = self.client.get(f"{url}/image/0", headers={'If-None-Match': etags[0]})
+        self.assertEqual(response.status_code, 304, "Does not download images that have not changed")
+
+    def test_api_v3_get_image_status_etag(self):
+        url = '/api/v3/status/' + str(uuid.uuid4())
+        response = self._upload(url, make_payload([os.urandom(1024), os.urandom(1024)]))
+        self.assertEqual(response.status_code, 200, "Upload succeeds")
+        etag = self.client.get(url).headers['ETag']
+        for index in range(2):
+            response = self.client.get(f"{url}/image/{index}")
+            self.assertEqual(response.headers['X-Status-ETag'], etag, "Images give the ETag of their status")
+
+    def test_api_v3_get_image_opaque_upload(self):
+        url = '/api/v3/status/' + str(uuid.uuid4())
+        response = self._upload(url, os.urandom(1024))
+        self.assertEqual(response.status_code, 200, "Uploading data in an unknown format succeeds")
+        response = self.client.get(f"{url}/image/0")
+        self.assertEqual(response.status_code, 404, "Getting images from data in an unknown format fails")
+
+    def test_api_v3_get_range(self):
+        url = '/api/v3/status/' + str(uuid.uuid4())
+        data = make_payload([os.urandom(1024), os.urandom(1024)])
+        response = self._upload(url, data)
+        self.assertEqual(response.status_code, 200, "Upload succeeds")
+        response = self.client.get(url, headers={'Range': 'bytes=0-15'})
+        self.assertEqual(response.status_code, 206, "Range request succeeds")
+        self.assertEqual(response.content, data[:16], "Downloaded range matches uploaded data")
+        response = self.client.get(url, headers={'Range': 'bytes=0-15', 'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304, "Conditional range requests are not downloaded if unchanged")
+
     def test_api_v2_if_modified_since_header(self):
         self._test_if_modified_since_header('/api/v2/poiuytre')
 
@@ -300,7 +470,7 @@ class TestAPI(unittest.TestCase):
         token = '2EDvBde5PThia/q/zS0aSWe4kbnhjEiE9C+q3ykf7cU='
         response = self.client.post(url, json={'token': token})
         self.assertEqual(response.status_code, 200, "Registering device succeeds")
-        db = database.Database(readonly=True)
+        db = database.connect(readonly=True)
         self.assertTrue({"token": apns.encode_token(token), "use_sandbox": False} in db.get_devices())
 
     def test_api_v3_post_device_no_sandbox_explicit(self):
@@ -308,7 +478,7 @@ class TestAPI(unittest.TestCase):
         token = '2EDvBde5PThia/q/zS0aSWe4kbnhjEiE9C+q3ykf7cU='
         response = self.client.post(url, json={'token': token, 'use_sandbox': False})
         self.assertEqual(response.status_code, 200, "Registering device succeeds")
-        db = database.Database(readonly=True)
+        db = database.connect(readonly=True)
         self.assertTrue({"token": apns.encode_token(token), "use_sandbox": False} in db.get_devices())
 
     def test_api_v3_post_device_use_sandbox(self):
@@ -316,9 +486,19 @@ class TestAPI(unittest.TestCase):
         token = '2EDvBde5PThia/q/zS0aSWe4kbnhjEiE9C+q3ykf7cU='
         response = self.client.post(url, json={'token': token, 'use_sandbox': True})
         self.assertEqual(response.status_code, 200, "Registering device succeeds")
-        db = database.Database(readonly=True)
+        db = database.connect(readonly=True)
         self.assertTrue({"token": apns.encode_token(token), "use_sandbox": True} in db.get_devices())
 
+    def test_api_v3_post_device_repeat_registration(self):
+        url = '/api/v3/device/'
+        token = 'Y2VDZdJQmNQWf6Ew0Vfn6xKbq4Jp9MD5J3xCxkhW6Ns='
+        for use_sandbox in [True, True, False, False]:
+            response = self.client.post(url, json={'token': token, 'use_sandbox': use_sandbox})
+            self.assertEqual(response.status_code, 200, "Registering device succeeds")
+        db = database.connect(readonly=True)
+        self.assertTrue({"token": apns.encode_token(token), "use_sandbox": False} in db.get_devices(),
+                        "Changing use_sandbox is always written")
+
     def test_service_about(self):
         response = self.client.get("/api/v3/service/about")
         self.assertTrue("version" in response.json())
@@ -0,0 +1,80 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import unittest
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import cache
+import helpers
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.Clock()
+        self.cache = cache.TTLCache(ttl=10, max_size=3, clock=self.clock)
+
+    def test_set_get(self):
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertTrue("a" in self.cache)
+        self.assertFalse("b" in self.cache)
+
+    def test_expiry(self):
+        self.cache.set("a")
+        self.clock.time += 9.9
+        self.assertTrue("a" in self.cache, "Entries are retained until their TTL")
+        self.clock.time += 0.1
+        self.assertFalse("a" in self.cache, "Entries expire after their TTL")
+        self.assertEqual(len(self.cache), 0, "Expired entries are removed on access")
+
+    def test_set_refreshes_expiry(self):
+        self.cache.set("a")
+        self.clock.time += 5
+        self.cache.set("a")
+        self.clock.time += 9
+        self.assertTrue("a" in self.cache)
+
+    def test_discard(self):
+        self.cache.set("a")
+        self.cache.discard("a")
+        self.cache.discard("b")
+        self.assertFalse("a" in self.cache)
+
+    def test_eviction(self):
+        for key in ["a", "b", "c"]:
+            self.cache.set(key)
+        self.cache.set("a")
+        self.cache.set("d")
+        self.assertEqual(len(self.cache), 3)
+        self.assertFalse("b" in self.cache, "Least recently set entry is evicted")
+        self.assertTrue("a" in self.cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
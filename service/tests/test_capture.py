@@ -0,0 +1,112 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from flask import Flask, abort
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import capture
+
+
+class TestCaptureMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "capture.jsonl")
+        self.app = Flask(__name__)
+
+        @self.app.route('/api/v3/status/<identifier>', methods=['GET', 'POST'])
+        def status(identifier):
+            if identifier == "missing1":
+                abort(404)
+            return "data"
+
+    def tearDown(self):
+        self.middleware.close()
+        shutil.rmtree(self.directory)
+
+    def install(self, sample_rate, salt="salt"):
+        self.middleware = capture.CaptureMiddleware(self.app.wsgi_app, self.app.url_map, self.path,
+                                                    sample_rate=sample_rate, salt=salt)
+        self.app.wsgi_app = self.middleware
+        return self.app.test_client()
+
+    def records(self):
+        with open(self.path) as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_record(self):
+        client = self.install(sample_rate=1)
+        client.get('/api/v3/status/abcdefgh', headers={"If-None-Match": '"etag"', "Range": "bytes=0-10"})
+        client.post('/api/v3/status/abcdefgh', data=b"12345")
+        client.get('/api/v3/status/missing1')
+        client.get('/other')
+        records = self.records()
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[0]["route"], "/api/v3/status/<identifier>")
+        self.assertEqual(records[0]["identifier"], self.middleware.hash_identifier("abcdefgh"))
+        self.assertNotIn("abcdefgh", json.dumps(records))
+        self.assertEqual(records[0]["conditional"], ["If-None-Match"])
+        self.assertEqual(records[0]["range"], "bytes=0-10")
+        self.assertEqual(records[0]["response_size"], 4)
+        self.assertEqual(records[1]["method"], "POST")
+        self.assertEqual(records[1]["size"], 5)
+        self.assertEqual(records[2]["status"], 404)
+        self.assertIsNone(records[3]["route"])
+
+    def test_sampling_is_by_identifier(self):
+        client = self.install(sample_rate=0.5)
+        identifiers = ["%08x" % i for i in range(200)]
+        for identifier in identifiers * 2:
+            client.get('/api/v3/status/' + identifier)
+        records = self.records()
+        sampled = [identifier for identifier in identifiers
+                   if self.middleware.is_sampled(identifier)]
+        self.assertEqual(len(records), 2 * len(sampled))
+        self.assertGreater(len(sampled), 60)
+        self.assertLess(len(sampled), 140)
+
+    def test_sampling_is_independent_of_salt(self):
+        # Workers without a shared salt must still capture the same devices.
+        self.install(sample_rate=0.5, salt=None)
+        first = self.middleware
+        self.install(sample_rate=0.5, salt=None)
+        identifiers = ["%08x" % i for i in range(200)]
+        self.assertNotEqual(first.hash_identifier("abcdefgh"), self.middleware.hash_identifier("abcdefgh"))
+        self.assertEqual([first.is_sampled(identifier) for identifier in identifiers],
+                         [self.middleware.is_sampled(identifier) for identifier in identifiers])
+        self.assertEqual(self.middleware.is_sampled("ABCDEFGH"), self.middleware.is_sampled("abcdefgh"))
+        first.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import database
+import keepalive
+import migrate
+
+
+class DatabaseTests(object):
+    """
+    Backend-independent tests for the storage interface; see the subclasses below. The Postgres backend is covered by
+    running these against `DATABASE_URL` if it's set.
+    """
+
+    def connect(self, readonly=False):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.db = self.connect()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_get_missing_data(self):
+        with self.assertRaises(KeyError):
+            self.db.get_data(str(uuid.uuid4()))
+
+    def test_set_data_batch_last_value_wins(self):
+        key = str(uuid.uuid4())
+        self.db.set_data_batch([(key, b"first"), (key, b"second")])
+        status = self.db.get_data(key)
+        self.assertEqual(status.data, b"second")
+        self.assertIsNone(status.update_interval)
+        self.assertIsNotNone(status.last_modified.tzinfo)
+
+    def test_update_interval(self):
+        key = str(uuid.uuid4())
+        self.db.set_data(key, b"first")
+        time.sleep(0.05)
+        self.db.set_data(key, b"second")
+        self.assertGreater(self.db.get_data(key).update_interval, 0)
+
+    def test_get_image(self):
+        key = str(uuid.uuid4())
+        data = bytes([0xFF, 0x00, 0x08, 0x00, 0x00, 0x02, 0x00, 0x00, 16, 0, 0, 0, 18, 0, 0, 0]) + b"abcde"
+        self.db.set_data(key, data)
+        self.assertEqual(self.db.get_image(key, 0).data, b"ab")
+        self.assertEqual(self.db.get_image(key, 1).data, b"cde")
+        with self.assertRaises(KeyError):
+            self.db.get_image(key, 2)
+
+    def test_register_device(self):
+        token = uuid.uuid4().hex
+        self.db.register_device(token, use_sandbox=True)
+        self.db.register_device(token, use_sandbox=False, min_age=60)
+        reader = self.connect(readonly=True)
+        self.assertIn({"token": token, "use_sandbox": False}, reader.get_devices())
+        reader.close()
+        self.db.delete_device(token)
+        self.assertNotIn(token, [device["token"] for device in self.db.get_devices()])
+
+    def test_get_devices_by_slot(self):
+        tokens = [uuid.uuid4().hex for _ in range(20)]
+        for token in tokens:
+            self.db.register_device(token)
+        for slot in range(4):
+            devices = [device["token"] for device in self.db.get_devices(slot=slot, slots=4)]
+            self.assertEqual(sorted(token for token in devices if token in tokens),
+                             sorted(token for token in tokens if keepalive.get_slot(token, 4) == slot))
+
+    def test_acquire_rate_limit_token(self):
+        key = str(uuid.uuid4())
+        self.assertEqual(self.db.acquire_rate_limit_token(key, rate=0.001, burst=2), 0)
+        self.assertEqual(self.db.acquire_rate_limit_token(key, rate=0.001, burst=2), 0)
+        self.assertGreater(self.db.acquire_rate_limit_token(key, rate=0.001, burst=2), 0)
+
+    def test_get_keys(self):
+        keys = [str(uuid.uuid4()) for _ in range(5)]
+        self.db.set_data_batch([(key, b"data") for key in keys])
+        pages = []
+        after = None
+        while True:
+            page = self.db.get_keys(after=after, limit=2)
+            if not page:
+                break
+            self.assertLessEqual(len(page), 2)
+            pages.append(page)
+            after = page[-1]
+        all_keys = [key for page in pages for key in page]
+        self.assertEqual(len(all_keys), len(set(all_keys)))
+        self.assertTrue(set(keys) <= set(all_keys))
+
+    def test_try_lock_scheduler(self):
+        first, second = self.connect(), self.connect()
+        try:
+            self.assertTrue(first.try_lock_scheduler())
+            self.assertTrue(first.try_lock_scheduler())
+            self.assertFalse(second.try_lock_scheduler())
+            first.close()
+            self.assertTrue(second.try_lock_scheduler())
+        finally:
+            second.close()
+
+    def test_status(self):
+        self.db.set_data(str(uuid.uuid4()), b"data")
+        status = self.db.status()
+        self.assertGreaterEqual(status["statusCount"], 1)
+        self.assertGreaterEqual(status["statusSize"], 4)
+
+
+class TestMemoryDatabase(DatabaseTests, unittest.TestCase):
+
+    def connect(self, readonly=False):
+        return database.connect("memory://test", readonly=readonly)
+
+
+class TestSQLiteDatabase(DatabaseTests, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+    def connect(self, readonly=False):
+        return database.connect("sqlite://" + os.path.join(self.directory, "statuspanel.sqlite"), readonly=readonly)
+
+
+class TestSQLiteURLs(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_paths(self):
+        path = os.path.join(self.directory, "status?panel%.sqlite")
+        for database_url in ["sqlite://" + path, "sqlite:///" + path]:
+            db = database.connect(database_url)
+            db.set_data("key", b"data")
+            db.close()
+            reader = database.connect(database_url, readonly=True)
+            self.assertEqual(reader.get_data("key").data, b"data")
+            reader.close()
+        self.assertTrue(os.path.exists(path))
+
+
+@unittest.skipUnless(os.environ.get("DATABASE_URL", "").startswith("postgres"), "DATABASE_URL is not a Postgres URL")
+class TestPostgresDatabase(DatabaseTests, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        migrate.migrate(os.environ["DATABASE_URL"])
+
+    def connect(self, readonly=False):
+        return database.connect(readonly=readonly)
+
+
+if __name__ == "__main__":
+    unittest.main()
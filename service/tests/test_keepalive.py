@@ -0,0 +1,94 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import os
+import sys
+import unittest
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import helpers
+import keepalive
+
+
+class TestKeepaliveScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.Clock()
+        self.sent = []
+        self.scheduler = keepalive.KeepaliveScheduler(send=self.send, slots=60, interval=60 * 60, clock=self.clock)
+
+    def send(self, slot, slots):
+        self.sent.append(slot)
+        return 2
+
+    def test_slots_are_stable_and_spread(self):
+        tokens = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(6000)]
+        slots = [keepalive.get_slot(token, 60) for token in tokens]
+        self.assertEqual(slots, [keepalive.get_slot(token, 60) for token in tokens])
+        counts = [slots.count(slot) for slot in range(60)]
+        self.assertGreater(min(counts), 50)
+        self.assertLess(max(counts), 150)
+
+    def test_one_slot_per_minute(self):
+        for minute in range(120):
+            self.clock.time = minute * 60 + 1
+            self.scheduler.run()
+        self.assertEqual(self.sent, list(range(60)) * 2)
+
+    def test_repeat_runs_are_ignored(self):
+        self.clock.time = 61
+        self.scheduler.run()
+        self.scheduler.run()
+        self.assertEqual(self.sent, [1])
+
+    def test_missed_slots_are_sent(self):
+        self.clock.time = 59 * 60
+        self.scheduler.run()
+        self.clock.time = 62 * 60
+        self.scheduler.run()
+        self.assertEqual(self.sent, [59, 0, 1, 2])
+
+    def test_stats(self):
+        for minute in range(3):
+            self.clock.time = minute * 60
+            self.scheduler.run()
+        stats = self.scheduler.stats()
+        self.assertEqual(list(stats.keys()), ["0", "1", "2"])
+        self.assertEqual(stats["1"]["runs"], 1)
+        self.assertEqual(stats["1"]["devices"], 2)
+        self.assertGreaterEqual(stats["1"]["lastDurationMs"], 0)
+
+    def test_failures_are_recorded(self):
+        def send(slot, slots):
+            raise Exception("Failed")
+        scheduler = keepalive.KeepaliveScheduler(send=send, clock=self.clock)
+        scheduler.run()
+        self.assertEqual(scheduler.stats()["0"]["failures"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,214 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import unittest
+
+import psycopg2
+import psycopg2.errors
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import database
+import migrate
+
+
+class Cursor(object):
+    """
+    Records the statements executed on a `Connection`, answering the handful of queries the migrator makes itself.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, parameters=None):
+        self.connection.statements.append(sql)
+        if sql.startswith("SELECT pg_try_advisory_lock"):
+            self.result = (self.connection.locks.pop(0) if self.connection.locks else True, )
+        elif sql.startswith("SELECT to_regclass"):
+            self.result = (True, )
+        elif sql.startswith("SELECT value FROM metadata"):
+            self.result = (self.connection.version, )
+        elif sql.startswith("UPDATE metadata"):
+            self.connection.pending_version = parameters[0]
+        elif sql == "COMMIT" and self.connection.pending_version is not None:
+            self.connection.version = self.connection.pending_version
+            self.connection.pending_version = None
+        elif sql == "ROLLBACK":
+            self.connection.pending_version = None
+
+    def fetchone(self):
+        return self.result
+
+
+class Connection(object):
+
+    def __init__(self, version=0, locks=None):
+        self.version = version
+        self.pending_version = None
+        self.locks = locks or []
+        self.statements = []
+        self.autocommit = False
+
+    def cursor(self):
+        return Cursor(self)
+
+
+def timeout(count):
+    """
+    Returns a migration step that times out waiting for a lock `count` times before succeeding.
+    """
+    def step(cursor):
+        cursor.execute("ALTER TABLE example")
+        if step.failures < count:
+            step.failures += 1
+            raise psycopg2.errors.LockNotAvailable("canceling statement due to lock timeout")
+    step.failures = 0
+    return step
+
+
+def alter_table(cursor):
+    cursor.execute("ALTER TABLE example")
+
+
+def create_index(cursor):
+    cursor.execute("CREATE INDEX CONCURRENTLY example_index ON example (value)")
+
+
+def backfill(cursor, position, batch_size):
+    position = (position or 0) + batch_size
+    cursor.execute(f"UPDATE example {position}")
+    return position if position < 5 else None
+
+
+class TestMigrator(unittest.TestCase):
+
+    def migrator(self, connection, migrations, **kwargs):
+        self.sleeps = []
+        return migrate.Migrator(connection, migrations=migrations, sleep=self.sleeps.append, **kwargs)
+
+    def test_applies_outstanding_migrations(self):
+        connection = Connection(version=1)
+        results = self.migrator(connection, {1: alter_table, 2: alter_table, 3: alter_table}).run()
+        self.assertEqual([(version, name, attempts) for version, name, _, attempts in results],
+                         [(2, "alter_table", 1), (3, "alter_table", 1)])
+        self.assertEqual(connection.version, 3)
+        self.assertEqual(len([statement for statement in connection.statements
+                              if statement.startswith("INSERT INTO migration_log")]), 2)
+        self.assertFalse(connection.autocommit)
+
+    def test_up_to_date(self):
+        connection = Connection(version=2)
+        self.assertEqual(self.migrator(connection, {1: alter_table, 2: alter_table}).run(), [])
+        self.assertNotIn("ALTER TABLE example", connection.statements)
+        self.assertEqual(connection.statements[-1], "SELECT pg_advisory_unlock(%s)")
+
+    def test_transactional_steps_set_timeouts(self):
+        connection = Connection()
+        self.migrator(connection, {1: alter_table}, lock_timeout="1s").run()
+        index = connection.statements.index("ALTER TABLE example")
+        self.assertEqual(connection.statements[index - 3:index],
+                         ["BEGIN", "SET LOCAL lock_timeout = %s", "SET LOCAL statement_timeout = %s"])
+        self.assertEqual(connection.statements[index + 1:index + 3], ["UPDATE metadata SET value=%s WHERE key=%s",
+                                                                      "COMMIT"])
+
+    def test_retries_lock_timeouts(self):
+        connection = Connection()
+        step = timeout(2)
+        results = self.migrator(connection, {1: step}, retry_interval=1).run()
+        self.assertEqual(results[0][3], 3)
+        self.assertEqual(self.sleeps, [1, 2])
+        self.assertEqual(connection.statements.count("ROLLBACK"), 2)
+        self.assertEqual(connection.version, 1)
+
+    def test_gives_up_after_attempts(self):
+        connection = Connection()
+        with self.assertRaises(migrate.MigrationError):
+            self.migrator(connection, {1: alter_table, 2: timeout(5)}, attempts=3).run()
+        self.assertEqual(connection.version, 1)
+        self.assertEqual(connection.statements[-1], "SELECT pg_advisory_unlock(%s)")
+
+    def test_waits_for_lock(self):
+        connection = Connection(locks=[False, False])
+        self.migrator(connection, {1: alter_table}).run()
+        self.assertEqual(connection.statements.count("SELECT pg_try_advisory_lock(%s)"), 3)
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_lock_wait_timeout(self):
+        connection = Connection(locks=[False] * 10)
+        with self.assertRaises(migrate.MigrationError):
+            self.migrator(connection, {1: alter_table}, lock_wait=0).run()
+        self.assertNotIn("ALTER TABLE example", connection.statements)
+
+    def test_concurrent_steps_run_outside_transactions(self):
+        connection = Connection()
+        self.migrator(connection, {1: database.Concurrently(create_index)}).run()
+        self.assertTrue(any(statement.startswith("INSERT INTO migration_log") for statement in connection.statements))
+        index = connection.statements.index("CREATE INDEX CONCURRENTLY example_index ON example (value)")
+        self.assertEqual(connection.statements[index - 2:index], ["SET lock_timeout = %s", "SET statement_timeout = 0"])
+        self.assertEqual(connection.statements[index + 1:index + 4], ["RESET lock_timeout",
+                                                                      "RESET statement_timeout",
+                                                                      "BEGIN"])
+        self.assertEqual(connection.version, 1)
+
+    def test_backfills_run_in_batches(self):
+        connection = Connection()
+        self.migrator(connection, {1: database.Backfill(backfill, batch_size=2)}).run()
+        updates = [statement for statement in connection.statements if statement.startswith("UPDATE example")]
+        self.assertEqual(updates, ["UPDATE example 2", "UPDATE example 4", "UPDATE example 6"])
+        for update in updates:
+            index = connection.statements.index(update)
+            self.assertEqual(connection.statements[index + 1], "COMMIT")
+        self.assertEqual(connection.version, 1)
+
+    def test_schema_version_matches_migrations(self):
+        self.assertEqual(max(database.PostgresDatabase.MIGRATIONS), database.PostgresDatabase.SCHEMA_VERSION)
+
+
+@unittest.skipUnless(os.environ.get("DATABASE_URL", "").startswith("postgres"), "DATABASE_URL is not a Postgres URL")
+class TestPostgresMigration(unittest.TestCase):
+
+    def test_migrate(self):
+        migrate.migrate(os.environ["DATABASE_URL"])
+        migrate.migrate(os.environ["DATABASE_URL"])
+        connection = psycopg2.connect(os.environ["DATABASE_URL"])
+        try:
+            with connection.cursor() as cursor:
+                self.assertEqual(database.get_schema_version(cursor), database.PostgresDatabase.SCHEMA_VERSION)
+        finally:
+            connection.close()
+        database.connect(os.environ["DATABASE_URL"]).close()
+
+
+if __name__ == "__main__":
+    unittest.main()
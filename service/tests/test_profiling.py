@@ -0,0 +1,129 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+import werkzeug.routing
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import profiling
+
+
+URL_MAP = werkzeug.routing.Map([werkzeug.routing.Rule("/api/v3/status/<identifier>")])
+
+
+def slow_handler():
+    time.sleep(0.05)
+
+
+def app(environ, start_response):
+    slow_handler()
+    start_response("200 OK", [])
+    return [b""]
+
+
+def make_environ(path="/api/v3/status/example", **headers):
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "SERVER_NAME": "localhost", "SERVER_PORT": "80",
+               "wsgi.url_scheme": "http"}
+    environ.update(headers)
+    return environ
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = profiling.Profiler(token="secret", sample_rate=1.0, interval=0.001)
+        self.middleware = profiling.ProfilerMiddleware(app, URL_MAP, self.profiler)
+
+    def tearDown(self):
+        self.profiler.stop()
+
+    def request(self, environ):
+        return self.middleware(environ, lambda status, headers: None)
+
+    def test_stopped(self):
+        self.request(make_environ())
+        self.assertEqual(self.profiler.dump(), "")
+        self.assertEqual(self.profiler.stats["requests"], 0)
+        self.assertIsNone(self.profiler._thread)
+
+    def test_sampled_requests(self):
+        self.profiler.start()
+        self.request(make_environ())
+        stacks = self.profiler.dump().splitlines()
+        self.assertTrue(stacks)
+        for line in stacks:
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(stack.startswith("GET /api/v3/status/<identifier>;app (test_profiling.py:"))
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any("slow_handler (test_profiling.py:" in line for line in stacks))
+        self.assertFalse(any("__call__" in line for line in stacks))
+        self.assertEqual(self.profiler.stats["requests"], 1)
+
+    def test_sample_rate(self):
+        self.profiler.sample_rate = 0.0
+        self.profiler.start()
+        self.request(make_environ())
+        self.assertEqual(self.profiler.stats["requests"], 0)
+
+    def test_token_header(self):
+        self.request(make_environ(HTTP_X_PROFILE_TOKEN="secret"))
+        self.assertEqual(self.profiler.stats["requests"], 1)
+        self.assertIn("slow_handler", self.profiler.dump())
+        self.assertFalse(self.profiler._wake.is_set())
+
+    def test_invalid_token_header(self):
+        self.request(make_environ(HTTP_X_PROFILE_TOKEN="incorrect"))
+        self.assertEqual(self.profiler.stats["requests"], 0)
+
+    def test_unknown_route(self):
+        self.request(make_environ("/unknown", HTTP_X_PROFILE_TOKEN="secret"))
+        self.assertTrue(self.profiler.dump().startswith("GET unknown;"))
+
+    def test_reset(self):
+        self.request(make_environ(HTTP_X_PROFILE_TOKEN="secret"))
+        self.profiler.reset()
+        self.assertEqual(self.profiler.dump(), "")
+        self.assertEqual(self.profiler.stats["samples"], 0)
+
+    def test_toggle(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "profile.txt")
+            self.profiler.toggle(path)
+            self.assertTrue(self.profiler.running)
+            self.request(make_environ())
+            self.profiler.toggle(path)
+            self.assertFalse(self.profiler.running)
+            with open(path) as fh:
+                self.assertEqual(fh.read(), self.profiler.dump())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import http.server
+import os
+import sys
+import threading
+import unittest
+
+import werkzeug
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import proxycache
+
+
+class StubCache(http.server.BaseHTTPRequestHandler):
+
+    requests = []
+    status = 200
+
+    def do_PURGE(self):
+        StubCache.requests.append((self.path, self.headers["Surrogate-Key"]))
+        self.send_response(StubCache.status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPurger(unittest.TestCase):
+
+    def setUp(self):
+        StubCache.requests = []
+        StubCache.status = 200
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubCache)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.purger = proxycache.Purger("http://127.0.0.1:%d/" % self.server.server_address[1])
+
+    def tearDown(self):
+        self.purger.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_purge(self):
+        self.purger.purge("abcdefgh", image_count=2).result()
+        self.assertEqual(StubCache.requests, [("/api/v2/abcdefgh", "status-abcdefgh"),
+                                              ("/api/v3/status/abcdefgh", "status-abcdefgh"),
+                                              ("/api/v3/status/abcdefgh/image/0", "status-abcdefgh"),
+                                              ("/api/v3/status/abcdefgh/image/1", "status-abcdefgh")])
+        self.assertEqual(self.purger.stats, {"purges": 4, "errors": 0})
+
+    def test_purge_missing_entry(self):
+        StubCache.status = 404
+        self.purger.purge("abcdefgh").result()
+        self.assertEqual(self.purger.stats, {"purges": 2, "errors": 0})
+
+    def test_purge_failure(self):
+        StubCache.status = 500
+        self.purger.purge("abcdefgh").result()
+        self.assertEqual(self.purger.stats, {"purges": 0, "errors": 2})
+
+
+class TestCacheHeaders(unittest.TestCase):
+
+    def test_set_cache_headers(self):
+        response = werkzeug.wrappers.Response(b"data")
+        response.cache_control.max_age = 30
+        proxycache.set_cache_headers(response, "abcdefgh", 3600)
+        self.assertEqual(sorted(response.headers["Cache-Control"].split(", ")), ["max-age=30", "public", "s-maxage=3600"])
+        self.assertEqual(response.headers["Surrogate-Key"], "status-abcdefgh")
+
+
+if __name__ == "__main__":
+    unittest.main()
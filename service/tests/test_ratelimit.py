@@ -0,0 +1,90 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import unittest
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import helpers
+import ratelimit
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.Clock()
+        self.limiter = ratelimit.RateLimiter(rate=2, burst=3, clock=self.clock)
+
+    def test_burst_admitted(self):
+        for _ in range(3):
+            self.assertEqual(self.limiter.acquire("a"), 0, "Requests within the burst are admitted")
+        self.assertAlmostEqual(self.limiter.acquire("a"), 0.5, msg="Requests beyond the burst are rejected")
+
+    def test_refill(self):
+        for _ in range(3):
+            self.limiter.acquire("a")
+        self.clock.time += 0.5
+        self.assertEqual(self.limiter.acquire("a"), 0, "Bucket refills over time")
+        self.assertNotEqual(self.limiter.acquire("a"), 0, "Refill is limited by rate")
+
+    def test_rejections_do_not_consume_tokens(self):
+        for _ in range(3):
+            self.limiter.acquire("a")
+        for _ in range(10):
+            self.limiter.acquire("a")
+        self.clock.time += 0.5
+        self.assertEqual(self.limiter.acquire("a"), 0, "Rejected requests don't delay recovery")
+
+    def test_keys_are_independent(self):
+        for _ in range(3):
+            self.limiter.acquire("a")
+        self.assertNotEqual(self.limiter.acquire("a"), 0)
+        self.assertEqual(self.limiter.acquire("b"), 0, "Other keys are unaffected")
+
+    def test_prune(self):
+        limiter = ratelimit.RateLimiter(rate=1, burst=1, max_keys=10, clock=self.clock)
+        for i in range(10):
+            limiter.acquire(str(i))
+        self.clock.time += 1
+        limiter.acquire("x")
+        self.assertEqual(len(limiter._buckets), 1, "Refilled buckets are pruned")
+        self.assertNotEqual(limiter.acquire("x"), 0, "Active buckets survive pruning")
+
+
+class TestConcurrencyLimiter(unittest.TestCase):
+
+    def test_limit(self):
+        limiter = ratelimit.ConcurrencyLimiter(2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire(), "Requests beyond the limit are rejected")
+        limiter.release()
+        self.assertTrue(limiter.acquire(), "Capacity is returned on release")
+
+
+if __name__ == "__main__":
+    unittest.main()
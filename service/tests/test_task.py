@@ -0,0 +1,72 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import unittest
+import uuid
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import database
+import task
+
+
+class TestSchedulerLock(unittest.TestCase):
+
+    def setUp(self):
+        self.url = "memory://" + uuid.uuid4().hex
+        self.locks = [task.SchedulerLock(lambda: database.connect(self.url)) for _ in range(2)]
+
+    def tearDown(self):
+        for lock in self.locks:
+            lock.close()
+
+    def test_runs_in_a_single_process(self):
+        calls = []
+        for _ in range(3):
+            for lock in self.locks:
+                lock.run(calls.append, lock)
+        self.assertEqual(calls, [self.locks[0]] * 3)
+        self.assertTrue(self.locks[0].held)
+        self.assertFalse(self.locks[1].held)
+
+    def test_takes_over(self):
+        self.assertTrue(self.locks[0].acquire())
+        self.assertFalse(self.locks[1].acquire())
+        self.locks[0].close()
+        self.assertTrue(self.locks[1].acquire())
+
+    def test_connection_errors(self):
+        def connect():
+            raise database.OperationalError[0]("Connection refused")
+
+        lock = task.SchedulerLock(connect)
+        self.assertFalse(lock.acquire())
+        self.assertIsNone(lock.database)
+
+
+if __name__ == "__main__":
+    unittest.main()
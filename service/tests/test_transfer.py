@@ -0,0 +1,148 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import uuid
+
+import psycopg2
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import database
+import migrate
+import transfer
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_postgres(self):
+        with self.assertRaises(transfer.TransferError):
+            transfer.export("sqlite://" + os.path.join(self.directory, "statuspanel.sqlite"), self.directory)
+
+    def test_import_requires_export(self):
+        with self.assertRaises(transfer.TransferError):
+            transfer.import_("postgresql://localhost/statuspanel", self.directory)
+
+    def test_import_requires_complete_export(self):
+        transfer.save_manifest(self.directory, {"schemaVersion": database.PostgresDatabase.SCHEMA_VERSION,
+                                                "since": None,
+                                                "until": None,
+                                                "tables": {"data": {"columns": transfer.TABLES["data"].columns,
+                                                                    "chunks": [],
+                                                                    "complete": False}}})
+        with self.assertRaises(transfer.TransferError):
+            transfer.import_("postgresql://localhost/statuspanel", self.directory)
+
+    def test_conditions(self):
+        conditions, parameters = transfer.get_conditions(transfer.TABLES["data"], "2024-01-01", None, "key")
+        self.assertEqual(conditions, "TRUE AND last_modified >= %s AND id > %s")
+        self.assertEqual(parameters, ["2024-01-01", "key"])
+
+
+@unittest.skipUnless(os.environ.get("DATABASE_URL", "").startswith("postgres"), "DATABASE_URL is not a Postgres URL")
+class TestPostgresTransfer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        migrate.migrate(os.environ["DATABASE_URL"])
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = database.connect(os.environ["DATABASE_URL"])
+        # Use the database's clock to select the statuses created by each test.
+        connection = psycopg2.connect(os.environ["DATABASE_URL"])
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT current_timestamp")
+                self.since = cursor.fetchone()[0].isoformat()
+        finally:
+            connection.close()
+        self.keys = [str(uuid.uuid4()) for _ in range(5)]
+        self.values = {key: bytes([0xFF, 0x00, 0x08, 0x00, 0x00, 0x02, 0x00, 0x00, 16, 0, 0, 0, 18, 0, 0, 0]) + os.urandom(5)
+                       for key in self.keys}
+        self.db.set_data_batch(self.values.items())
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        manifest = transfer.export(os.environ["DATABASE_URL"], self.directory, tables=["data"], since=self.since,
+                                   chunk_size=2)
+        self.assertEqual(sum(chunk["rows"] for chunk in manifest["tables"]["data"]["chunks"]), len(self.keys))
+        self.assertEqual(len(manifest["tables"]["data"]["chunks"]), 3)
+        self.db.delete_rows(self.db.get_rows(self.keys))
+        changed = transfer.import_(os.environ["DATABASE_URL"], self.directory)
+        self.assertEqual(changed["data"], len(self.keys))
+        for key, value in self.values.items():
+            self.assertEqual(self.db.get_data(key).data, value)
+        self.assertEqual(self.db.get_image(self.keys[0], 1).data, self.values[self.keys[0]][18:])
+
+        # Importing again is a no-op.
+        self.assertEqual(transfer.import_(os.environ["DATABASE_URL"], self.directory)["data"], 0)
+
+    def test_resume(self):
+        transfer.export(os.environ["DATABASE_URL"], self.directory, tables=["data"], since=self.since, chunk_size=2)
+        manifest = transfer.load_manifest(self.directory)
+        manifest["tables"]["data"]["chunks"] = manifest["tables"]["data"]["chunks"][:1]
+        manifest["tables"]["data"]["complete"] = False
+        transfer.save_manifest(self.directory, manifest)
+        manifest = transfer.export(os.environ["DATABASE_URL"], self.directory, tables=["data"], since=self.since,
+                                   chunk_size=2)
+        self.assertEqual(sum(chunk["rows"] for chunk in manifest["tables"]["data"]["chunks"]), len(self.keys))
+
+    def test_schema_mismatch(self):
+        transfer.export(os.environ["DATABASE_URL"], self.directory, tables=["data"], since=self.since)
+        manifest = transfer.load_manifest(self.directory)
+        manifest["schemaVersion"] -= 1
+        transfer.save_manifest(self.directory, manifest)
+        with self.assertRaises(transfer.TransferError):
+            transfer.import_(os.environ["DATABASE_URL"], self.directory)
+
+    def test_import_connection_tolerates_concurrent_writes(self):
+        connection = transfer.connect(os.environ["DATABASE_URL"])
+        try:
+            with database.Transaction(connection) as cursor:
+                cursor.execute("SELECT count(*) FROM data")
+                self.db.set_data_batch([(self.keys[0], self.values[self.keys[0]])])
+                # Would raise a serialization failure if imports ran at REPEATABLE READ.
+                cursor.execute("UPDATE data SET last_modified = last_modified WHERE id = %s", (self.keys[0],))
+                self.assertEqual(cursor.rowcount, 1)
+        finally:
+            connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
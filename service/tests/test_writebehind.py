@@ -0,0 +1,155 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import threading
+import unittest
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(TESTS_DIR)
+WEB_SERVICE_DIR = os.path.join(SERVICE_DIR, "web", "src")
+
+sys.path.append(WEB_SERVICE_DIR)
+
+import writebehind
+
+
+class Database(object):
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.batches = []
+        self.written = threading.Event()
+
+    def set_data_batch(self, items):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Connection lost")
+        self.batches.append(items)
+        self.written.set()
+
+    def close(self):
+        pass
+
+
+class TestWriteBehindBuffer(unittest.TestCase):
+
+    def test_coalesces_uploads(self):
+        database = Database()
+        buffer = writebehind.WriteBehindBuffer(lambda: database, interval=60, max_pending=10)
+        self.assertTrue(buffer.put("a", b"1"))
+        self.assertTrue(buffer.put("b", b"2"))
+        self.assertTrue(buffer.put("a", b"3"))
+        buffer.close()
+        self.assertEqual(database.batches, [[("b", b"2"), ("a", b"3")]])
+        self.assertEqual(buffer.stats["coalesced"], 1)
+        self.assertEqual(buffer.stats["written"], 2)
+
+    def test_writes_after_interval(self):
+        database = Database()
+        buffer = writebehind.WriteBehindBuffer(lambda: database, interval=0.01, max_pending=10)
+        self.assertTrue(buffer.put("a", b"1"))
+        self.assertTrue(database.written.wait(5))
+        self.assertEqual(database.batches, [[("a", b"1")]])
+        buffer.close()
+
+    def test_rejects_when_full(self):
+        database = Database()
+        buffer = writebehind.WriteBehindBuffer(lambda: database, interval=60, max_pending=2)
+        self.assertTrue(buffer.put("a", b"1"))
+        self.assertTrue(buffer.put("b", b"2"))
+        self.assertFalse(buffer.put("c", b"3"))
+        self.assertTrue(buffer.put("a", b"4"))  # Coalescing doesn't need space.
+        buffer.close()
+        self.assertEqual(buffer.stats["rejected"], 1)
+        self.assertFalse(buffer.put("d", b"5"))
+
+    def test_queues_uploads_being_written_when_full(self):
+        database = Database()
+        writing, proceed = threading.Event(), threading.Event()
+        set_data_batch = database.set_data_batch
+
+        def blocking_set_data_batch(items):
+            writing.set()
+            proceed.wait(5)
+            set_data_batch(items)
+
+        database.set_data_batch = blocking_set_data_batch
+        buffer = writebehind.WriteBehindBuffer(lambda: database, interval=0, max_pending=1)
+        self.assertTrue(buffer.put("a", b"1"))
+        self.assertTrue(writing.wait(5))
+        self.assertTrue(buffer.put("b", b"2"))
+        self.assertFalse(buffer.put("c", b"3"))
+        # The newer upload must be written after the batch containing the older one.
+        self.assertTrue(buffer.put("a", b"4"))
+        proceed.set()
+        buffer.close()
+        self.assertEqual(database.batches, [[("a", b"1")], [("b", b"2"), ("a", b"4")]])
+
+    def test_on_write(self):
+        database = Database()
+        written = []
+        buffer = writebehind.WriteBehindBuffer(lambda: database, interval=60, max_pending=10, on_write=written.append)
+        buffer.put("a", b"1")
+        buffer.close()
+        self.assertEqual(written, [{"a": b"1"}])
+
+    def test_contains_until_written(self):
+        database = Database()
+        contained = []
+        buffer = writebehind.WriteBehindBuffer(lambda: database, interval=60, max_pending=10,
+                                               on_write=lambda batch: contained.append("a" in buffer))
+        buffer.put("a", b"1")
+        self.assertIn("a", buffer)
+        self.assertNotIn("b", buffer)
+        buffer.close()
+        self.assertEqual(contained, [True])
+        self.assertNotIn("a", buffer)
+
+    def test_survives_on_write_errors(self):
+        database = Database()
+
+        def on_write(batch):
+            raise Exception("Purge failed")
+
+        buffer = writebehind.WriteBehindBuffer(lambda: database, interval=0, max_pending=10, on_write=on_write)
+        with self.assertLogs(level="ERROR"):
+            self.assertTrue(buffer.put("a", b"1"))
+            self.assertTrue(database.written.wait(5))
+            database.written.clear()
+            self.assertTrue(buffer.put("b", b"2"))
+            self.assertTrue(database.written.wait(5))
+        buffer.close()
+        self.assertEqual(database.batches, [[("a", b"1")], [("b", b"2")]])
+
+    def test_retries_failed_writes(self):
+        database = Database(failures=1)
+        buffer = writebehind.WriteBehindBuffer(lambda: database, interval=0, max_pending=10, retry_interval=0.01)
+        self.assertTrue(buffer.put("a", b"1"))
+        self.assertTrue(database.written.wait(5))
+        buffer.close()
+        self.assertEqual(database.batches, [[("a", b"1")]])
+        self.assertEqual(buffer.stats["errors"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,9 +23,13 @@ import datetime
 import errno
 import functools
 import logging
+import math
 import os
 import re
+import signal
 import sys
+import tempfile
+import threading
 import time
 
 # Monkey patch collections to work around legacy behaviour in gobiko and dateutil.
@@ -35,11 +39,12 @@ collections.Mapping = collections.abc.Mapping
 collections.MutableSet = collections.abc.MutableSet
 collections.MutableMapping = collections.abc.MutableMapping
 
-import psycopg2
 import werkzeug
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Flask, send_from_directory, request, redirect, abort, jsonify, g, make_response
+from werkzeug.http import quote_etag
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 import collections.abc
 collections.Iterable = collections.abc.Iterable
@@ -48,8 +53,16 @@ collections.MutableSet = collections.abc.MutableSet
 collections.MutableMapping = collections.abc.MutableMapping
 
 import apns
+import cache
+import capture
 import database
+import keepalive
+import payload
+import profiling
+import proxycache
+import ratelimit
 import task
+import writebehind
 
 logging.basicConfig(level=logging.INFO,
                     format="[%(asctime)s] [%(process)d] [%(levelname)s] %(message)s",
@@ -61,6 +74,69 @@ VERSION_PATH = os.path.join(SERVICE_DIRECTORY, "VERSION")
 
 LEGACY_IDENTIFIER = "A0198E25-8436-4439-8BE1-75C445655255"
 
+# Per-identifier, per-client rate limiting. The backend is one of 'memory' (per-worker), 'database' (shared across
+# workers using an unlogged table), or 'none'.
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", "1"))  # Requests per second.
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "60"))
+
+# Shared rate limit buckets are only purged once they'd have refilled (plus a margin for clock skew and slow purges);
+# purging a bucket any sooner would reset it.
+RATE_LIMIT_MAX_AGE = RATE_LIMIT_BURST / RATE_LIMIT_RATE + 60 * 60
+
+# The maximum number of requests each worker will handle concurrently before shedding load (0 is unlimited).
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "0"))
+
+# How long a worker remembers that an identifier has no status, answering repeat polls from unpaired devices without a
+# database query (0 disables the cache). Uploads clear entries on the worker that handles them immediately; other
+# workers may continue to report the identifier as missing for at most this long.
+NEGATIVE_CACHE_TTL = float(os.environ.get("NEGATIVE_CACHE_TTL", "30"))
+
+# Bounds for the polling interval suggested to devices using 'Cache-Control: max-age'. Within these, the suggestion is a
+# fraction of the average time between uploads for that identifier, so rarely updated devices poll rarely.
+POLL_INTERVAL_MIN = int(os.environ.get("POLL_INTERVAL_MIN", "30"))
+POLL_INTERVAL_MAX = int(os.environ.get("POLL_INTERVAL_MAX", "600"))
+POLL_INTERVAL_FRACTION = float(os.environ.get("POLL_INTERVAL_FRACTION", "0.1"))
+
+# Optional write-behind for uploads: when set, uploads are acknowledged once queued in memory and written to the database
+# in batches every WRITE_BEHIND_INTERVAL milliseconds (0 disables write-behind). Queued uploads can be lost if a worker
+# exits uncleanly, and aren't visible to downloads until written. Uploads are written synchronously whenever more than
+# WRITE_BEHIND_MAX_PENDING identifiers are queued.
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", "0"))
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get("WRITE_BEHIND_MAX_PENDING", "10000"))
+
+# How long a worker remembers device registrations, skipping the database entirely when an app re-registers the same
+# token with the same settings (0 disables the cache). Devices are purged after 30 days without registering, so this
+# must be significantly shorter than that.
+REGISTRATION_CACHE_TTL = float(os.environ.get("REGISTRATION_CACHE_TTL", str(60 * 60 * 24)))
+
+# Keepalive pushes are spread across the hour by sending to one of KEEPALIVE_SLOTS groups of devices at a time.
+KEEPALIVE_INTERVAL = 60 * 60
+KEEPALIVE_SLOTS = int(os.environ.get("KEEPALIVE_SLOTS", "60"))
+
+# Optional integration with a shared cache (e.g., nginx or Varnish) in front of the service: statuses may be cached for
+# up to PROXY_CACHE_MAX_AGE seconds (0 disables shared caching), and are purged using PURGE requests to
+# PROXY_CACHE_PURGE_URL whenever they're updated.
+PROXY_CACHE_MAX_AGE = int(os.environ.get("PROXY_CACHE_MAX_AGE", "0"))
+PROXY_CACHE_PURGE_URL = os.environ.get("PROXY_CACHE_PURGE_URL", "")
+
+# Optional traffic capture for replaying with 'benchmarks/replay.py': a CAPTURE_SAMPLE_RATE fraction of identifiers
+# (and other requests) are recorded, anonymised, to CAPTURE_PATH. Workers only hash identifiers consistently if
+# CAPTURE_SALT is set.
+CAPTURE_PATH = os.environ.get("CAPTURE_PATH", "")
+CAPTURE_SAMPLE_RATE = float(os.environ.get("CAPTURE_SAMPLE_RATE", "0.01"))
+CAPTURE_SALT = os.environ.get("CAPTURE_SALT")
+
+# Optional sampling profiler, enabled by setting PROFILER_TOKEN. While it's running (see the '/api/v3/service/profile'
+# routes, or send SIGUSR2 to a worker), a PROFILER_SAMPLE_RATE fraction of requests have their stacks sampled every
+# PROFILER_INTERVAL milliseconds; requests with an 'X-Profile-Token' header are always profiled.
+PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN", "")
+PROFILER_SAMPLE_RATE = float(os.environ.get("PROFILER_SAMPLE_RATE", "0.01"))
+PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", "5"))
+
+# The number of reverse proxies in front of the service whose X-Forwarded-For headers we trust.
+TRUSTED_PROXY_COUNT = int(os.environ.get("TRUSTED_PROXY_COUNT", "0"))
+
 
 # Read the version.
 METADATA = {
@@ -73,13 +149,16 @@ if os.path.exists(VERSION_PATH):
 logging.info("Starting service...")
 logging.info("Version %s", METADATA["version"])
 
-# Log the build details.
+# Log the build details (only available in release builds).
 build_number = METADATA["version"]
 date_string, sha_string = build_number[:10], build_number[10:]
-date = datetime.datetime.strptime(date_string, "%y%m%d%H%M")
-sha = "%06x" % int(sha_string)
-logging.info("%s (UTC)" % date)
-logging.info("https://github.com/inseven/statuspanel/commit/" + sha)
+try:
+    date = datetime.datetime.strptime(date_string, "%y%m%d%H%M")
+    sha = "%06x" % int(sha_string)
+    logging.info("%s (UTC)" % date)
+    logging.info("https://github.com/inseven/statuspanel/commit/" + sha)
+except ValueError:
+    logging.warning("Unable to parse build number '%s'.", build_number)
 
 
 # Check that we can create an APNS instance before proceeding.
@@ -105,12 +184,45 @@ else:
 app = Flask(__name__)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
-
-# Create a scheduler to run periodic tasks like database clean up and device notification.
+profiler = None
+if PROFILER_TOKEN:
+    profiler = profiling.Profiler(token=PROFILER_TOKEN,
+                                  sample_rate=PROFILER_SAMPLE_RATE,
+                                  interval=PROFILER_INTERVAL / 1000)
+    app.wsgi_app = profiling.ProfilerMiddleware(app.wsgi_app, app.url_map, profiler)
+    # Signal handlers can only be installed on the main thread, and shouldn't block it.
+    if threading.current_thread() is threading.main_thread():
+        profile_path = os.path.join(tempfile.gettempdir(), f"statuspanel-profile-{os.getpid()}.txt")
+        signal.signal(signal.SIGUSR2,
+                      lambda signum, frame: threading.Thread(target=profiler.toggle, args=(profile_path, )).start())
+if CAPTURE_PATH:
+    app.wsgi_app = capture.CaptureMiddleware(app.wsgi_app,
+                                             app.url_map,
+                                             path=CAPTURE_PATH,
+                                             sample_rate=CAPTURE_SAMPLE_RATE,
+                                             salt=CAPTURE_SALT)
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
+# Create a scheduler to run periodic tasks like database clean up and device notification. Every worker schedules them,
+# but they only run in the one holding the scheduler lock, so devices aren't sent a keepalive by each worker.
+keepalive_scheduler = keepalive.KeepaliveScheduler(send=task.send_keepalive_slot,
+                                                   slots=KEEPALIVE_SLOTS,
+                                                   interval=KEEPALIVE_INTERVAL)
+scheduler_lock = task.SchedulerLock(database.connect)
 scheduler = BackgroundScheduler()
-scheduler.add_job(func=task.run_periodic_tasks, trigger="interval", seconds=60 * 60)  # Runs every hour.
+scheduler.add_job(func=scheduler_lock.run,
+                  args=[task.run_periodic_tasks],
+                  kwargs={"rate_limit_max_age": RATE_LIMIT_MAX_AGE},
+                  trigger="interval",
+                  seconds=60 * 60)  # Runs every hour.
+scheduler.add_job(func=scheduler_lock.run,
+                  args=[keepalive_scheduler.run],
+                  trigger="interval",
+                  seconds=keepalive_scheduler.slot_duration)
 scheduler.start()
 atexit.register(lambda: scheduler.shutdown())
+atexit.register(scheduler_lock.close)
 
 
 def get_database():
@@ -118,9 +230,9 @@ def get_database():
         logging.info("Connecting to the database...")
         while True:
             try:
-                g.database = database.Database()
+                g.database = database.connect()
                 break
-            except psycopg2.OperationalError:
+            except database.OperationalError:
                 time.sleep(0.1)
     return g.database
 
@@ -133,6 +245,63 @@ def close_database(exception):
         db.close()
 
 
+if RATE_LIMIT_BACKEND == "memory":
+    rate_limiter = ratelimit.RateLimiter(rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST)
+elif RATE_LIMIT_BACKEND == "database":
+    rate_limiter = ratelimit.SharedRateLimiter(get_database, rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST)
+elif RATE_LIMIT_BACKEND == "none":
+    rate_limiter = None
+else:
+    raise ValueError(f"Unsupported rate limit backend '{RATE_LIMIT_BACKEND}'")
+
+concurrency_limiter = ratelimit.ConcurrencyLimiter(MAX_CONCURRENT_REQUESTS) if MAX_CONCURRENT_REQUESTS else None
+
+missing_identifiers = cache.TTLCache(ttl=NEGATIVE_CACHE_TTL) if NEGATIVE_CACHE_TTL else None
+registered_devices = cache.TTLCache(ttl=REGISTRATION_CACHE_TTL) if REGISTRATION_CACHE_TTL else None
+
+purger = None
+if PROXY_CACHE_PURGE_URL:
+    purger = proxycache.Purger(PROXY_CACHE_PURGE_URL)
+    atexit.register(purger.close)
+
+
+def purge(identifier, data):
+    if purger is None:
+        return
+    index = payload.parse_index(data)
+    purger.purge(identifier, image_count=len(index) if index is not None else 0)
+
+
+def on_upload_written(batch):
+    # Polls that arrived before the flush may have cached the status as missing, or the previous status in a proxy.
+    for identifier, data in batch.items():
+        if missing_identifiers is not None:
+            missing_identifiers.discard(identifier)
+        purge(identifier, data)
+
+
+upload_buffer = None
+if WRITE_BEHIND_INTERVAL:
+    # Cached statuses are only purged once the upload has been written, so caches can't pick up the previous status.
+    upload_buffer = writebehind.WriteBehindBuffer(database.connect,
+                                                  interval=WRITE_BEHIND_INTERVAL / 1000,
+                                                  max_pending=WRITE_BEHIND_MAX_PENDING,
+                                                  on_write=on_upload_written)
+    atexit.register(upload_buffer.close)
+
+
+def get_poll_interval(update_interval):
+    if update_interval is None:
+        return POLL_INTERVAL_MIN
+    return int(min(max(update_interval * POLL_INTERVAL_FRACTION, POLL_INTERVAL_MIN), POLL_INTERVAL_MAX))
+
+
+def retry_later(message, status, retry_after):
+    response = make_response(message, status)
+    response.headers.set("Retry-After", str(max(1, math.ceil(retry_after))))
+    return response
+
+
 # Valid identifiers are either 8-character strings comprising 0-9 and a-z, or
 # canonical UUID strings (hex digits structured as 8-4-4-4-12).
 SHORT_IDENTIFIER_REGEX = re.compile(r"^[0-9a-z]{8}$")
@@ -143,14 +312,34 @@ def check_identifier(fn):
     @functools.wraps(fn)
     def inner(*args, **kwargs):
         logging.info(f"Checking identifier '{kwargs['identifier']}'...")
-        if SHORT_IDENTIFIER_REGEX.match(kwargs['identifier']):
-            return fn(*args, **kwargs)
-        elif UUID_IDENTIFIER_REGEX.match(kwargs['identifier']):
+        if UUID_IDENTIFIER_REGEX.match(kwargs['identifier']):
             kwargs['identifier'] = kwargs['identifier'].lower()
-            return fn(*args, **kwargs)
-        else:
+        elif not SHORT_IDENTIFIER_REGEX.match(kwargs['identifier']):
             request.stream.read()
             return f"Invalid identifier '{kwargs['identifier']}'", 400
+        # Rate limiting uses the normalised identifier, so that changing the case of a UUID doesn't give a client a new
+        # bucket; it happens before anything else so that rejecting a misbehaving client is as cheap as possible.
+        if rate_limiter is not None:
+            retry_after = rate_limiter.acquire(f"{kwargs['identifier']} {request.remote_addr}")
+            if retry_after:
+                request.stream.read()
+                return retry_later("Too many requests", 429, retry_after)
+        return fn(*args, **kwargs)
+    return inner
+
+
+def limit_concurrency(fn):
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+        if concurrency_limiter is None:
+            return fn(*args, **kwargs)
+        if not concurrency_limiter.acquire():
+            request.stream.read()
+            return retry_later("Service busy", 503, 1)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            concurrency_limiter.release()
     return inner
 
 
@@ -162,22 +351,84 @@ def homepage():
 @app.route('/api/v2/<identifier>', methods=['POST'])
 @app.route('/api/v3/status/<identifier>', methods=['POST'])
 @check_identifier
+@limit_concurrency
 def upload(identifier):
-    get_database().set_data(identifier, request.files['file'].read())
+    data = request.files['file'].read()
+    if upload_buffer is None or not upload_buffer.put(identifier, data):
+        get_database().set_data(identifier, data)
+        purge(identifier, data)
+    if missing_identifiers is not None:
+        missing_identifiers.discard(identifier)
     return jsonify({})
 
 
+def get_status_etag(last_modified):
+    # Last-Modified only has a resolution of one second, so we also offer an ETag to ensure devices can't miss updates
+    # made in quick succession.
+    return "%x" % int(last_modified.timestamp() * 1000000)
+
+
+def make_status_response(identifier, data, last_modified, update_interval, etag):
+    poll_interval = get_poll_interval(update_interval)
+    response = make_response(data)
+    response.headers.set('Content-Type', 'application/octet-stream')
+    response.headers.set("Access-Control-Allow-Origin", "*")
+    response.last_modified = last_modified
+    response.set_etag(etag)
+    response.cache_control.max_age = poll_interval
+    response.expires = time.time() + poll_interval
+    # Only caches that are purged on upload may share responses; the polling interval is just a hint for devices.
+    if PROXY_CACHE_MAX_AGE:
+        proxycache.set_cache_headers(response, identifier, PROXY_CACHE_MAX_AGE)
+    else:
+        response.cache_control.private = True
+    return response
+
+
 @app.route('/api/v2/<identifier>', methods=['GET'])
 @app.route('/api/v3/status/<identifier>', methods=['GET'])
 @check_identifier
+@limit_concurrency
 def download(identifier):
+    if missing_identifiers is not None and identifier in missing_identifiers:
+        abort(404)
     try:
-        data, last_modified = get_database().get_data(identifier)
-        response = make_response(data)
-        response.headers.set('Content-Type', 'application/octet-stream')
-        response.headers.set("Access-Control-Allow-Origin", "*")
-        response.last_modified = last_modified
-        response.cache_control.max_age = 0
+        status = get_database().get_data(identifier)
+        response = make_status_response(identifier,
+                                        status.data,
+                                        last_modified=status.last_modified,
+                                        update_interval=status.update_interval,
+                                        etag=get_status_etag(status.last_modified))
+        # Range requests allow devices to fetch just the header and index. Werkzeug gives Range precedence over
+        # If-None-Match and If-Modified-Since, so we check whether the resource is unmodified first.
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+        response.make_conditional(request, accept_ranges=True, complete_length=len(status.data))
+        return response
+    except KeyError:
+        # Don't remember statuses as missing while an upload for them is waiting to be written.
+        if missing_identifiers is not None and (upload_buffer is None or identifier not in upload_buffer):
+            missing_identifiers.set(identifier)
+        abort(404)
+
+
+@app.route('/api/v3/status/<identifier>/image/<int:index>', methods=['GET'])
+@check_identifier
+@limit_concurrency
+def download_image(identifier, index):
+    if missing_identifiers is not None and identifier in missing_identifiers:
+        abort(404)
+    try:
+        image = get_database().get_image(identifier, index)
+        response = make_status_response(identifier,
+                                        image.data,
+                                        last_modified=image.last_modified,
+                                        update_interval=image.update_interval,
+                                        etag=image.digest)
+        # Images are identified by their digest, so we also give the ETag of the status they belong to, allowing devices
+        # to check that an image is from the update they're showing.
+        response.headers.set("X-Status-ETag", quote_etag(get_status_etag(image.last_modified)))
         response.make_conditional(request)
         return response
     except KeyError:
@@ -185,17 +436,20 @@ def download(identifier):
 
 
 @app.route('/api/v3/device/', methods=['POST'])
+@limit_concurrency
 def device():
-    logging.info(request)
-    logging.info(request.get_json())
-
-    # Store the token
     data = request.get_json()
     token = apns.encode_token(data["token"])
-    get_database().register_device(token, use_sandbox=data["use_sandbox"] if "use_sandbox" in data else False)
-    logging.info(get_database().get_devices())
+    use_sandbox = data["use_sandbox"] if "use_sandbox" in data else False
+
+    # Store the token, unless this worker has already done so recently.
+    if registered_devices is None or registered_devices.get(token) != use_sandbox:
+        logging.info("Registering device (use_sandbox=%s)...", use_sandbox)
+        get_database().register_device(token, use_sandbox=use_sandbox, min_age=REGISTRATION_CACHE_TTL)
+        if registered_devices is not None:
+            registered_devices.set(token, use_sandbox)
 
-    return jsonify(request.get_json())
+    return jsonify(data)
 
 @app.route('/api/v3/service/about', methods=['GET'])
 def service_about():
@@ -203,7 +457,47 @@ def service_about():
 
 @app.route('/api/v3/service/status', methods=['GET'])
 def service_status():
-    return jsonify(get_database().status())
+    status = get_database().status()
+    if upload_buffer is not None:
+        status["writeBehind"] = dict(upload_buffer.stats)  # Per-worker.
+    if purger is not None:
+        status["proxyCache"] = dict(purger.stats)  # Per-worker.
+    status["scheduler"] = scheduler_lock.held  # Whether this worker runs the scheduled tasks (and has keepalive stats).
+    status["keepalive"] = keepalive_scheduler.stats()  # Per-worker.
+    if profiler is not None:
+        status["profiler"] = dict(profiler.stats)  # Per-worker.
+    return jsonify(status)
+
+
+def check_profiler_token():
+    if profiler is None:
+        abort(404)
+    authorization = request.headers.get("Authorization", "")
+    if not authorization.startswith("Bearer ") or not profiler.is_authorized(authorization[len("Bearer "):]):
+        abort(401)
+
+
+@app.route('/api/v3/service/profile', methods=['GET'])
+def service_profile():
+    # Profiles are per-worker; repeat the request to collect them from each worker.
+    check_profiler_token()
+    response = make_response(profiler.dump())
+    response.headers["Content-Type"] = "text/plain; charset=utf-8"
+    return response
+
+
+@app.route('/api/v3/service/profile/<action>', methods=['POST'])
+def service_profile_action(action):
+    check_profiler_token()
+    if action == "start":
+        profiler.start()
+    elif action == "stop":
+        profiler.stop()
+    elif action == "reset":
+        profiler.reset()
+    else:
+        abort(404)
+    return jsonify(profiler.stats)
 
 
 if __name__ == '__main__':
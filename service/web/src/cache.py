@@ -0,0 +1,72 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    Thread-safe mapping whose entries expire `ttl` seconds after they were last set.
+
+    Once the cache holds `max_size` entries, the least recently set entries are evicted to make room.
+    """
+
+    def __init__(self, ttl, max_size=100000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # Synchronized on _lock
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expiry = self._entries[key]
+            except KeyError:
+                return default
+            if expiry <= self.clock():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value=True):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, self.clock() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
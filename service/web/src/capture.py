@@ -0,0 +1,122 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import werkzeug.exceptions
+
+
+CONDITIONAL_HEADERS = ["If-None-Match", "If-Modified-Since"]
+
+
+class CaptureMiddleware(object):
+    """
+    WSGI middleware that records a sample of requests to a JSONL file for replaying with 'benchmarks/replay.py'.
+
+    Each line records the time, method, route (e.g., '/api/v3/status/<identifier>'), a salted hash of the identifier,
+    which conditional headers were present (but not their values), any `Range` header, the request and response body
+    sizes, the response status, and the duration. Nothing else about the request is kept.
+
+    Requests with an identifier are sampled by an unsalted hash of the identifier, so that every worker captures the
+    complete traffic for the same devices; other requests are sampled individually. Recorded identifier hashes are only
+    consistent across workers if they share a salt.
+    """
+
+    def __init__(self, app, url_map, path, sample_rate, salt=None, clock=time.time, timer=time.perf_counter):
+        self.app = app
+        self.url_map = url_map
+        self.sample_rate = sample_rate
+        self.salt = salt if salt is not None else os.urandom(16).hex()
+        self.clock = clock
+        self.timer = timer
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def hash_identifier(self, identifier):
+        return hashlib.sha256((self.salt + identifier.lower()).encode("utf-8")).hexdigest()[:16]
+
+    def is_sampled(self, identifier):
+        if identifier is None:
+            return random.random() < self.sample_rate
+        digest = hashlib.sha256(identifier.lower().encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64 < self.sample_rate
+
+    def __call__(self, environ, start_response):
+        try:
+            rule, arguments = self.url_map.bind_to_environ(environ).match(return_rule=True)
+            route = rule.rule
+        except werkzeug.exceptions.HTTPException:
+            route, arguments = None, {}
+        identifier = arguments.get("identifier")
+        if not self.is_sampled(identifier):
+            return self.app(environ, start_response)
+        identifier_hash = self.hash_identifier(identifier) if identifier is not None else None
+        return self.capture(environ, start_response, route, arguments, identifier_hash)
+
+    def capture(self, environ, start_response, route, arguments, identifier_hash):
+        record = {
+            "time": round(self.clock(), 3),
+            "method": environ.get("REQUEST_METHOD"),
+            "route": route,
+            "identifier": identifier_hash,
+            "index": arguments.get("index"),
+            "conditional": [header for header in CONDITIONAL_HEADERS
+                            if "HTTP_" + header.upper().replace("-", "_") in environ],
+            "range": environ.get("HTTP_RANGE"),
+            "size": int(environ.get("CONTENT_LENGTH") or 0),
+        }
+        status = []
+
+        def capture_start_response(response_status, headers, exc_info=None):
+            status[:] = [int(response_status.split(" ", 1)[0])]
+            return start_response(response_status, headers, exc_info)
+
+        start = self.timer()
+        response_size = 0
+        response = self.app(environ, capture_start_response)
+        try:
+            for chunk in response:
+                response_size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(response, "close"):
+                response.close()
+            record["status"] = status[0] if status else None
+            record["response_size"] = response_size
+            record["duration_ms"] = round((self.timer() - start) * 1000, 3)
+            self.write(record)
+
+    def write(self, record):
+        # Single appends are atomic for lines this short, so workers can share a file.
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        try:
+            with self._lock:
+                os.write(self._fd, line)
+        except OSError as e:
+            logging.error("Failed to write capture record with error '%s'.", e)
+
+    def close(self):
+        os.close(self._fd)
@@ -18,13 +18,90 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import logging
+import collections
+import datetime
 import os
+import sqlite3
+import urllib.parse
+
 import psycopg2
 import psycopg2.extras
 
+import payload
+
 SECONDS_PER_WEEK = 60 * 60 * 24 * 7
 
+# Weight given to the most recent interval when updating the moving average of the time between uploads.
+UPDATE_INTERVAL_SMOOTHING = 0.25
+
+
+Status = collections.namedtuple("Status", ["data", "last_modified", "update_interval"])
+Image = collections.namedtuple("Image", ["data", "last_modified", "update_interval", "digest"])
+Row = collections.namedtuple("Row", ["key", "data", "last_modified", "update_interval"])
+
+# Key for the advisory lock held by the process that runs scheduled tasks (see `Database.try_lock_scheduler`).
+SCHEDULER_LOCK = 0x5354415455535053
+
+# Errors indicating that the database is (perhaps temporarily) unavailable.
+OperationalError = (psycopg2.OperationalError, psycopg2.InterfaceError, sqlite3.OperationalError)
+
+
+class IncompatibleSchema(Exception):
+    """
+    Raised when connecting to a database whose schema hasn't been migrated to the version this code expects; run
+    'migrate.py' first.
+    """
+    pass
+
+
+def from_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+
+def get_image_index(data):
+    """
+    Returns the image offsets, lengths, and digests for a status payload, or `None, None, None` if it can't be parsed.
+    """
+    index = payload.parse_index(data)
+    if index is None:
+        return None, None, None
+    return [offset for offset, _ in index], [length for _, length in index], payload.image_digests(data, index)
+
+
+def connect(database_url=None, readonly=False):
+    """
+    Connects to the database at `database_url` (defaulting to the `DATABASE_URL` environment variable), selecting the
+    backend using the URL scheme:
+
+    - 'postgres://' or 'postgresql://'–Postgres
+    - 'sqlite:///path/to/database.sqlite'–SQLite, for single-node deployments
+    - 'memory://' or 'memory://name'–an in-memory store shared by all connections to the same URL in this process, for
+      tests and benchmarks
+
+    If no URL is given and `DATABASE_SHARDS` is set, statuses are instead sharded across the (space-separated) database
+    URLs it contains, with devices stored on `DATABASE_DEVICE_SHARD`; see `sharding.ShardedDatabase`.
+    """
+    if database_url is None and os.environ.get("DATABASE_SHARDS"):
+        import sharding
+        if not os.environ.get("DATABASE_DEVICE_SHARD"):
+            raise ValueError("DATABASE_DEVICE_SHARD must be set when using DATABASE_SHARDS")
+        return sharding.ShardedDatabase(os.environ["DATABASE_SHARDS"].split(),
+                                        device_url=os.environ["DATABASE_DEVICE_SHARD"],
+                                        previous_urls=os.environ.get("DATABASE_PREVIOUS_SHARDS", "").split(),
+                                        readonly=readonly)
+    if database_url is None:
+        database_url = os.environ['DATABASE_URL']
+    scheme = urllib.parse.urlparse(database_url).scheme
+    if scheme in ("postgres", "postgresql"):
+        return PostgresDatabase(database_url, readonly=readonly)
+    elif scheme == "sqlite":
+        import database_sqlite
+        return database_sqlite.SQLiteDatabase(database_url, readonly=readonly)
+    elif scheme == "memory":
+        import database_memory
+        return database_memory.MemoryDatabase(database_url, readonly=readonly)
+    raise ValueError(f"Unsupported database URL scheme '{scheme}'")
+
 
 class Metadata(object):
     SCHEMA_VERSION = "schema_version"
@@ -48,6 +125,54 @@ class Transaction(object):
         self.cursor.close()
 
 
+class Concurrently(object):
+    """
+    Marks a migration that can't run inside a transaction (e.g., `CREATE INDEX CONCURRENTLY`). It's run in autocommit
+    mode, so it must be safe to re-run if it's interrupted part way through.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.__name__ = fn.__name__
+
+
+class Backfill(object):
+    """
+    Marks a migration that updates existing rows in batches, each in its own short transaction, rather than locking
+    every row at once. `fn(cursor, position, batch_size)` processes the batch following `position` (`None` for the
+    first batch), returning the position to continue from, or `None` once there's nothing left to do. Backfills are
+    restarted from the beginning if they're interrupted, so they must be idempotent.
+    """
+
+    def __init__(self, fn, batch_size=100):
+        self.fn = fn
+        self.batch_size = batch_size
+        self.__name__ = fn.__name__
+
+
+def get_schema_version(cursor):
+    """
+    Returns the schema version of a Postgres database, or 0 if it has never been migrated.
+    """
+    cursor.execute("SELECT to_regclass('metadata') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute("SELECT value FROM metadata WHERE key=%s", (Metadata.SCHEMA_VERSION, ))
+    result = cursor.fetchone()
+    return result[0] if result is not None else 0
+
+
+def drop_invalid_index(cursor, name):
+    # Interrupted concurrent index builds leave an invalid index behind, which `CREATE INDEX CONCURRENTLY IF NOT EXISTS`
+    # would otherwise skip.
+    cursor.execute("""SELECT 1
+                        FROM pg_index
+                        JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+                       WHERE pg_class.relname = %s AND NOT pg_index.indisvalid""", (name, ))
+    if cursor.fetchone() is not None:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
 def empty_migration(cursor):
     pass
 
@@ -73,9 +198,168 @@ def add_devices_use_sandbox(cursor):
     cursor.execute("ALTER TABLE devices ADD COLUMN use_sandbox boolean NOT NULL DEFAULT FALSE")
 
 
+def create_rate_limits_table(cursor):
+    # Rate limiting state is ephemeral, so we use an unlogged table to avoid paying for WAL writes on every request.
+    cursor.execute("CREATE UNLOGGED TABLE rate_limits (key text NOT NULL, tokens real NOT NULL, updated timestamptz NOT NULL, UNIQUE(key))")
+
+
+def add_data_update_interval(cursor):
+    cursor.execute("ALTER TABLE data ADD COLUMN update_interval real")
+
+
+def add_data_image_index(cursor):
+    cursor.execute("ALTER TABLE data ADD COLUMN image_offsets integer[], ADD COLUMN image_lengths integer[], ADD COLUMN image_digests text[]")
+    # Payloads are encrypted and therefore incompressible; storing them uncompressed means we can read individual images
+    # using substring without having to read the whole value.
+    cursor.execute("ALTER TABLE data ALTER COLUMN data SET STORAGE EXTERNAL")
+
+
+def create_data_last_modified_index(cursor):
+    # Used when purging stale statuses.
+    drop_invalid_index(cursor, "data_last_modified_index")
+    cursor.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS data_last_modified_index ON data (last_modified)")
+
+
+def backfill_data_image_index(cursor, position, batch_size):
+    # Statuses uploaded before the image index was added can't be fetched an image at a time until they're next
+    # updated. Rows that have changed since they were read are skipped, since the upload will have set the index.
+    cursor.execute("""SELECT id, data, last_modified
+                        FROM data
+                       WHERE id > %s AND image_offsets IS NULL
+                    ORDER BY id
+                       LIMIT %s""", (position or "", batch_size))
+    rows = cursor.fetchall()
+    for key, data, last_modified in rows:
+        image_offsets, image_lengths, image_digests = get_image_index(data.tobytes())
+        if image_offsets is None:
+            continue
+        cursor.execute("""UPDATE data
+                             SET image_offsets = %s, image_lengths = %s, image_digests = %s
+                           WHERE id = %s AND last_modified = %s""",
+                       (image_offsets, image_lengths, image_digests, key, last_modified))
+    if len(rows) < batch_size:
+        return None
+    return rows[-1][0]
+
+
 class Database(object):
+    """
+    Storage interface implemented by each backend; use `connect` to create an instance.
+
+    Connections are not thread-safe. All ages are given in seconds, and timestamps are returned as timezone-aware
+    datetimes.
+    """
+
+    def migrate(self):
+        """
+        Brings the schema up to date. SQLite and in-memory databases are migrated automatically when connecting (unless
+        the connection is readonly); Postgres databases must be migrated using 'migrate.py' before the service starts,
+        and connecting raises `IncompatibleSchema` if they're out of date.
+        """
+        raise NotImplementedError()
+
+    def set_data(self, key, value):
+        self.set_data_batch([(key, value)])
+
+    def set_data_batch(self, items):
+        """
+        Stores multiple `(key, value)` uploads using a single write (and commit). If a key appears more than once, the
+        last value wins.
+        """
+        raise NotImplementedError()
+
+    def get_data(self, key):
+        """
+        Returns the `Status` for `key`, raising `KeyError` if there isn't one.
+        """
+        raise NotImplementedError()
 
-    SCHEMA_VERSION = 11
+    def get_image(self, key, index):
+        """
+        Returns the `Image` at `index` in the status for `key`, raising `KeyError` if there isn't one.
+        """
+        raise NotImplementedError()
+
+    def purge_stale_data(self, max_age):
+        raise NotImplementedError()
+
+    def get_keys(self, after=None, limit=1000):
+        """
+        Returns up to `limit` keys of stored statuses in order, starting after `after`, so that every key can be read a
+        page at a time.
+        """
+        raise NotImplementedError()
+
+    def get_rows(self, keys):
+        """
+        Returns the stored `Row`s for `keys`, omitting any that don't exist; used to copy statuses between databases.
+        """
+        raise NotImplementedError()
+
+    def put_rows(self, rows):
+        """
+        Stores `Row`s copied from another database, leaving any existing statuses that are at least as recent.
+        """
+        raise NotImplementedError()
+
+    def delete_rows(self, rows):
+        """
+        Deletes statuses, but only if they haven't been modified since `rows` were read.
+        """
+        raise NotImplementedError()
+
+    def register_device(self, token, use_sandbox=False, min_age=0):
+        """
+        Registers a device for keepalive notifications. Re-registrations only update the device if `use_sandbox` has
+        changed or it was last updated more than `min_age` seconds ago.
+        """
+        raise NotImplementedError()
+
+    def get_devices(self, slot=None, slots=None):
+        """
+        Returns the registered devices as `{"token": ..., "use_sandbox": ...}` dictionaries; if `slot` is given, only
+        the devices for which `keepalive.get_slot(token, slots) == slot`.
+        """
+        raise NotImplementedError()
+
+    def purge_stale_devices(self, max_age):
+        raise NotImplementedError()
+
+    def delete_device(self, token):
+        raise NotImplementedError()
+
+    def acquire_rate_limit_token(self, key, rate, burst):
+        """
+        Token bucket shared by all connections; returns 0 if the request is allowed, or the number of seconds after
+        which it should be retried. Rejected requests also draw down the bucket, but never by more than a single token
+        of debt.
+        """
+        raise NotImplementedError()
+
+    def purge_stale_rate_limits(self, max_age):
+        raise NotImplementedError()
+
+    def try_lock_scheduler(self):
+        """
+        Tries to take the lock that selects the single process (across all workers and hosts sharing the database) that
+        runs scheduled tasks, returning True if this connection holds it. Once taken, the lock is held until the
+        connection is closed; calling this again checks that the connection is still alive.
+        """
+        raise NotImplementedError()
+
+    def status(self):
+        """
+        Returns a dictionary containing `deviceCount`, `statusCount`, and `statusSize`.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+
+class PostgresDatabase(Database):
+
+    SCHEMA_VERSION = 16
 
     MIGRATIONS = {
         1:  empty_migration,
@@ -89,93 +373,149 @@ class Database(object):
         9:  rename_modified_date_and_correct_default_value,
         10: create_devices_table,
         11: add_devices_use_sandbox,
+        12: create_rate_limits_table,
+        13: add_data_update_interval,
+        14: add_data_image_index,
+        15: Concurrently(create_data_last_modified_index),
+        16: Backfill(backfill_data_image_index),
     }
 
-    def __init__(self, database_url=None, readonly=False):
-
-        if database_url is None:
-            database_url = os.environ['DATABASE_URL']
+    # URLs of databases already known to have a compatible schema; checked once per process.
+    compatible_urls = set()
 
+    def __init__(self, database_url, readonly=False):
         self.connection = psycopg2.connect(database_url)
         self.connection.set_session(readonly=readonly)
+        self.scheduler_locked = False
+        if database_url not in self.compatible_urls:
+            self.check_schema()
+            self.compatible_urls.add(database_url)
 
-        # Migrations are disabled on readonly connections.
-        if readonly:
-            return
-
-        # Create the metadata table (used for versioning).
+    def check_schema(self):
+        # Newer schemas are accepted, so that the database can be migrated before rolling out the code that needs it.
         with Transaction(self.connection) as cursor:
-            cursor.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT NOT NULL, value INT, UNIQUE(key))")
-
-        # Create the initial version if necessary.
-        try:
-            with Transaction(self.connection) as cursor:
-                cursor.execute("INSERT INTO metadata VALUES (%s, %s)",
-                               (Metadata.SCHEMA_VERSION, 0))
-        except psycopg2.IntegrityError:
-            logging.info("schema_version key already exists")
-
-        self.migrate()
+            schema_version = get_schema_version(cursor)
+        if schema_version < self.SCHEMA_VERSION:
+            self.connection.close()
+            raise IncompatibleSchema(f"Schema at version {schema_version} but version {self.SCHEMA_VERSION} is "
+                                     "required; run 'migrate.py' to update it")
 
     def migrate(self):
-        with Transaction(self.connection) as cursor:
-            cursor.execute("SELECT value FROM metadata WHERE key=%s",
-                           (Metadata.SCHEMA_VERSION, ))
-            result = cursor.fetchone()
-            schema_version = result[0]
-            logging.info(f"Current schema at version {schema_version}")
-            if schema_version >= self.SCHEMA_VERSION:
-                return
-            for i in range(schema_version + 1, self.SCHEMA_VERSION + 1):
-                logging.info(f"Performing migration to version {i}...")
-                self.MIGRATIONS[i](cursor)
-            cursor.execute("UPDATE metadata SET value=%s WHERE key=%s",
-                           (self.SCHEMA_VERSION, Metadata.SCHEMA_VERSION))
-            logging.info(f"Updated schema to version {self.SCHEMA_VERSION}")
+        import migrate
+        migrate.Migrator(self.connection).run()
 
-    def set_data(self, key, value):
+    def set_data_batch(self, items):
+        rows = []
+        for key, value in collections.OrderedDict(items).items():
+            rows.append((key, psycopg2.Binary(value)) + get_image_index(value))
         with Transaction(self.connection) as cursor:
-            cursor.execute("SELECT COUNT(*) FROM data WHERE id = %s",
-                           (key, ))
-            result = cursor.fetchone()
-            count = result[0]
-            if count:
-                cursor.execute("UPDATE data SET data = %s, last_modified = current_timestamp WHERE id = %s",
-                               (psycopg2.Binary(value), key))
-            else:
-                cursor.execute("INSERT INTO data (id, data, last_modified) VALUES (%s, %s, current_timestamp)",
-                               (key, psycopg2.Binary(value)))
+            # Track an exponentially weighted moving average of the time between uploads so we can tell devices how
+            # often it's worth polling; `data.*` refers to the existing row, and `EXCLUDED.*` to the upload.
+            psycopg2.extras.execute_values(cursor,
+                                           f"""INSERT INTO data (id, data, last_modified, image_offsets, image_lengths, image_digests)
+                                                    VALUES %s
+                                               ON CONFLICT (id) DO UPDATE
+                                                       SET data = EXCLUDED.data,
+                                                           update_interval = COALESCE({UPDATE_INTERVAL_SMOOTHING} * EXTRACT(EPOCH FROM current_timestamp - data.last_modified) + (1 - {UPDATE_INTERVAL_SMOOTHING}) * data.update_interval,
+                                                                                      EXTRACT(EPOCH FROM current_timestamp - data.last_modified)),
+                                                           last_modified = current_timestamp,
+                                                           image_offsets = EXCLUDED.image_offsets,
+                                                           image_lengths = EXCLUDED.image_lengths,
+                                                           image_digests = EXCLUDED.image_digests""",
+                                           rows,
+                                           template="(%s, %s, current_timestamp, %s::integer[], %s::integer[], %s::text[])")
 
     def get_data(self, key):
         with Transaction(self.connection) as cursor:
-            cursor.execute("SELECT data, last_modified FROM data WHERE id = %s",
+            cursor.execute("SELECT data, last_modified, update_interval FROM data WHERE id = %s",
                            (key, ))
             result = cursor.fetchone()
             if result is None:
                 raise KeyError(f"No data for key '{key}'")
-            return result[0].tobytes(), result[1]
+            return Status(result[0].tobytes(), result[1], result[2])
+
+    def get_image(self, key, index):
+        # Array indices in Postgres start at 1 and are NULL when out of range.
+        with Transaction(self.connection) as cursor:
+            cursor.execute("""SELECT substring(data FROM image_offsets[%(index)s] + 1 FOR image_lengths[%(index)s]),
+                                     last_modified,
+                                     update_interval,
+                                     image_digests[%(index)s]
+                                FROM data
+                               WHERE id = %(id)s AND image_offsets[%(index)s] IS NOT NULL""",
+                           {"id": key, "index": index + 1})
+            result = cursor.fetchone()
+            if result is None:
+                raise KeyError(f"No image {index} for key '{key}'")
+            return Image(result[0].tobytes(), result[1], result[2], result[3])
 
     def purge_stale_data(self, max_age):
         with Transaction(self.connection) as cursor:
-            cursor.execute("DELETE FROM data WHERE last_modified < current_timestamp - %s", (max_age, ))
+            cursor.execute("DELETE FROM data WHERE last_modified < current_timestamp - (%s||' seconds')::interval", (max_age, ))
 
-    def register_device(self, token, use_sandbox=False):
+    def get_keys(self, after=None, limit=1000):
         with Transaction(self.connection) as cursor:
-            cursor.execute("SELECT COUNT(*) FROM devices WHERE token = %s",
-                           (token, ))
-            result = cursor.fetchone()
-            count = result[0]
-            if count:
-                cursor.execute("UPDATE devices SET use_sandbox = %s, last_modified = current_timestamp WHERE token = %s",
-                               (use_sandbox, token))
+            if after is None:
+                cursor.execute("SELECT id FROM data ORDER BY id LIMIT %s", (limit, ))
             else:
-                cursor.execute("INSERT INTO devices (token, use_sandbox, last_modified) VALUES (%s, %s, current_timestamp)",
-                               (token, use_sandbox))
+                cursor.execute("SELECT id FROM data WHERE id > %s ORDER BY id LIMIT %s", (after, limit))
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_rows(self, keys):
+        with Transaction(self.connection) as cursor:
+            cursor.execute("SELECT id, data, last_modified, update_interval FROM data WHERE id = ANY(%s)", (list(keys), ))
+            return [Row(key, data.tobytes(), last_modified, update_interval)
+                    for key, data, last_modified, update_interval in cursor.fetchall()]
 
-    def get_devices(self):
+    def put_rows(self, rows):
+        values = [(row.key, psycopg2.Binary(row.data), row.last_modified, row.update_interval) + get_image_index(row.data)
+                  for row in rows]
+        with Transaction(self.connection) as cursor:
+            psycopg2.extras.execute_values(cursor,
+                                           """INSERT INTO data (id, data, last_modified, update_interval, image_offsets, image_lengths, image_digests)
+                                                   VALUES %s
+                                              ON CONFLICT (id) DO UPDATE
+                                                      SET data = EXCLUDED.data,
+                                                          last_modified = EXCLUDED.last_modified,
+                                                          update_interval = EXCLUDED.update_interval,
+                                                          image_offsets = EXCLUDED.image_offsets,
+                                                          image_lengths = EXCLUDED.image_lengths,
+                                                          image_digests = EXCLUDED.image_digests
+                                                    WHERE data.last_modified < EXCLUDED.last_modified""",
+                                           values,
+                                           template="(%s, %s, %s, %s, %s::integer[], %s::integer[], %s::text[])")
+
+    def delete_rows(self, rows):
+        with Transaction(self.connection) as cursor:
+            psycopg2.extras.execute_values(cursor,
+                                           """DELETE FROM data
+                                                    USING (VALUES %s) AS rows (id, last_modified)
+                                                    WHERE data.id = rows.id AND data.last_modified = rows.last_modified""",
+                                           [(row.key, row.last_modified) for row in rows],
+                                           template="(%s, %s::timestamptz)")
+
+    def register_device(self, token, use_sandbox=False, min_age=0):
+        # Skipping unnecessary updates avoids dead tuples (and WAL) for frequently relaunched apps.
+        with Transaction(self.connection) as cursor:
+            cursor.execute("""INSERT INTO devices (token, use_sandbox, last_modified)
+                                   VALUES (%(token)s, %(use_sandbox)s, current_timestamp)
+                              ON CONFLICT (token) DO UPDATE
+                                      SET use_sandbox = EXCLUDED.use_sandbox,
+                                          last_modified = EXCLUDED.last_modified
+                                    WHERE devices.use_sandbox <> EXCLUDED.use_sandbox
+                                       OR devices.last_modified < current_timestamp - (%(min_age)s||' seconds')::interval""",
+                           {"token": token, "use_sandbox": use_sandbox, "min_age": min_age})
+
+    def get_devices(self, slot=None, slots=None):
         with Transaction(self.connection, cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
-            cursor.execute("""SELECT token, use_sandbox
-                                FROM devices""")
+            if slot is None:
+                cursor.execute("""SELECT token, use_sandbox
+                                    FROM devices""")
+            else:
+                cursor.execute("""SELECT token, use_sandbox
+                                    FROM devices
+                                   WHERE ('x' || substr(md5(token), 1, 7))::bit(28)::integer %% %s = %s""",  # keepalive.get_slot
+                               (slots, slot))
             results = cursor.fetchall()
             return results
 
@@ -187,6 +527,34 @@ class Database(object):
         with Transaction(self.connection) as cursor:
             cursor.execute("DELETE FROM devices WHERE token = %s", (token, ))
 
+    def acquire_rate_limit_token(self, key, rate, burst):
+        with Transaction(self.connection) as cursor:
+            cursor.execute("""INSERT INTO rate_limits (key, tokens, updated)
+                                   VALUES (%(key)s, %(burst)s - 1, clock_timestamp())
+                              ON CONFLICT (key) DO UPDATE
+                                      SET tokens = GREATEST(LEAST(%(burst)s, rate_limits.tokens + EXTRACT(EPOCH FROM clock_timestamp() - rate_limits.updated) * %(rate)s) - 1, -1),
+                                          updated = clock_timestamp()
+                                RETURNING tokens""",
+                           {"key": key, "rate": rate, "burst": burst})
+            tokens = cursor.fetchone()[0]
+            if tokens >= 0:
+                return 0
+            return (1 - tokens) / rate
+
+    def purge_stale_rate_limits(self, max_age):
+        with Transaction(self.connection) as cursor:
+            cursor.execute("DELETE FROM rate_limits WHERE updated < current_timestamp - (%s||' seconds')::interval", (max_age, ))
+
+    def try_lock_scheduler(self):
+        # Session-level advisory locks are released by the server if the connection is lost.
+        with Transaction(self.connection) as cursor:
+            if self.scheduler_locked:
+                cursor.execute("SELECT 1")
+            else:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (SCHEDULER_LOCK, ))
+                self.scheduler_locked = cursor.fetchone()[0]
+        return self.scheduler_locked
+
     def status(self):
         with Transaction(self.connection) as cursor:
             result = {}
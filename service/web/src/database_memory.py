@@ -0,0 +1,185 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import time
+
+import database
+import keepalive
+import payload
+
+
+class Store(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}  # Synchronized on lock
+        self.devices = {}  # Synchronized on lock
+        self.rate_limits = {}  # Synchronized on lock
+        self.scheduler_lock_holder = None  # Synchronized on lock
+
+
+STORES = {}
+STORES_LOCK = threading.Lock()
+
+
+def get_store(database_url):
+    with STORES_LOCK:
+        return STORES.setdefault(database_url, Store())
+
+
+class MemoryDatabase(database.Database):
+    """
+    In-process backend for tests and benchmarks, using 'memory://' URLs. Connections to the same URL share the same
+    store, which lasts for the lifetime of the process; nothing is persisted.
+    """
+
+    def __init__(self, database_url, readonly=False):
+        self.store = get_store(database_url)
+
+    def migrate(self):
+        pass
+
+    def set_data_batch(self, items):
+        now = time.time()
+        with self.store.lock:
+            for key, value in dict(items).items():
+                index = payload.parse_index(value)
+                digests = payload.image_digests(value, index) if index is not None else None
+                update_interval = None
+                if key in self.store.data:
+                    _, last_modified, previous_interval, _, _ = self.store.data[key]
+                    update_interval = now - last_modified
+                    if previous_interval is not None:
+                        update_interval = (database.UPDATE_INTERVAL_SMOOTHING * update_interval +
+                                           (1 - database.UPDATE_INTERVAL_SMOOTHING) * previous_interval)
+                self.store.data[key] = (bytes(value), now, update_interval, index, digests)
+
+    def get_data(self, key):
+        with self.store.lock:
+            try:
+                data, last_modified, update_interval, _, _ = self.store.data[key]
+            except KeyError:
+                raise KeyError(f"No data for key '{key}'")
+        return database.Status(data, database.from_timestamp(last_modified), update_interval)
+
+    def get_image(self, key, index):
+        with self.store.lock:
+            data, last_modified, update_interval, images, digests = self.store.data.get(key, (None, 0, None, None, None))
+        if images is None or index >= len(images):
+            raise KeyError(f"No image {index} for key '{key}'")
+        offset, length = images[index]
+        return database.Image(data[offset:offset + length], database.from_timestamp(last_modified), update_interval, digests[index])
+
+    def purge_stale_data(self, max_age):
+        threshold = time.time() - max_age
+        with self.store.lock:
+            for key in [key for key, value in self.store.data.items() if value[1] < threshold]:
+                del self.store.data[key]
+
+    def get_keys(self, after=None, limit=1000):
+        with self.store.lock:
+            keys = sorted(key for key in self.store.data.keys() if after is None or key > after)
+        return keys[:limit]
+
+    def get_rows(self, keys):
+        with self.store.lock:
+            values = [(key, self.store.data[key]) for key in keys if key in self.store.data]
+        return [database.Row(key, data, database.from_timestamp(last_modified), update_interval)
+                for key, (data, last_modified, update_interval, _, _) in values]
+
+    def put_rows(self, rows):
+        with self.store.lock:
+            for row in rows:
+                last_modified = row.last_modified.timestamp()
+                if row.key in self.store.data and self.store.data[row.key][1] >= last_modified:
+                    continue
+                index = payload.parse_index(row.data)
+                digests = payload.image_digests(row.data, index) if index is not None else None
+                self.store.data[row.key] = (bytes(row.data), last_modified, row.update_interval, index, digests)
+
+    def delete_rows(self, rows):
+        with self.store.lock:
+            for row in rows:
+                value = self.store.data.get(row.key)
+                if value is not None and abs(value[1] - row.last_modified.timestamp()) < 0.000001:
+                    del self.store.data[row.key]
+
+    def register_device(self, token, use_sandbox=False, min_age=0):
+        now = time.time()
+        with self.store.lock:
+            previous = self.store.devices.get(token)
+            if previous is None or previous[0] != use_sandbox or previous[1] < now - min_age:
+                self.store.devices[token] = (bool(use_sandbox), now)
+
+    def get_devices(self, slot=None, slots=None):
+        with self.store.lock:
+            devices = list(self.store.devices.items())
+        return [{"token": token, "use_sandbox": use_sandbox}
+                for token, (use_sandbox, _) in devices
+                if slot is None or keepalive.get_slot(token, slots) == slot]
+
+    def purge_stale_devices(self, max_age):
+        threshold = time.time() - max_age
+        with self.store.lock:
+            for token in [token for token, value in self.store.devices.items() if value[1] < threshold]:
+                del self.store.devices[token]
+
+    def delete_device(self, token):
+        with self.store.lock:
+            self.store.devices.pop(token, None)
+
+    def acquire_rate_limit_token(self, key, rate, burst):
+        now = time.time()
+        with self.store.lock:
+            if key in self.store.rate_limits:
+                tokens, updated = self.store.rate_limits[key]
+                tokens = max(min(burst, tokens + (now - updated) * rate) - 1, -1)
+            else:
+                tokens = burst - 1
+            self.store.rate_limits[key] = (tokens, now)
+        if tokens >= 0:
+            return 0
+        return (1 - tokens) / rate
+
+    def purge_stale_rate_limits(self, max_age):
+        threshold = time.time() - max_age
+        with self.store.lock:
+            for key in [key for key, value in self.store.rate_limits.items() if value[1] < threshold]:
+                del self.store.rate_limits[key]
+
+    def status(self):
+        with self.store.lock:
+            return {
+                "deviceCount": len(self.store.devices),
+                "statusCount": len(self.store.data),
+                "statusSize": sum(len(value[0]) for value in self.store.data.values()) or None,
+            }
+
+    def try_lock_scheduler(self):
+        with self.store.lock:
+            if self.store.scheduler_lock_holder is None:
+                self.store.scheduler_lock_holder = self
+            return self.store.scheduler_lock_holder is self
+
+    def close(self):
+        with self.store.lock:
+            if self.store.scheduler_lock_holder is self:
+                self.store.scheduler_lock_holder = None
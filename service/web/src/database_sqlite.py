@@ -0,0 +1,289 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import time
+import urllib.parse
+
+import database
+import keepalive
+
+
+def get_path(database_url):
+    """
+    Returns the path of the database given by a URL of the form 'sqlite:///path/to/database.sqlite'. SQLAlchemy's
+    'sqlite:////path/to/database.sqlite' form for absolute paths is also accepted.
+    """
+    path = database_url[len("sqlite://"):]
+    if path.startswith("//"):
+        path = "/" + path.lstrip("/")
+    return path
+
+
+def get_readonly_uri(path):
+    # Characters that are significant in URIs (e.g., '?' or '%') need escaping, and the path must be absolute so it
+    # can't be mistaken for a URI authority.
+    return "file:" + urllib.parse.quote(os.path.abspath(path)) + "?mode=ro"
+
+
+def get_image_index(data):
+    return tuple(json.dumps(column) if column is not None else None for column in database.get_image_index(data))
+
+
+def create_tables(cursor):
+    cursor.execute("CREATE TABLE data (id TEXT NOT NULL PRIMARY KEY, data BLOB NOT NULL, last_modified REAL NOT NULL, update_interval REAL, image_offsets TEXT, image_lengths TEXT, image_digests TEXT)")
+    cursor.execute("CREATE TABLE devices (token TEXT NOT NULL PRIMARY KEY, use_sandbox INTEGER NOT NULL DEFAULT 0, last_modified REAL NOT NULL)")
+    cursor.execute("CREATE TABLE rate_limits (key TEXT NOT NULL PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+
+class SQLiteDatabase(database.Database):
+    """
+    SQLite backend for single-node deployments, using 'sqlite://<path>' URLs (e.g., 'sqlite:///var/lib/statuspanel.db').
+
+    The database uses write-ahead logging so that readers don't block the (single) writer, and `synchronous=NORMAL`,
+    meaning the most recent transactions can be lost on power failure (but not if the process crashes). Timestamps are
+    stored as seconds since the epoch and image indexes as JSON arrays.
+    """
+
+    SCHEMA_VERSION = 1
+
+    MIGRATIONS = {
+        1: create_tables,
+    }
+
+    BUSY_TIMEOUT = 5  # Seconds to wait for other writers.
+
+    def __init__(self, database_url, readonly=False):
+        # Connections may be handed between threads (e.g., by `sharding.ConnectionPool`), but are never used
+        # concurrently.
+        path = get_path(database_url)
+        self.scheduler_lock_path = path + "-scheduler.lock"
+        self.scheduler_lock_fd = None
+        if readonly:
+            self.connection = sqlite3.connect(get_readonly_uri(path), uri=True, timeout=self.BUSY_TIMEOUT,
+                                              isolation_level=None, check_same_thread=False)
+        else:
+            self.connection = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT, isolation_level=None,
+                                              check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.create_function("keepalive_slot", 2, keepalive.get_slot, deterministic=True)
+
+        # Migrations are disabled on readonly connections.
+        if readonly:
+            return
+        self.migrate()
+
+    @contextlib.contextmanager
+    def transaction(self, immediate=False):
+        # Immediate transactions take the write lock up-front, ensuring read-modify-write sequences are atomic.
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        else:
+            cursor.execute("COMMIT")
+        finally:
+            cursor.close()
+
+    def migrate(self):
+        with self.transaction(immediate=True) as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT NOT NULL PRIMARY KEY, value INTEGER)")
+            cursor.execute("INSERT OR IGNORE INTO metadata VALUES (?, ?)", (database.Metadata.SCHEMA_VERSION, 0))
+            cursor.execute("SELECT value FROM metadata WHERE key = ?", (database.Metadata.SCHEMA_VERSION, ))
+            schema_version = cursor.fetchone()[0]
+            logging.info(f"Current schema at version {schema_version}")
+            if schema_version >= self.SCHEMA_VERSION:
+                return
+            for i in range(schema_version + 1, self.SCHEMA_VERSION + 1):
+                logging.info(f"Performing migration to version {i}...")
+                self.MIGRATIONS[i](cursor)
+            cursor.execute("UPDATE metadata SET value = ? WHERE key = ?",
+                           (self.SCHEMA_VERSION, database.Metadata.SCHEMA_VERSION))
+            logging.info(f"Updated schema to version {self.SCHEMA_VERSION}")
+
+    def set_data_batch(self, items):
+        now = time.time()
+        rows = []
+        for key, value in dict(items).items():
+            rows.append((key, value, now) + get_image_index(value))
+        smoothing = database.UPDATE_INTERVAL_SMOOTHING
+        with self.transaction(immediate=True) as cursor:
+            cursor.executemany(f"""INSERT INTO data (id, data, last_modified, image_offsets, image_lengths, image_digests)
+                                        VALUES (?, ?, ?, ?, ?, ?)
+                                   ON CONFLICT (id) DO UPDATE
+                                           SET data = excluded.data,
+                                               update_interval = COALESCE({smoothing} * (excluded.last_modified - data.last_modified) + (1 - {smoothing}) * data.update_interval,
+                                                                          excluded.last_modified - data.last_modified),
+                                               last_modified = excluded.last_modified,
+                                               image_offsets = excluded.image_offsets,
+                                               image_lengths = excluded.image_lengths,
+                                               image_digests = excluded.image_digests""",
+                               rows)
+
+    def get_data(self, key):
+        with self.transaction() as cursor:
+            cursor.execute("SELECT data, last_modified, update_interval FROM data WHERE id = ?", (key, ))
+            result = cursor.fetchone()
+            if result is None:
+                raise KeyError(f"No data for key '{key}'")
+            return database.Status(result[0], database.from_timestamp(result[1]), result[2])
+
+    def get_image(self, key, index):
+        path = f"$[{index}]"
+        with self.transaction() as cursor:
+            cursor.execute("""SELECT substr(data, json_extract(image_offsets, :path) + 1, json_extract(image_lengths, :path)),
+                                     last_modified,
+                                     update_interval,
+                                     json_extract(image_digests, :path)
+                                FROM data
+                               WHERE id = :id AND json_extract(image_offsets, :path) IS NOT NULL""",
+                           {"id": key, "path": path})
+            result = cursor.fetchone()
+            if result is None:
+                raise KeyError(f"No image {index} for key '{key}'")
+            return database.Image(result[0], database.from_timestamp(result[1]), result[2], result[3])
+
+    def purge_stale_data(self, max_age):
+        with self.transaction(immediate=True) as cursor:
+            cursor.execute("DELETE FROM data WHERE last_modified < ?", (time.time() - max_age, ))
+
+    def get_keys(self, after=None, limit=1000):
+        with self.transaction() as cursor:
+            if after is None:
+                cursor.execute("SELECT id FROM data ORDER BY id LIMIT ?", (limit, ))
+            else:
+                cursor.execute("SELECT id FROM data WHERE id > ? ORDER BY id LIMIT ?", (after, limit))
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_rows(self, keys):
+        rows = []
+        with self.transaction() as cursor:
+            for key in keys:
+                cursor.execute("SELECT id, data, last_modified, update_interval FROM data WHERE id = ?", (key, ))
+                rows.extend(database.Row(key, data, database.from_timestamp(last_modified), update_interval)
+                            for key, data, last_modified, update_interval in cursor.fetchall())
+        return rows
+
+    def put_rows(self, rows):
+        values = [(row.key, row.data, row.last_modified.timestamp(), row.update_interval) + get_image_index(row.data)
+                  for row in rows]
+        with self.transaction(immediate=True) as cursor:
+            cursor.executemany("""INSERT INTO data (id, data, last_modified, update_interval, image_offsets, image_lengths, image_digests)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?)
+                                  ON CONFLICT (id) DO UPDATE
+                                          SET data = excluded.data,
+                                              last_modified = excluded.last_modified,
+                                              update_interval = excluded.update_interval,
+                                              image_offsets = excluded.image_offsets,
+                                              image_lengths = excluded.image_lengths,
+                                              image_digests = excluded.image_digests
+                                        WHERE data.last_modified < excluded.last_modified""",
+                               values)
+
+    def delete_rows(self, rows):
+        # Timestamps are stored as floating point seconds, so they may not survive the round trip through datetime
+        # exactly.
+        with self.transaction(immediate=True) as cursor:
+            cursor.executemany("DELETE FROM data WHERE id = ? AND ABS(last_modified - ?) < 0.000001",
+                               [(row.key, row.last_modified.timestamp()) for row in rows])
+
+    def register_device(self, token, use_sandbox=False, min_age=0):
+        now = time.time()
+        with self.transaction(immediate=True) as cursor:
+            cursor.execute("""INSERT INTO devices (token, use_sandbox, last_modified)
+                                   VALUES (:token, :use_sandbox, :now)
+                              ON CONFLICT (token) DO UPDATE
+                                      SET use_sandbox = excluded.use_sandbox,
+                                          last_modified = excluded.last_modified
+                                    WHERE devices.use_sandbox <> excluded.use_sandbox
+                                       OR devices.last_modified < :now - :min_age""",
+                           {"token": token, "use_sandbox": bool(use_sandbox), "now": now, "min_age": min_age})
+
+    def get_devices(self, slot=None, slots=None):
+        with self.transaction() as cursor:
+            if slot is None:
+                cursor.execute("SELECT token, use_sandbox FROM devices")
+            else:
+                cursor.execute("SELECT token, use_sandbox FROM devices WHERE keepalive_slot(token, ?) = ?",
+                               (slots, slot))
+            return [{"token": token, "use_sandbox": bool(use_sandbox)} for token, use_sandbox in cursor.fetchall()]
+
+    def purge_stale_devices(self, max_age):
+        with self.transaction(immediate=True) as cursor:
+            cursor.execute("DELETE FROM devices WHERE last_modified < ?", (time.time() - max_age, ))
+
+    def delete_device(self, token):
+        with self.transaction(immediate=True) as cursor:
+            cursor.execute("DELETE FROM devices WHERE token = ?", (token, ))
+
+    def acquire_rate_limit_token(self, key, rate, burst):
+        with self.transaction(immediate=True) as cursor:
+            cursor.execute("""INSERT INTO rate_limits (key, tokens, updated)
+                                   VALUES (:key, :burst - 1, :now)
+                              ON CONFLICT (key) DO UPDATE
+                                      SET tokens = MAX(MIN(:burst, rate_limits.tokens + (:now - rate_limits.updated) * :rate) - 1, -1),
+                                          updated = :now""",
+                           {"key": key, "rate": rate, "burst": burst, "now": time.time()})
+            cursor.execute("SELECT tokens FROM rate_limits WHERE key = ?", (key, ))
+            tokens = cursor.fetchone()[0]
+        if tokens >= 0:
+            return 0
+        return (1 - tokens) / rate
+
+    def purge_stale_rate_limits(self, max_age):
+        with self.transaction(immediate=True) as cursor:
+            cursor.execute("DELETE FROM rate_limits WHERE updated < ?", (time.time() - max_age, ))
+
+    def status(self):
+        with self.transaction() as cursor:
+            result = {}
+            cursor.execute("SELECT COUNT(*) FROM devices")
+            result["deviceCount"] = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*), SUM(length(data)) FROM data")
+            result["statusCount"], result["statusSize"] = cursor.fetchone()
+            return result
+
+    def try_lock_scheduler(self):
+        # SQLite databases can only be shared by processes on the same host, so a file lock is enough.
+        if self.scheduler_lock_fd is not None:
+            return True
+        fd = os.open(self.scheduler_lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.scheduler_lock_fd = fd
+        return True
+
+    def close(self):
+        if self.scheduler_lock_fd is not None:
+            os.close(self.scheduler_lock_fd)
+            self.scheduler_lock_fd = None
+        self.connection.close()
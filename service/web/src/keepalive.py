@@ -0,0 +1,96 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import logging
+import threading
+import time
+
+
+def get_slot(token, slots):
+    """
+    Stable slot for a device token; must match the expression used by `Database.get_devices`.
+    """
+    return int(hashlib.md5(token.encode("ascii")).hexdigest()[:7], 16) % slots
+
+
+class KeepaliveScheduler(object):
+    """
+    Spreads keepalive pushes over the keepalive interval by partitioning devices into `slots` slots by token hash and
+    sending to one slot at a time, so each device still receives one push per interval but their apps don't all upload
+    at once.
+
+    `run` should be called at least once per slot duration (`interval / slots`). Slots are derived from wall-clock time so
+    each device is pushed at the same point in every interval; any slots missed (e.g., because a run was delayed) are sent
+    on the next run.
+    """
+
+    def __init__(self, send, slots=60, interval=60 * 60, clock=time.time, timer=time.perf_counter):
+        self.send = send
+        self.slots = slots
+        self.interval = interval
+        self.clock = clock
+        self.timer = timer
+        self._lock = threading.Lock()
+        self._last_slot = None  # Synchronized on _lock
+        self._stats = {}  # Synchronized on _lock
+
+    @property
+    def slot_duration(self):
+        return self.interval / self.slots
+
+    def current_slot(self):
+        return int(self.clock() // self.slot_duration) % self.slots
+
+    def run(self):
+        with self._lock:
+            slot = self.current_slot()
+            if self._last_slot is None:
+                pending = [slot]
+            else:
+                missed = (slot - self._last_slot) % self.slots
+                pending = [(self._last_slot + i) % self.slots for i in range(1, missed + 1)]
+            self._last_slot = slot
+        for slot in pending:
+            self.send_slot(slot)
+
+    def send_slot(self, slot):
+        start = self.timer()
+        try:
+            count = self.send(slot, self.slots)
+        except Exception as e:
+            logging.error("Failed to send keepalive for slot %d with error '%s'.", slot, e)
+            count, failed = 0, True
+        else:
+            failed = False
+        duration = (self.timer() - start) * 1000
+        with self._lock:
+            stats = self._stats.setdefault(slot, {"runs": 0, "failures": 0, "devices": 0, "lastDevices": 0,
+                                                  "lastDurationMs": 0.0, "maxDurationMs": 0.0})
+            stats["runs"] += 1
+            stats["failures"] += int(failed)
+            stats["devices"] += count
+            stats["lastDevices"] = count
+            stats["lastDurationMs"] = round(duration, 3)
+            stats["maxDurationMs"] = round(max(stats["maxDurationMs"], duration), 3)
+
+    def stats(self):
+        with self._lock:
+            return {str(slot): dict(stats) for slot, stats in sorted(self._stats.items())}
@@ -0,0 +1,266 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Migrates the Postgres schema without stalling the service.
+
+Run this before starting (or rolling out) the service; the web workers only check that the schema is compatible. Each
+migration takes a session-level advisory lock, so that concurrent runs wait for each other, and runs with short
+`lock_timeout` and `statement_timeout` values: a step that would queue behind (and therefore block) live traffic gives up
+quickly and is retried with backoff instead. Steps marked `database.Concurrently` run outside a transaction, and
+`database.Backfill` steps run in small batches. The duration of each step is logged, and recorded in the
+'migration_log' table.
+
+SQLite and in-memory databases are migrated when they're first connected, so there's nothing to do for those beyond
+connecting.
+"""
+
+import argparse
+import contextlib
+import datetime
+import logging
+import os
+import time
+import urllib.parse
+
+import psycopg2
+import psycopg2.errors
+
+import database
+
+
+# Key for the advisory lock held while migrating.
+MIGRATION_LOCK = 0x5354415455535041
+
+# Errors raised when a step exceeds `lock_timeout` or `statement_timeout`; these are retried.
+TIMEOUT_ERRORS = (psycopg2.errors.LockNotAvailable, psycopg2.errors.QueryCanceled)
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migrator(object):
+    """
+    Applies `migrations` (defaulting to `database.PostgresDatabase.MIGRATIONS`) to the database on `connection`, up to
+    `schema_version`. Steps that time out are retried up to `attempts` times, doubling `retry_interval` each time.
+    """
+
+    def __init__(self, connection, migrations=None, schema_version=None, lock_timeout="2s", statement_timeout="1min",
+                 attempts=10, retry_interval=1, lock_wait=600, clock=time.monotonic, sleep=time.sleep):
+        self.connection = connection
+        self.migrations = migrations if migrations is not None else database.PostgresDatabase.MIGRATIONS
+        self.schema_version = schema_version if schema_version is not None else max(self.migrations)
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.attempts = attempts
+        self.retry_interval = retry_interval
+        self.lock_wait = lock_wait
+        self.clock = clock
+        self.sleep = sleep
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute("BEGIN")
+            try:
+                cursor.execute("SET LOCAL lock_timeout = %s", (self.lock_timeout, ))
+                cursor.execute("SET LOCAL statement_timeout = %s", (self.statement_timeout, ))
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def retry(self, description, fn):
+        """
+        Calls `fn` until it completes without timing out, returning its result and the number of attempts it took.
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return fn(), attempt
+            except TIMEOUT_ERRORS as e:
+                if attempt == self.attempts:
+                    raise MigrationError(f"{description} failed after {attempt} attempts: {e}") from e
+                interval = self.retry_interval * 2 ** (attempt - 1)
+                logging.warning("%s timed out (%s); retrying in %ss...", description, str(e).strip(), interval)
+                self.sleep(interval)
+
+    def acquire_lock(self):
+        deadline = self.clock() + self.lock_wait
+        with self.connection.cursor() as cursor:
+            while True:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK, ))
+                if cursor.fetchone()[0]:
+                    return
+                if self.clock() >= deadline:
+                    raise MigrationError("Timed out waiting for another migration to finish")
+                logging.info("Waiting for another migration to finish...")
+                self.sleep(self.retry_interval)
+
+    def release_lock(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK, ))
+
+    def prepare(self):
+        def create_tables():
+            with self.transaction() as cursor:
+                cursor.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT NOT NULL, value INT, UNIQUE(key))")
+                cursor.execute("INSERT INTO metadata VALUES (%s, %s) ON CONFLICT (key) DO NOTHING",
+                               (database.Metadata.SCHEMA_VERSION, 0))
+                cursor.execute("""CREATE TABLE IF NOT EXISTS migration_log (version integer NOT NULL,
+                                                                            name text NOT NULL,
+                                                                            started timestamptz NOT NULL,
+                                                                            duration_ms real NOT NULL,
+                                                                            attempts integer NOT NULL)""")
+        self.retry("Creating the metadata tables", create_tables)
+
+    def get_version(self):
+        with self.connection.cursor() as cursor:
+            return database.get_schema_version(cursor)
+
+    def set_version(self, cursor, version):
+        cursor.execute("UPDATE metadata SET value=%s WHERE key=%s", (version, database.Metadata.SCHEMA_VERSION))
+
+    def apply(self, version, step):
+        """
+        Applies a single migration step and updates the schema version, returning the number of attempts it took (the
+        most taken by any one batch, for backfills).
+        """
+        description = f"Migration {version} ({step.__name__})"
+
+        if not isinstance(step, (database.Concurrently, database.Backfill)):
+            def run_transaction():
+                with self.transaction() as cursor:
+                    step(cursor)
+                    self.set_version(cursor, version)
+            _, attempts = self.retry(description, run_transaction)
+            return attempts
+
+        if isinstance(step, database.Concurrently):
+            # Concurrent steps don't block reads or writes, so they're allowed to run for as long as they need; the
+            # lock timeout still applies to the brief locks they take at the start and end.
+            def run_concurrently():
+                with self.connection.cursor() as cursor:
+                    cursor.execute("SET lock_timeout = %s", (self.lock_timeout, ))
+                    cursor.execute("SET statement_timeout = 0")
+                    try:
+                        step.fn(cursor)
+                    finally:
+                        cursor.execute("RESET lock_timeout")
+                        cursor.execute("RESET statement_timeout")
+            _, attempts = self.retry(description, run_concurrently)
+        else:
+            attempts = 0
+            batches = 0
+            position = None
+            while True:
+                def run_batch():
+                    with self.transaction() as cursor:
+                        return step.fn(cursor, position, step.batch_size)
+                position, batch_attempts = self.retry(description, run_batch)
+                attempts = max(attempts, batch_attempts)
+                batches += 1
+                if position is None:
+                    break
+            logging.info(f"{description} processed {batches} batches")
+
+        # Non-transactional steps record their version separately once they've completed.
+        def update_version():
+            with self.transaction() as cursor:
+                self.set_version(cursor, version)
+        self.retry(f"Updating the schema version to {version}", update_version)
+        return attempts
+
+    def run(self):
+        """
+        Applies any outstanding migrations, returning a list of `(version, name, duration_ms, attempts)` tuples.
+        """
+        autocommit = self.connection.autocommit
+        self.connection.autocommit = True
+        try:
+            self.acquire_lock()
+            try:
+                self.prepare()
+                current_version = self.get_version()
+                logging.info(f"Current schema at version {current_version}")
+                results = []
+                for version in range(current_version + 1, self.schema_version + 1):
+                    step = self.migrations[version]
+                    logging.info(f"Performing migration to version {version} ({step.__name__})...")
+                    started = datetime.datetime.now(datetime.timezone.utc)
+                    start = self.clock()
+                    attempts = self.apply(version, step)
+                    duration_ms = (self.clock() - start) * 1000
+                    with self.transaction() as cursor:
+                        cursor.execute("INSERT INTO migration_log VALUES (%s, %s, %s, %s, %s)",
+                                       (version, step.__name__, started, duration_ms, attempts))
+                    logging.info(f"Migrated to version {version} in {duration_ms:.0f}ms ({attempts} attempts)")
+                    results.append((version, step.__name__, duration_ms, attempts))
+                return results
+            finally:
+                self.release_lock()
+        finally:
+            self.connection.autocommit = autocommit
+
+
+def migrate(database_url, **kwargs):
+    """
+    Migrates the database at `database_url`, passing `kwargs` to `Migrator` for Postgres databases.
+    """
+    if urllib.parse.urlparse(database_url).scheme not in ("postgres", "postgresql"):
+        database.connect(database_url).close()
+        return []
+    connection = psycopg2.connect(database_url)
+    try:
+        return Migrator(connection, **kwargs).run()
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("urls", nargs="*",
+                        default=os.environ.get("DATABASE_SHARDS", "").split() or [os.environ.get("DATABASE_URL")],
+                        help="databases to migrate (defaults to DATABASE_SHARDS, or DATABASE_URL)")
+    parser.add_argument("--lock-timeout", default="2s", help="maximum time each statement waits for a lock")
+    parser.add_argument("--statement-timeout", default="1min", help="maximum duration of each transactional statement")
+    parser.add_argument("--attempts", type=int, default=10, help="number of times to try each step")
+    options = parser.parse_args()
+    if not all(options.urls):
+        parser.error("no database URL given, and DATABASE_URL is not set")
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s")
+    for url in options.urls:
+        # The database may still be starting up.
+        while True:
+            try:
+                migrate(url,
+                        lock_timeout=options.lock_timeout,
+                        statement_timeout=options.statement_timeout,
+                        attempts=options.attempts)
+                break
+            except database.OperationalError as e:
+                logging.warning("Failed to connect to the database (%s); retrying...", str(e).strip())
+                time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import struct
+
+
+MARKER = b"\xff\x00"
+MINIMUM_HEADER_LENGTH = 6  # Marker, header length, wakeup time, and image count.
+
+INDEX_ENTRY = struct.Struct("<I")
+
+
+def parse_index(data):
+    """
+    Returns a list of (offset, length) tuples describing the images in a status payload, or None if the data isn't in
+    a format we understand. Payloads are otherwise opaque to the service, so failing to parse one is not an error.
+    """
+    if len(data) < MINIMUM_HEADER_LENGTH or data[:2] != MARKER:
+        return None
+    header_length = data[2]
+    count = data[5]
+    index_end = header_length + count * INDEX_ENTRY.size
+    if header_length < MINIMUM_HEADER_LENGTH or len(data) < index_end:
+        return None
+    offsets = [INDEX_ENTRY.unpack_from(data, header_length + i * INDEX_ENTRY.size)[0] for i in range(count)]
+    bounds = [index_end] + offsets + [len(data)]
+    if any(start > end for start, end in zip(bounds, bounds[1:])):
+        return None
+    return [(offset, end - offset) for offset, end in zip(offsets, bounds[2:])]
+
+
+def image_digests(data, index):
+    view = memoryview(data)
+    return [hashlib.sha256(view[offset:offset + length]).hexdigest() for offset, length in index]
@@ -0,0 +1,194 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import werkzeug.exceptions
+
+
+TOKEN_HEADER = "HTTP_X_PROFILE_TOKEN"
+
+
+def get_frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame, root):
+    """
+    Returns the names of the frames from `root` (exclusive) to `frame`, outermost first.
+    """
+    names = []
+    while frame is not None and frame is not root:
+        names.append(get_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class Profiler(object):
+    """
+    Statistical profiler for request handlers. While running, a background thread periodically samples the stacks of
+    the threads handling profiled requests, and counts them by route in the collapsed-stack format used by
+    flamegraph.pl, speedscope, and similar tools ('route;outer;...;inner count').
+
+    A `sample_rate` fraction of requests are profiled while the profiler is running; requests carrying an
+    'X-Profile-Token' header matching `token` are always profiled. Nothing is sampled otherwise.
+    """
+
+    def __init__(self, token, sample_rate=0.01, interval=0.005, clock=time.time):
+        self.token = token
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.clock = clock
+        self.running = False
+        self._lock = threading.Lock()
+        self._active = {}  # Thread identifier to (route, frame); synchronized on _lock
+        self._stacks = collections.Counter()  # Synchronized on _lock
+        self._wake = threading.Event()
+        self._thread = None
+        self.stats = {
+            "running": False,
+            "started": None,
+            "requests": 0,
+            "samples": 0,
+        }
+
+    def is_authorized(self, token):
+        return token is not None and hmac.compare_digest(token.encode("utf-8"), self.token.encode("utf-8"))
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self.running = True
+            self.stats["running"] = True
+            self.stats["started"] = self.clock()
+            self._update_wake()
+        logging.info("Started profiling.")
+
+    def stop(self):
+        with self._lock:
+            if not self.running:
+                return
+            self.running = False
+            self.stats["running"] = False
+            self._update_wake()
+        logging.info("Stopped profiling.")
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.stats["requests"] = 0
+            self.stats["samples"] = 0
+
+    def toggle(self, path):
+        """
+        Starts the profiler, or stops it and writes the collected stacks to `path`; used by the signal handler.
+        """
+        if not self.running:
+            self.start()
+            return
+        self.stop()
+        with open(path, "w") as fh:
+            fh.write(self.dump())
+        logging.info("Wrote profile to '%s'.", path)
+
+    def dump(self):
+        """
+        Returns the collected stacks in collapsed-stack format.
+        """
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+    def should_profile(self, environ):
+        if TOKEN_HEADER in environ and self.is_authorized(environ[TOKEN_HEADER]):
+            return True
+        return self.running and random.random() < self.sample_rate
+
+    def _update_wake(self):
+        # Must be called while holding _lock. The sampling thread only runs while there's something to sample.
+        if self.running or self._active:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+            self._wake.set()
+        else:
+            self._wake.clear()
+
+    def enter(self, route, frame):
+        with self._lock:
+            self._active[threading.get_ident()] = (route, frame)
+            self.stats["requests"] += 1
+            self._update_wake()
+
+    def exit(self):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+            self._update_wake()
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            for thread_id, (route, root) in self._active.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                self._stacks[";".join([route] + collapse_stack(frame, root))] += 1
+                self.stats["samples"] += 1
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            self.sample()
+
+
+class ProfilerMiddleware(object):
+    """
+    WSGI middleware that profiles requests selected by `profiler`; the cost for unprofiled requests while the profiler
+    is stopped is a dictionary lookup.
+    """
+
+    def __init__(self, app, url_map, profiler):
+        self.app = app
+        self.url_map = url_map
+        self.profiler = profiler
+
+    def __call__(self, environ, start_response):
+        if not (self.profiler.running or TOKEN_HEADER in environ) or not self.profiler.should_profile(environ):
+            return self.app(environ, start_response)
+        try:
+            route = self.url_map.bind_to_environ(environ).match(return_rule=True)[0].rule
+        except werkzeug.exceptions.HTTPException:
+            route = "unknown"
+        self.profiler.enter(f"{environ.get('REQUEST_METHOD')} {route}", sys._getframe())
+        try:
+            return self.app(environ, start_response)
+        finally:
+            self.profiler.exit()
@@ -0,0 +1,90 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import concurrent.futures
+import logging
+import threading
+import urllib.parse
+
+import requests
+
+
+def get_surrogate_key(identifier):
+    return f"status-{identifier}"
+
+
+def get_paths(identifier, image_count):
+    """
+    Paths under which a shared cache may hold the status for `identifier`.
+    """
+    return ([f"/api/v2/{identifier}", f"/api/v3/status/{identifier}"] +
+            [f"/api/v3/status/{identifier}/image/{index}" for index in range(image_count)])
+
+
+def set_cache_headers(response, identifier, max_age):
+    """
+    Allows shared caches to serve the response for up to `max_age` seconds, or until purged; devices continue to use
+    the `max-age` and `ETag` already set on the response.
+    """
+    response.cache_control.public = True
+    response.cache_control.s_maxage = max_age
+    response.headers.set("Surrogate-Key", get_surrogate_key(identifier))
+
+
+class Purger(object):
+    """
+    Purges statuses from a shared cache (e.g., nginx or Varnish) in front of the service after they're updated.
+
+    Each cached path is purged with a `PURGE` request to `base_url`, also carrying a `Surrogate-Key` header for caches
+    that support purging by key. Purges are sent in the background so they don't delay uploads; failures are logged and
+    counted, and the cached responses then expire after their `s-maxage`.
+    """
+
+    def __init__(self, base_url, timeout=2, max_workers=2):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="purge")
+        self._lock = threading.Lock()
+        self.stats = {"purges": 0, "errors": 0}  # Synchronized on _lock
+
+    def purge(self, identifier, image_count=0):
+        return self.executor.submit(self._purge, identifier, image_count)
+
+    def _purge(self, identifier, image_count):
+        surrogate_key = get_surrogate_key(identifier)
+        for path in get_paths(identifier, image_count):
+            try:
+                response = self.session.request("PURGE",
+                                                urllib.parse.urljoin(self.base_url, path),
+                                                headers={"Surrogate-Key": surrogate_key},
+                                                timeout=self.timeout)
+                # Caches typically respond with '404 Not Found' if there was nothing to purge.
+                if response.status_code >= 400 and response.status_code != 404:
+                    raise Exception(f"Unexpected status {response.status_code}")
+                with self._lock:
+                    self.stats["purges"] += 1
+            except Exception as e:
+                logging.error("Failed to purge '%s' with error '%s'.", path, e)
+                with self._lock:
+                    self.stats["errors"] += 1
+
+    def close(self):
+        self.executor.shutdown(wait=True)
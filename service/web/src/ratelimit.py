@@ -0,0 +1,101 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    In-memory token bucket rate limiter, keyed by an arbitrary string.
+
+    Each key starts with `burst` tokens and regains `rate` tokens per second. This is per-worker state; use
+    `SharedRateLimiter` to enforce the same limits across workers.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}  # Synchronized on _lock
+
+    def acquire(self, key):
+        """
+        Returns 0 if the request is admitted, or the number of seconds until the next token becomes available.
+        """
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                return (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return 0
+
+    def _prune(self, now):
+        # Buckets that have refilled completely are indistinguishable from new ones, so they can be dropped without
+        # changing behaviour. If that doesn't free anything up, we fail open rather than growing without bound.
+        self._buckets = {key: (tokens, updated) for key, (tokens, updated) in self._buckets.items()
+                         if tokens + (now - updated) * self.rate < self.burst}
+        if len(self._buckets) > self.max_keys:
+            logging.warning("Rate limiter exceeded %d keys; resetting...", self.max_keys)
+            self._buckets = {}
+
+
+class SharedRateLimiter(object):
+    """
+    Token bucket rate limiter backed by the database, for enforcing limits across workers.
+
+    Requests are first checked against a local `RateLimiter` so requests that would be rejected anyway never reach the
+    database.
+    """
+
+    def __init__(self, get_database, rate, burst):
+        self.get_database = get_database
+        self.rate = rate
+        self.burst = burst
+        self.local = RateLimiter(rate=rate, burst=burst)
+
+    def acquire(self, key):
+        retry_after = self.local.acquire(key)
+        if retry_after:
+            return retry_after
+        return self.get_database().acquire_rate_limit_token(key, rate=self.rate, burst=self.burst)
+
+
+class ConcurrencyLimiter(object):
+    """
+    Caps the number of requests a worker will process concurrently, rejecting (rather than queueing) any excess.
+    """
+
+    def __init__(self, limit):
+        self._semaphore = threading.BoundedSemaphore(limit)
+
+    def acquire(self):
+        return self._semaphore.acquire(blocking=False)
+
+    def release(self):
+        self._semaphore.release()
@@ -0,0 +1,107 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Copies statuses to their new shards after the shard list changes.
+
+The service should first be deployed with `DATABASE_SHARDS` set to the new shards and `DATABASE_PREVIOUS_SHARDS` to the
+old ones, so that new uploads go to the new shards and statuses that haven't been copied yet are still found. Copying
+never overwrites a more recent status, so it's safe to run while the service is live, and to re-run.
+
+Once every worker is using the new shard list, run again with `--delete` to remove the copied statuses from their old
+shards (statuses modified since they were copied are left alone), and unset `DATABASE_PREVIOUS_SHARDS`.
+"""
+
+import argparse
+import collections
+import logging
+import os
+import time
+
+import database
+import sharding
+
+
+def rebalance(source_urls, target_urls, batch_size=100, delete=False):
+    """
+    Copies (and optionally deletes) every status on `source_urls` that `target_urls` places on a different shard,
+    returning the number of statuses moved keyed by `(source, target)` shard names.
+    """
+    ring = sharding.HashRing(target_urls)
+    moved = collections.Counter()
+    targets = {}
+    try:
+        for source_url in source_urls:
+            source_name = sharding.get_shard_name(source_url)
+            source = database.connect(source_url)
+            try:
+                logging.info("Moving statuses from '%s'...", source_name)
+                # Keys are read a page at a time, so shards of any size can be rebalanced in constant memory.
+                after = None
+                while True:
+                    page = source.get_keys(after=after, limit=batch_size)
+                    if not page:
+                        break
+                    after = page[-1]
+                    keys = [key for key in page if sharding.get_shard_name(ring.get_url(key)) != source_name]
+                    if not keys:
+                        continue
+                    batches = collections.defaultdict(list)
+                    for row in source.get_rows(keys):
+                        batches[ring.get_url(row.key)].append(row)
+                    for target_url, rows in batches.items():
+                        if target_url not in targets:
+                            targets[target_url] = database.connect(target_url)
+                        targets[target_url].put_rows(rows)
+                        if delete:
+                            source.delete_rows(rows)
+                        moved[(source_name, sharding.get_shard_name(target_url))] += len(rows)
+            finally:
+                source.close()
+    finally:
+        for target in targets.values():
+            target.close()
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from", dest="source_urls", nargs="+",
+                        default=os.environ.get("DATABASE_PREVIOUS_SHARDS", "").split(),
+                        help="shards to move statuses from (defaults to DATABASE_PREVIOUS_SHARDS)")
+    parser.add_argument("--to", dest="target_urls", nargs="+",
+                        default=os.environ.get("DATABASE_SHARDS", "").split(),
+                        help="new shard list (defaults to DATABASE_SHARDS)")
+    parser.add_argument("--delete", action="store_true", help="delete statuses from their old shards once copied")
+    parser.add_argument("--batch-size", type=int, default=100, help="number of statuses to copy at a time")
+    options = parser.parse_args()
+    if not options.source_urls or not options.target_urls:
+        parser.error("both the old and new shards are required")
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s")
+    start = time.monotonic()
+    moved = rebalance(options.source_urls, options.target_urls, batch_size=options.batch_size, delete=options.delete)
+    for (source, target), count in sorted(moved.items()):
+        logging.info("%s -> %s: %d", source, target, count)
+    logging.info("Moved %d statuses in %.1fs.", sum(moved.values()), time.monotonic() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import bisect
+import collections
+import contextlib
+import hashlib
+import threading
+import urllib.parse
+
+import database
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+def get_shard_name(url):
+    """
+    Name used to place a shard on the hash ring; credentials are omitted so they can be changed without moving data.
+    """
+    components = urllib.parse.urlsplit(url)
+    netloc = components.hostname or ""
+    if components.port is not None:
+        netloc += f":{components.port}"
+    return urllib.parse.urlunsplit(components._replace(netloc=netloc))
+
+
+class HashRing(object):
+    """
+    Consistent hash ring mapping keys to shard URLs. Adding a shard to N existing shards moves roughly 1/(N+1) of the
+    keys, all of them to the new shard.
+    """
+
+    def __init__(self, urls, replicas=128):
+        if not urls:
+            raise ValueError("At least one shard is required")
+        points = sorted((hash_key(f"{get_shard_name(url)}#{replica}"), url)
+                        for url in urls
+                        for replica in range(replicas))
+        self.urls = list(urls)
+        self._hashes = [point for point, _ in points]
+        self._urls = [url for _, url in points]
+
+    def get_url(self, key):
+        index = bisect.bisect(self._hashes, hash_key(key)) % len(self._hashes)
+        return self._urls[index]
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of idle connections to a single database, reused across requests.
+    """
+
+    def __init__(self, url, readonly=False, max_idle=4):
+        self.url = url
+        self.readonly = readonly
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = []  # Synchronized on _lock
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return database.connect(self.url, readonly=self.readonly)
+
+    def release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+def get_pool(url, readonly=False):
+    with POOLS_LOCK:
+        return POOLS.setdefault((url, readonly), ConnectionPool(url, readonly=readonly))
+
+
+class ShardedDatabase(database.Database):
+    """
+    Distributes statuses across several databases by consistent hashing of their identifiers. Rate limits are sharded by
+    key, and devices are stored on the shard given by `device_url`, which must be one of `urls` (so that it's migrated
+    along with them); it's named explicitly so that shards can be reordered or replaced without orphaning devices.
+
+    Connections are taken from a per-shard pool the first time a shard is used, and returned by `close`. Postgres shards
+    are migrated separately by 'migrate.py'; SQLite shards migrate themselves when they're first connected.
+
+    While rebalancing (see 'rebalance.py'), `previous_urls` gives the shards before the change; reads of statuses that
+    haven't been copied to their new shard yet fall back to the previous one. Writes always go to the new shard.
+    """
+
+    def __init__(self, urls, device_url, previous_urls=None, readonly=False):
+        if get_shard_name(device_url) not in {get_shard_name(url) for url in urls}:
+            raise ValueError("The device shard must be one of the shards")
+        self.ring = HashRing(urls)
+        self.device_url = device_url
+        self.scheduler_database = None
+        self.previous_ring = HashRing(previous_urls) if previous_urls else None
+        self.readonly = readonly
+        self._connections = {}
+
+    @property
+    def urls(self):
+        return self.ring.urls
+
+    @contextlib.contextmanager
+    def shard(self, url):
+        try:
+            connection = self._connections[url]
+        except KeyError:
+            connection = get_pool(url, readonly=self.readonly).acquire()
+            self._connections[url] = connection
+        try:
+            yield connection
+        except database.OperationalError:
+            # Don't return broken connections to the pool.
+            del self._connections[url]
+            connection.close()
+            raise
+
+    def _read(self, key, fn):
+        url = self.ring.get_url(key)
+        try:
+            with self.shard(url) as connection:
+                return fn(connection)
+        except KeyError:
+            if self.previous_ring is None or self.previous_ring.get_url(key) == url:
+                raise
+        with self.shard(self.previous_ring.get_url(key)) as connection:
+            return fn(connection)
+
+    def migrate(self):
+        for url in self.urls:
+            with self.shard(url) as connection:
+                connection.migrate()
+
+    def set_data_batch(self, items):
+        batches = collections.defaultdict(list)
+        for key, value in items:
+            batches[self.ring.get_url(key)].append((key, value))
+        for url, batch in batches.items():
+            with self.shard(url) as connection:
+                connection.set_data_batch(batch)
+
+    def get_data(self, key):
+        return self._read(key, lambda connection: connection.get_data(key))
+
+    def get_image(self, key, index):
+        return self._read(key, lambda connection: connection.get_image(key, index))
+
+    def purge_stale_data(self, max_age):
+        for url in self.urls:
+            with self.shard(url) as connection:
+                connection.purge_stale_data(max_age)
+
+    def register_device(self, token, use_sandbox=False, min_age=0):
+        with self.shard(self.device_url) as connection:
+            connection.register_device(token, use_sandbox=use_sandbox, min_age=min_age)
+
+    def get_devices(self, slot=None, slots=None):
+        with self.shard(self.device_url) as connection:
+            return connection.get_devices(slot=slot, slots=slots)
+
+    def purge_stale_devices(self, max_age):
+        with self.shard(self.device_url) as connection:
+            connection.purge_stale_devices(max_age)
+
+    def delete_device(self, token):
+        with self.shard(self.device_url) as connection:
+            connection.delete_device(token)
+
+    def acquire_rate_limit_token(self, key, rate, burst):
+        with self.shard(self.ring.get_url(key)) as connection:
+            return connection.acquire_rate_limit_token(key, rate=rate, burst=burst)
+
+    def purge_stale_rate_limits(self, max_age):
+        for url in self.urls:
+            with self.shard(url) as connection:
+                connection.purge_stale_rate_limits(max_age)
+
+    def try_lock_scheduler(self):
+        # The lock is held by a dedicated connection, which mustn't be returned to a pool while it holds it.
+        if self.scheduler_database is None:
+            self.scheduler_database = database.connect(self.device_url)
+        return self.scheduler_database.try_lock_scheduler()
+
+    def status(self):
+        result = {"deviceCount": 0, "statusCount": 0, "statusSize": 0, "shards": []}
+        for url in self.urls:
+            with self.shard(url) as connection:
+                status = connection.status()
+            result["shards"].append(status)
+            result["deviceCount"] += status["deviceCount"]
+            result["statusCount"] += status["statusCount"]
+            result["statusSize"] += status["statusSize"] or 0
+        return result
+
+    def close(self):
+        for url, connection in self._connections.items():
+            get_pool(url, readonly=self.readonly).release(connection)
+        self._connections = {}
+        if self.scheduler_database is not None:
+            self.scheduler_database.close()
+            self.scheduler_database = None
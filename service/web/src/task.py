@@ -22,11 +22,57 @@
 
 import argparse
 import subprocess
+import threading
 
 import apns
 import database
 
 
+class SchedulerLock(object):
+    """
+    Ensures scheduled tasks run in a single process, however many workers (and hosts) share the database: only the
+    process holding the database's scheduler lock runs them, and another takes over once it exits or loses its
+    connection.
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self.database = None  # Synchronized on _lock
+        self.held = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            try:
+                if self.database is None:
+                    self.database = self.connect()
+                self.held = self.database.try_lock_scheduler()
+            except Exception as e:
+                print(f"Failed to check the scheduler lock with error '{e}'.")
+                self._close()
+            return self.held
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Runs `fn` if this process holds (or can take) the lock.
+        """
+        if self.acquire():
+            fn(*args, **kwargs)
+
+    def _close(self):
+        self.held = False
+        if self.database is not None:
+            try:
+                self.database.close()
+            except Exception:
+                pass
+            self.database = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
 def send_keepalive(db, use_sandbox, tokens):
     if tokens:
         print(f"Devices: {tokens}")
@@ -39,19 +85,36 @@ def send_keepalive(db, use_sandbox, tokens):
                 db.delete_device(token=device_token)
 
 
-def run_periodic_tasks():
-    db = database.Database()
+def run_periodic_tasks(rate_limit_max_age):
+    db = database.connect()
 
     # Delete any devices that haven't been seen in a month.
     print("Purging stale devices...")
     db.purge_stale_devices(max_age=60 * 60 * 24 * 30)
 
-    # Send the tokens.
-    print("Sending keepalive...")
-    devices = db.get_devices()
+    # Discard rate limiting buckets that have had time to refill, since they're equivalent to new ones.
+    print("Purging stale rate limits...")
+    db.purge_stale_rate_limits(max_age=rate_limit_max_age)
+
+    db.close()
+
+
+def send_keepalive_slot(slot, slots):
+    """
+    Sends keepalive notifications to the devices in one slot (see `keepalive.KeepaliveScheduler`), returning the number
+    of devices.
+    """
+    db = database.connect()
+    try:
+        print(f"Sending keepalive to slot {slot}/{slots}...")
+        devices = db.get_devices(slot=slot, slots=slots)
+
+        print("Sending sandbox tokens...")
+        send_keepalive(db, use_sandbox=True, tokens=[device["token"] for device in devices if device["use_sandbox"]])
 
-    print("Sending sandbox tokens...")
-    send_keepalive(db, use_sandbox=True, tokens=[device["token"] for device in devices if device["use_sandbox"]])
+        print("Sending tokens...")
+        send_keepalive(db, use_sandbox=False, tokens=[device["token"] for device in devices if not device["use_sandbox"]])
 
-    print("Sending tokens...")
-    send_keepalive(db, use_sandbox=False, tokens=[device["token"] for device in devices if not device["use_sandbox"]])
+        return len(devices)
+    finally:
+        db.close()
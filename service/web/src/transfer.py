@@ -0,0 +1,291 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Exports the statuses and devices in a Postgres database to a directory, and imports them into another, using binary
+`COPY`.
+
+Exports are written a chunk (of `--chunk-size` rows, in key order) at a time, each chunk to its own file, and streamed
+straight to disk, so no more than a single buffer is held in memory. Progress is recorded in 'manifest.json' in the
+export directory after each chunk, so an interrupted export or import can be resumed by running the same command
+again. `--since` and `--until` limit the export to rows last modified in that range.
+
+Imports never overwrite a more recent status or device, so they're safe to run against a live database and to re-run,
+and they're refused unless the database is at the same schema version as the export; run 'migrate.py' first. Devices
+are matched by token, since their identifiers are local to each database. Each shard of a sharded deployment should be
+exported separately; run 'rebalance.py' after importing if the shard lists differ.
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+import psycopg2
+import psycopg2.extensions
+
+import database
+import sharding
+
+
+MANIFEST = "manifest.json"
+
+Table = collections.namedtuple("Table", ["name", "key", "columns", "merge"])
+
+TABLES = collections.OrderedDict([
+    ("data", Table("data", "id", ["id", "data", "last_modified", "update_interval", "image_offsets", "image_lengths",
+                                  "image_digests"],
+                   """INSERT INTO data (id, data, last_modified, update_interval, image_offsets, image_lengths, image_digests)
+                           SELECT id, data, last_modified, update_interval, image_offsets, image_lengths, image_digests
+                             FROM staging
+                      ON CONFLICT (id) DO UPDATE
+                              SET data = EXCLUDED.data,
+                                  last_modified = EXCLUDED.last_modified,
+                                  update_interval = EXCLUDED.update_interval,
+                                  image_offsets = EXCLUDED.image_offsets,
+                                  image_lengths = EXCLUDED.image_lengths,
+                                  image_digests = EXCLUDED.image_digests
+                            WHERE data.last_modified < EXCLUDED.last_modified""")),
+    ("devices", Table("devices", "id", ["id", "token", "last_modified", "use_sandbox"],
+                      """INSERT INTO devices (token, last_modified, use_sandbox)
+                              SELECT token, last_modified, use_sandbox
+                                FROM staging
+                         ON CONFLICT (token) DO UPDATE
+                                 SET last_modified = EXCLUDED.last_modified,
+                                     use_sandbox = EXCLUDED.use_sandbox
+                               WHERE devices.last_modified < EXCLUDED.last_modified""")),
+])
+
+
+class TransferError(Exception):
+    pass
+
+
+def connect(database_url, readonly=False):
+    if urllib.parse.urlparse(database_url).scheme not in ("postgres", "postgresql"):
+        raise TransferError("Only Postgres databases can be exported and imported")
+    connection = psycopg2.connect(database_url)
+    if readonly:
+        # Each exported chunk is read in a single snapshot, so its row count and last key match the file.
+        connection.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    else:
+        # Imports upsert rows that live traffic may be updating concurrently; at REPEATABLE READ those conflicts would
+        # abort the chunk with a serialization failure, whereas the conditional upserts are safe at READ COMMITTED.
+        connection.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    return connection
+
+
+def get_schema_version(connection):
+    with database.Transaction(connection) as cursor:
+        return database.get_schema_version(cursor)
+
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+class Progress(object):
+    """
+    Logs the rows and bytes transferred for each table, and the throughput so far.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.start = clock()
+        self.rows = collections.Counter()
+        self.bytes = collections.Counter()
+
+    def update(self, table, rows, size):
+        self.rows[table] += rows
+        self.bytes[table] += size
+        duration = max(self.clock() - self.start, 1e-6)
+        logging.info("%s: %d rows (%.1f MB); %.0f rows/s, %.1f MB/s",
+                     table, self.rows[table], self.bytes[table] / 1e6,
+                     sum(self.rows.values()) / duration, sum(self.bytes.values()) / 1e6 / duration)
+
+    def summary(self):
+        return {table: {"rows": self.rows[table], "bytes": self.bytes[table]} for table in self.rows}
+
+
+def get_conditions(table, since, until, position):
+    conditions, parameters = ["TRUE"], []
+    if since is not None:
+        conditions.append("last_modified >= %s")
+        parameters.append(since)
+    if until is not None:
+        conditions.append("last_modified < %s")
+        parameters.append(until)
+    if position is not None:
+        conditions.append(f"{table.key} > %s")
+        parameters.append(position)
+    return " AND ".join(conditions), parameters
+
+
+def export(database_url, directory, tables=tuple(TABLES), since=None, until=None, chunk_size=1000, progress=None):
+    """
+    Exports `tables` from the database at `database_url` to `directory`, resuming a previous export if there is one.
+    `since` and `until` are ISO 8601 timestamps. Returns the manifest.
+    """
+    progress = progress if progress is not None else Progress()
+    os.makedirs(directory, exist_ok=True)
+    connection = connect(database_url, readonly=True)
+    try:
+        schema_version = get_schema_version(connection)
+        manifest = load_manifest(directory)
+        if manifest is None:
+            manifest = {"schemaVersion": schema_version,
+                        "since": since,
+                        "until": until,
+                        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                        "tables": {}}
+        elif (manifest["schemaVersion"], manifest["since"], manifest["until"]) != (schema_version, since, until):
+            raise TransferError(f"'{directory}' contains a different export; use a new directory")
+
+        for name in tables:
+            table = TABLES[name]
+            state = manifest["tables"].setdefault(name, {"columns": table.columns, "chunks": [], "complete": False})
+            while not state["complete"]:
+                position = state["chunks"][-1]["lastKey"] if state["chunks"] else None
+                conditions, parameters = get_conditions(table, since, until, position)
+                filename = f"{name}-{len(state['chunks']):06d}.copy"
+                path = os.path.join(directory, filename)
+                with database.Transaction(connection) as cursor:
+                    cursor.execute(f"""SELECT count(*), max({table.key})
+                                         FROM (SELECT {table.key}
+                                                 FROM {name}
+                                                WHERE {conditions}
+                                             ORDER BY {table.key}
+                                                LIMIT %s) AS chunk""",
+                                   parameters + [chunk_size])
+                    rows, last_key = cursor.fetchone()
+                    if rows:
+                        query = cursor.mogrify(f"""COPY (SELECT {', '.join(table.columns)}
+                                                           FROM {name}
+                                                          WHERE {conditions} AND {table.key} <= %s
+                                                       ORDER BY {table.key})
+                                                   TO STDOUT (FORMAT binary)""", parameters + [last_key])
+                        with open(path + ".tmp", "wb") as f:
+                            cursor.copy_expert(query.decode(), f)
+                if not rows:
+                    state["complete"] = True
+                else:
+                    os.replace(path + ".tmp", path)
+                    size = os.path.getsize(path)
+                    state["chunks"].append({"file": filename, "rows": rows, "bytes": size, "lastKey": last_key})
+                    progress.update(name, rows, size)
+                save_manifest(directory, manifest)
+        return manifest
+    finally:
+        connection.close()
+
+
+def import_(database_url, directory, progress=None):
+    """
+    Imports a complete export from `directory` into the database at `database_url`, skipping chunks already imported
+    into that database. Returns the number of rows inserted or updated by table.
+    """
+    progress = progress if progress is not None else Progress()
+    manifest = load_manifest(directory)
+    if manifest is None:
+        raise TransferError(f"'{directory}' doesn't contain an export")
+    if not all(state["complete"] for state in manifest["tables"].values()):
+        raise TransferError(f"The export in '{directory}' is incomplete; run the export again to finish it")
+    connection = connect(database_url)
+    try:
+        schema_version = get_schema_version(connection)
+        if schema_version != manifest["schemaVersion"]:
+            raise TransferError(f"The export is at schema version {manifest['schemaVersion']} but the database is at "
+                                f"version {schema_version}")
+
+        # Progress is tracked per target database, so the same export can be imported into several.
+        imports = manifest.setdefault("imports", {}).setdefault(sharding.get_shard_name(database_url), {})
+        changed = collections.Counter()
+        for name, state in manifest["tables"].items():
+            table = TABLES[name]
+            if state["columns"] != table.columns:
+                raise TransferError(f"The columns of '{name}' in the export don't match this version")
+            for chunk in state["chunks"][imports.get(name, 0):]:
+                with open(os.path.join(directory, chunk["file"]), "rb") as f, database.Transaction(connection) as cursor:
+                    cursor.execute(f"CREATE TEMPORARY TABLE staging (LIKE {name}) ON COMMIT DROP")
+                    cursor.copy_expert(f"COPY staging ({', '.join(table.columns)}) FROM STDIN (FORMAT binary)", f)
+                    cursor.execute(table.merge)
+                    changed[name] += cursor.rowcount
+                imports[name] = imports.get(name, 0) + 1
+                save_manifest(directory, manifest)
+                progress.update(name, chunk["rows"], chunk["bytes"])
+        return changed
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default=os.environ.get("DATABASE_URL"),
+                        help="database to export from or import into (defaults to DATABASE_URL)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="export to a directory")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--tables", nargs="+", choices=list(TABLES), default=list(TABLES),
+                               help="tables to export (defaults to all)")
+    export_parser.add_argument("--since", help="only export rows last modified at or after this ISO 8601 timestamp")
+    export_parser.add_argument("--until", help="only export rows last modified before this ISO 8601 timestamp")
+    export_parser.add_argument("--chunk-size", type=int, default=1000, help="number of rows in each chunk")
+    import_parser = subparsers.add_parser("import", help="import from a directory")
+    import_parser.add_argument("directory")
+    options = parser.parse_args()
+    if not options.database:
+        parser.error("no database URL given, and DATABASE_URL is not set")
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s")
+    progress = Progress()
+    try:
+        if options.command == "export":
+            export(options.database, options.directory, tables=options.tables, since=options.since,
+                   until=options.until, chunk_size=options.chunk_size, progress=progress)
+        else:
+            changed = import_(options.database, options.directory, progress=progress)
+            for name, count in changed.items():
+                logging.info("%s: %d rows inserted or updated", name, count)
+    except TransferError as e:
+        parser.exit(1, f"{parser.prog}: {e}\n")
+    summary = progress.summary()
+    logging.info("Transferred %d rows (%.1f MB) in %.1fs.",
+                 sum(table["rows"] for table in summary.values()),
+                 sum(table["bytes"] for table in summary.values()) / 1e6,
+                 time.monotonic() - progress.start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# Copyright (c) 2018-2025 Jason Morley, Tom Sutcliffe
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import threading
+import time
+
+
+class WriteBehindBuffer(object):
+    """
+    Bounded, coalescing write-behind buffer for uploads.
+
+    `put` queues an upload in memory and returns immediately; a background thread writes everything queued every
+    `interval` seconds using a single batched write (and commit). Uploads to the same identifier within an interval are
+    coalesced, with the last one winning.
+
+    Durability: an upload is acknowledged once it's queued, not once it's committed. Queued uploads are flushed on
+    `close`, but any acknowledged in the last `interval` (or while the database is unavailable) are lost if the process
+    exits uncleanly. They are also only visible to readers once flushed, after which `on_write` is called with the
+    written uploads; until then, `identifier in buffer` is true. When `max_pending` identifiers are queued, `put`
+    returns False for any identifier that isn't already in the buffer, and the caller should write synchronously
+    instead.
+    """
+
+    def __init__(self, connect, interval, max_pending, retry_interval=1, on_write=None):
+        self.connect = connect
+        self.on_write = on_write
+        self.interval = interval
+        self.max_pending = max_pending
+        self.retry_interval = retry_interval
+        self.database = None  # Only accessed from the writer thread.
+        self._condition = threading.Condition()
+        self._pending = {}  # Synchronized on _condition
+        self._writing = {}  # Synchronized on _condition
+        self._stopped = False  # Synchronized on _condition
+        # Synchronized on _condition
+        self.stats = {"queued": 0, "coalesced": 0, "rejected": 0, "written": 0, "batches": 0, "errors": 0}
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, identifier, data):
+        with self._condition:
+            if self._stopped:
+                return False
+            if identifier in self._pending:
+                self.stats["coalesced"] += 1
+                del self._pending[identifier]  # Re-inserting keeps the pending uploads in arrival order.
+            elif len(self._pending) >= self.max_pending and identifier not in self._writing:
+                # Uploads for identifiers that are being written are always queued, even when full: writing them
+                # synchronously could commit before the batch (or its retry), which would then overwrite them.
+                self.stats["rejected"] += 1
+                return False
+            self._pending[identifier] = data
+            self.stats["queued"] += 1
+            if len(self._pending) == 1:
+                self._condition.notify()
+            return True
+
+    def __contains__(self, identifier):
+        with self._condition:
+            return identifier in self._pending or identifier in self._writing
+
+    def close(self, timeout=10):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.error("Failed to flush %d uploads before shutdown.", len(self._pending))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                # Allow the batch to fill up, writing immediately if we're asked to stop.
+                deadline = time.monotonic() + self.interval
+                while not self._stopped:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch, self._pending = self._pending, {}
+                self._writing = batch
+            if not self._write(batch):
+                with self._condition:
+                    # Uploads received while we were writing are newer, so they take precedence.
+                    batch.update(self._pending)
+                    self._pending = batch
+                    self._writing = {}
+                time.sleep(self.retry_interval)
+                continue
+            with self._condition:
+                self._writing = {}
+
+    def _write(self, batch):
+        try:
+            if self.database is None:
+                self.database = self.connect()
+            self.database.set_data_batch(list(batch.items()))
+        except Exception as e:
+            logging.error("Failed to write %d uploads with error '%s'; retrying...", len(batch), e)
+            with self._condition:
+                self.stats["errors"] += 1
+            if self.database is not None:
+                try:
+                    self.database.close()
+                except Exception:
+                    pass
+                self.database = None
+            return False
+        with self._condition:
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+        if self.on_write is not None:
+            # The uploads have been written, so a failure here mustn't cause them to be retried (or stop the writer).
+            try:
+                self.on_write(batch)
+            except Exception as e:
+                logging.error("Failed to handle %d written uploads with error '%s'.", len(batch), e)
+        return True